@@ -0,0 +1,137 @@
+# Lazy access to the APHRODITE daily precipitation archive (APHRO_MA_025deg_V1101.<year>.nc, 1951-2007) as one cube
+# indexed by (date, latitude row, longitude column). Nothing is read when the cube is made: a yearly file is only opened
+# the first time one of its days is asked for, and only the requested slab (one day, one cell's series, a window...)
+# is read from it, so a day of any year costs the same as a day of the first one and the ~20k daily grids are never all
+# in memory. A few files are kept open for the next reads (maxOpen), the least recently used one is closed first.
+#
+#   precipCube = PrecipCube(aphroditePattern, range(1951, 2007+1))
+#   precipCube.day(1998, 32)                                    - 1 Feb 1998 (day of year starts at 1), lat x lon
+#   precipCube['1998-02-01']                                    - same day
+#   precipCube['1998-01-01':'1999-01-01', 120, 200]             - daily series of one cell for 1998
+#   precipCube[0:365*2, 100:140, 180:220]                       - days by number from the first of January of the
+#                                                                 first year, then rows and columns
+# Missing values (ocean cells) are NaN. Dates are datetime.date/datetime, numpy.datetime64, 'YYYY-MM-DD' strings or
+# day numbers; slices of dates stop before the stop date like any slice.
+
+import datetime
+from collections import OrderedDict
+
+import numpy as np
+import netCDF4
+
+
+class DailyArchive(object):
+    # Dates and day numbers of a daily archive of whole years, shared with the consolidated store (aphrodite_store.py)
+
+    def __init__(self, years):
+        self.years = list(years)
+        self.first = datetime.date(self.years[0], 1, 1)
+        self.end = datetime.date(self.years[-1]+1, 1, 1)
+
+    def __len__(self):
+        # Days in the archive. The files are daily with leap days, so this comes from the calendar
+        return (self.end - self.first).days
+
+    def date(self, dayNumber):
+        return self.first + datetime.timedelta(days=int(dayNumber))
+
+    def dayNumber(self, value):
+        # Day number from the first of January of the first year of a date, a 'YYYY-MM-DD' string or a day number
+        if value is None or isinstance(value, (int, np.integer)):
+            return value
+        if isinstance(value, np.datetime64):
+            value = value.astype('datetime64[D]').astype(datetime.date)
+        elif isinstance(value, (str, type(u''))):
+            value = datetime.datetime.strptime(value[:10], '%Y-%m-%d').date()
+        elif isinstance(value, datetime.datetime):
+            value = value.date()
+        return (value - self.first).days
+
+    def day(self, year, day, lat=slice(None), lon=slice(None)):
+        # One day of a year (day of year starting at 1), like precipData[year-1951][day-1] used to be. A day outside
+        # the year is an IndexError, not a day of the next year
+        daysInYear = (datetime.date(year+1, 1, 1) - datetime.date(year, 1, 1)).days
+        if not 1 <= day <= daysInYear:
+            raise IndexError('Day '+str(day)+' is not in '+str(year))
+        return self[(datetime.date(year, 1, 1) - self.first).days + day-1, lat, lon]
+
+    def _splitKey(self, key):
+        # (days, latitude key, longitude key) of a cube key. days is a day number for one date, a slice
+        # with start, stop and step all set for a slice of dates
+        if not isinstance(key, tuple):
+            key = (key,)
+        timeKey = key[0]
+        lat, lon = tuple(key[1:]) + (slice(None),)*(3-len(key))
+        if not isinstance(timeKey, slice):
+            dayNumber = self.dayNumber(timeKey)
+            if dayNumber < 0:
+                dayNumber += len(self)
+            if not 0 <= dayNumber < len(self):
+                raise IndexError('Day '+str(timeKey)+' is not in the archive')
+            return dayNumber, lat, lon
+        start, stop, step = slice(self.dayNumber(timeKey.start), self.dayNumber(timeKey.stop),
+                                  timeKey.step).indices(len(self))
+        if step < 0:
+            raise ValueError('Days have to be in increasing order')
+        return slice(start, stop, step), lat, lon
+
+    def _yearDay(self, dayNumber):
+        date = self.date(dayNumber)
+        return date.year, date.timetuple().tm_yday-1
+
+
+class PrecipCube(DailyArchive):
+
+    def __init__(self, pathPattern, years, variable='precip', maxOpen=4):
+        # pathPattern: path of a yearly file with {0} for the year. years: years of the archive, consecutive
+        DailyArchive.__init__(self, years)
+        self.pathPattern = pathPattern
+        self.variable = variable
+        self.maxOpen = maxOpen
+        self._open = OrderedDict()
+
+    @property
+    def shape(self):
+        # (days, latitude rows, longitude columns). Opens the first file for the grid size
+        nLat, nLon = self._dataset(self.years[0]).variables[self.variable].shape[1:]
+        return len(self), nLat, nLon
+
+    def __getitem__(self, key):
+        days, lat, lon = self._splitKey(key)
+        if not isinstance(days, slice):
+            year, dayOfYear = self._yearDay(days)
+            return self._read(year, (dayOfYear, lat, lon))
+        # Each year's days of the slice are one strided slab of that year's file
+        slabs = list()
+        dayNumber, stop, step = days.start, days.stop, days.step
+        while dayNumber < stop:
+            year, dayOfYear = self._yearDay(dayNumber)
+            yearEnd = min(stop, (datetime.date(year+1, 1, 1) - self.first).days)
+            count = (yearEnd - dayNumber + step - 1)//step
+            slabs.append(self._read(year, (slice(dayOfYear, dayOfYear + (count-1)*step + 1, step), lat, lon)))
+            dayNumber += count*step
+        if not slabs:
+            return self._read(self.years[0], (slice(0, 0), lat, lon))
+        return np.concatenate(slabs, axis=0)
+
+    def _dataset(self, year):
+        if year in self._open:
+            self._open[year] = self._open.pop(year)
+            return self._open[year]
+        if year not in self.years:
+            raise IndexError('No file for '+str(year))
+        if len(self._open) >= self.maxOpen:
+            _, dataset = self._open.popitem(last=False)
+            dataset.close()
+        self._open[year] = netCDF4.Dataset(self.pathPattern.format(year))
+        return self._open[year]
+
+    def _read(self, year, key):
+        # Only the slab in key is read from the file. Masked cells become NaN
+        data = self._dataset(year).variables[self.variable][key]
+        return np.ma.filled(np.ma.asarray(data, dtype=np.float32), np.nan)
+
+    def close(self):
+        for dataset in self._open.values():
+            dataset.close()
+        self._open.clear()
@@ -0,0 +1,133 @@
+# Consolidated store of the 1951-2007 APHRODITE archive, made once from the yearly .nc files (convert), so neither a
+# daily map nor a 57 year series of one cell has to read whole netCDF files. The archive is kept twice, as compressed
+# .npz chunks of float32 (NaN for missing values):
+#   maps/<year>/<day of year>.npz   - one day of the whole grid per chunk
+#   series/<row>_<col>.npz          - every day of a small block of cells (blockShape, 8 x 8 by default) per chunk
+#   store.json                      - years, grid shape and block shape, written last so a half finished conversion
+#                                     isn't mistaken for a store
+# PrecipStore is indexed like PrecipCube (see aphrodite_cube.py) and reads each query from the layout that means
+# decompressing fewer cells: a day or a window of a few days from the maps, a cell or a small area over many days
+# from the series. Lists of rows or columns select every combination of them, as in netCDF4. The last few chunks
+# read are kept in memory, so cells of the same block don't decompress it again.
+#
+#   convert(PrecipCube(aphroditePattern, range(1951, 2007+1)), storeFolder)      - once, takes a while
+#   precipStore = PrecipStore(storeFolder)
+#   precipStore.day(1998, 32)                   - from maps/1998/032.npz
+#   precipStore[:, 120, 200]                    - all 57 years of one cell, from one series chunk
+
+import json
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+from aphrodite_cube import DailyArchive, PrecipCube
+
+infoName = 'store.json'
+
+
+def convert(cube, folder, blockShape=(8, 8)):
+    # Writes both layouts of cube (a PrecipCube) to folder. The maps are written a year at a time, the series a band
+    # of blockShape[0] rows at a time, so memory use is one year or one band of the archive, not the whole of it
+    nDays, nLat, nLon = cube.shape
+    blockRows, blockCols = blockShape
+    for year in cube.years:
+        yearDays = cube['%d-01-01' % year:'%d-01-01' % (year+1)]
+        yearFolder = os.path.join(folder, 'maps', str(year))
+        if not os.path.isdir(yearFolder):
+            os.makedirs(yearFolder)
+        for dayOfYear in range(len(yearDays)):
+            np.savez_compressed(os.path.join(yearFolder, '%03d.npz' % (dayOfYear+1)), precip=yearDays[dayOfYear])
+        print('Maps of '+str(year)+' written')
+        del yearDays
+    seriesFolder = os.path.join(folder, 'series')
+    if not os.path.isdir(seriesFolder):
+        os.makedirs(seriesFolder)
+    for row0 in range(0, nLat, blockRows):
+        band = cube[:, row0:row0+blockRows, :]
+        for col0 in range(0, nLon, blockCols):
+            np.savez_compressed(os.path.join(seriesFolder, '%d_%d.npz' % (row0, col0)),
+                                precip=band[:, :, col0:col0+blockCols])
+        print('Series of rows '+str(row0)+' to '+str(min(row0+blockRows, nLat)-1)+' written')
+        del band
+    with open(os.path.join(folder, infoName), 'w') as f:
+        json.dump({'years': list(cube.years), 'shape': [nDays, nLat, nLon], 'blockShape': list(blockShape)}, f)
+    return PrecipStore(folder)
+
+
+class PrecipStore(DailyArchive):
+
+    def __init__(self, folder, maxCached=8):
+        # maxCached: chunks kept in memory after they are read
+        with open(os.path.join(folder, infoName)) as f:
+            info = json.load(f)
+        DailyArchive.__init__(self, info['years'])
+        self.folder = folder
+        self.shape = tuple(info['shape'])
+        self.blockShape = tuple(info['blockShape'])
+        self.maxCached = maxCached
+        self._cache = OrderedDict()
+
+    def layout(self, key):
+        # 'maps' or 'series', the layout a query is read from
+        days, rows, cols = self._indices(key)[:3]
+        return self._layout(len(days), rows, cols)
+
+    def _layout(self, nDays, rows, cols):
+        # Cells decompressed with either layout: the whole grid for every day, or every day of every block touched
+        mapCells = nDays*self.shape[1]*self.shape[2]
+        blocks = len(np.unique(rows//self.blockShape[0]))*len(np.unique(cols//self.blockShape[1]))
+        seriesCells = blocks*len(self)*self.blockShape[0]*self.blockShape[1]
+        return 'maps' if mapCells <= seriesCells else 'series'
+
+    def _indices(self, key):
+        # Day numbers, rows and columns of a key, and which of them were single values (dropped from the result)
+        days, lat, lon = self._splitKey(key)
+        dayScalar = not isinstance(days, slice)
+        days = np.array([days]) if dayScalar else np.arange(days.start, days.stop, days.step)
+        rows = np.arange(self.shape[1])[lat]
+        cols = np.arange(self.shape[2])[lon]
+        return days, np.atleast_1d(rows), np.atleast_1d(cols), (dayScalar, rows.ndim == 0, cols.ndim == 0)
+
+    def __getitem__(self, key):
+        days, rows, cols, scalars = self._indices(key)
+        out = np.empty((len(days), len(rows), len(cols)), dtype=np.float32)
+        if len(days) and len(rows) and len(cols):
+            if self._layout(len(days), rows, cols) == 'maps':
+                for i, dayNumber in enumerate(days):
+                    year, dayOfYear = self._yearDay(dayNumber)
+                    chunk = self._chunk(os.path.join('maps', str(year), '%03d.npz' % (dayOfYear+1)))
+                    out[i] = chunk[np.ix_(rows, cols)]
+            else:
+                blockRows, blockCols = self.blockShape
+                for row0 in np.unique(rows//blockRows)*blockRows:
+                    inRows = np.flatnonzero((rows >= row0) & (rows < row0+blockRows))
+                    for col0 in np.unique(cols//blockCols)*blockCols:
+                        inCols = np.flatnonzero((cols >= col0) & (cols < col0+blockCols))
+                        chunk = self._chunk(os.path.join('series', '%d_%d.npz' % (row0, col0)))
+                        out[np.ix_(np.arange(len(days)), inRows, inCols)] = \
+                            chunk[np.ix_(days, rows[inRows]-row0, cols[inCols]-col0)]
+        dayScalar, rowScalar, colScalar = scalars
+        return out[(0 if dayScalar else slice(None), 0 if rowScalar else slice(None), 0 if colScalar else slice(None))]
+
+    def series(self, row, col, start=None, stop=None):
+        # Daily series of one cell from start up to stop (dates or day numbers, the whole archive by default)
+        return self[start:stop, row, col]
+
+    def _chunk(self, name):
+        if name in self._cache:
+            self._cache[name] = self._cache.pop(name)
+            return self._cache[name]
+        with np.load(os.path.join(self.folder, name)) as f:
+            chunk = f['precip']
+        if len(self._cache) >= self.maxCached:
+            self._cache.popitem(last=False)
+        self._cache[name] = chunk
+        return chunk
+
+
+if __name__ == '__main__':
+    # One time conversion of the yearly files. Paths are valid as of last edit, may need to be changed when data moves
+    aphroditePattern = "D:/Mekong NASA IDS/Mekong Data/Precip_Data/APHRODITE/netcdf/extracted/APHRO_MA_025deg_V1101.{0}.nc/APHRO_MA_025deg_V1101.{0}.nc"
+    storeFolder = "D:/Mekong NASA IDS/Mekong Data/Precip_Data/APHRODITE/store"
+    convert(PrecipCube(aphroditePattern, range(1951, 2007+1)), storeFolder)
@@ -4,14 +4,17 @@
 # Written by Jake Roush on 11/10/2017
 # Last modified 11/10/2017
 
+import os
+
 import numpy as np
 import pandas as pd
-import netCDF4
 import arcpy
 
-# Declaring variables and making an empty list
+from aphrodite_cube import PrecipCube
+from aphrodite_store import PrecipStore
+
+# Declaring variables
 yearRange = range(1951, 2007+1) # Defining range of years covered by data
-precipData = list() # Making empty list to iteratively populate
 latRange = np.arange(55,-15,-0.25) # Defining limits of latitude for the dataset
 lonRange = np.arange(60,150,0.25) # Defining limits of longitude for dataset
 
@@ -26,25 +29,17 @@ sampleRas = arcpy.Raster('S:\\Users\\roushjac\\NASA_Mekong\\Codes\\Precip\\preci
 
 
 
-for b in yearRange: # Iterating through my list of years to select each file from the google drive
-    
-    # Reading in one .nc file from the APHRODITE precip data
-    # File path is valid as of last edit, may need to be changed when data moves
-    oneFile = netCDF4.Dataset("D:/Mekong NASA IDS/Mekong Data/Precip_Data/APHRODITE/netcdf/extracted/APHRO_MA_025deg_V1101."+str(b)+".nc/APHRO_MA_025deg_V1101."+str(b)+".nc")
-    
-    # Writing the contents of the .nc to an array
-    pData = oneFile.variables['precip'][:] # Shape is time, latitude, longitude
-    
-    # Attempting to store each day, which is a numpy array, as a separate index in a list
-    # This will hopefully allow for easy selecting of any given day by simply inputting the day as an index to the list
-    pList = list()
-    
-    for a in range(0,len(pData)): # Iterating through all days for 1 year - should be 365
-        pOneDayArray = pData[a] # Selecting one day
-        pList.append(pOneDayArray) # Appending that day to list
-    
-    precipData.append(pList) # Append yearly data to total list - 1 year for each index
-        
+# The yearly .nc files are opened as one cube of (day, latitude, longitude) without reading them (see aphrodite_cube.py).
+# A file is only opened when one of its days is asked for, and only that day is read, instead of copying every day
+# of the 57 files into a list up front
+# File path is valid as of last edit, may need to be changed when data moves
+aphroditePattern = "D:/Mekong NASA IDS/Mekong Data/Precip_Data/APHRODITE/netcdf/extracted/APHRO_MA_025deg_V1101.{0}.nc/APHRO_MA_025deg_V1101.{0}.nc"
+# Once the archive has been converted to the chunked store (run aphrodite_store.py), days are read from there instead
+aphroditeStore = "D:/Mekong NASA IDS/Mekong Data/Precip_Data/APHRODITE/store"
+if os.path.exists(os.path.join(aphroditeStore, 'store.json')):
+    precipCube = PrecipStore(aphroditeStore)
+else:
+    precipCube = PrecipCube(aphroditePattern, yearRange)
 
 
 
@@ -53,7 +48,7 @@ for b in yearRange: # Iterating through my list of years to select each file fro
 
 def makePrecipRaster(year, day, rasName):
     # Function arguments are a year, day, and a raster name. Saves to given Arcpy workspace
-    oneDay = precipData[(year-min(yearRange))][day-1]
+    oneDay = precipCube.day(year, day) # Only this day is read from the year's file. Missing values are NaN
     oneDayDF = pd.DataFrame(oneDay)
     # Don't really need to rename columns/rows anymore, but keeping the code here in case something changes
     oneDayDF.columns = lonRange # Renaming column names to match up with longitude coordinates
@@ -9,9 +9,24 @@ import arcpy
 import os, subprocess
 import pandas as pd, numpy as np
 import time
-import threading
-
-#%% Convert CSVs from R outputs into dbf files
+# Helper modules kept in this folder
+import FocalSum
+from AttributeStore import AttributeStore
+from RasterGrid import RasterGrid
+from RadialProfile import RadialProfiles
+import BufferGroups
+import FarmPlacement
+import BinPlacement
+import RadiusUpdate
+import RasterAlgebra
+import ZonalStats
+import PointRaster
+from PackedMask import PackedMask, groupPolygons
+import CompactRaster
+import RunTrace
+import MassBalance
+
+#%% [stage: input tables] Convert CSVs from R outputs into dbf files
 # This was not working with 64 bit background processing enabled and I cannot figure out how to to fix it. Doing it manually 
 # in ArcMap for now
 arcpy.TableToTable_conversion('S:\\Users\\roushjac\\Tipping Points\\Manure\\Script\\All_CAFOs_Final.xlsx\Sheet1$', 'S:\\Users\\roushjac\\Tipping Points\\Manure\\Script\\Python\\Inputs', 'All_CAFOs_Final')
@@ -21,7 +36,7 @@ arcpy.TableToTable_conversion('S:\\Users\\roushjac\\Tipping Points\\Manure\\Scri
 arcpy.TableToTable_conversion('S:\\Users\\roushjac\\Tipping Points\\Manure\\Script\\Total_Confined_County_Loads.xlsx', 'S:\\Users\\roushjac\\Tipping Points\\Manure\\Script\\Python\\Inputs', 'Total_Confined_County_Loads')
 
 
-#%% Refresh inputs cell
+#%% [setup] Refresh inputs cell
 
 #Set working directory for the script - separate from the ArcPy working directory
 os.chdir("S:\\Users\\roushjac\\Tipping Points\\Manure\\Script\\Python")
@@ -66,6 +81,7 @@ fieldPUnrecovered = 'kgP_y_urec'
 fieldAnimalBin = 'GMEID'
 fieldLoadID = 'BIN_CTY'
 fieldFarmCount = 'FARMS_TOT'
+fieldOperations = 'Operations' # Number of farms to place for each BIN_CTY
 #Fertilizer Demand
 # As of initially writing this script on 6-30-2017, these rasters were made using the old model method. They will work for
 # now, but should be updated to use rasters generated by the new model
@@ -101,7 +117,18 @@ ReqAreaThreshold = .05 # 5 percent - means that the difference in area needs to
 ConvThreshold = .04 #Percentage of CAFOS whose area needs to converge before loop ends
 paramFocalDist = 667 #Approximately 20km radius
 paramFocalDistPasture = 15 #Approximately 40 acres circular area
+# Focal distance sensitivity runs: extra radii (cells) whose focal areas are summed in the same pass as the model's
+# radius and stored next to it as FocalArea_<radius>.npy / FocalAreaPast_<radius>.npy, e.g. [333, 500, 833]
+paramFocalDistSweep = []
+paramFocalDistPastureSweep = []
+paramRadiusUpdate = 'secant' # How buffer radii are updated in the convergence loop. 'damped' is the original 1/.75/.5/.1 schedule (see RadiusUpdate.py)
+paramMaxIterations = 200 # The convergence loop stops after this many iterations even if Conv is still above ConvThreshold
 paramPastureAssimiliation = .0084
+paramAvgRCapPercentile = 90 # County average confined application rates (AvgR) above this percentile are capped at it
+paramPlacementSeed = 2017 # Seed for the random farm placement. The same seed places the same farms
+paramPlacementWorkers = 4 # Processes used to place farms. 1 places every bin in this process, with the same result
+paramRasterWorkers = 4 # Threads used to evaluate the ag mask band by band (see RasterAlgebra.py)
+paramTracePython = True # Record the peak of Python/NumPy allocations with tracemalloc (Python 3 only). Slows pure Python loops a little
 
 #Temporary Parameters: Don't need to change these
 featureTempGolfCourses = 'tempGolfCourses'
@@ -110,15 +137,15 @@ fieldRaster = 'raster'
 fieldCountyJoin = 'CtyID'
 fieldManureAreaTotal = 'MAN_M2'
 featureTempCountyManure = 'CtyMan'
-rasterFocalArea = 'FocalArea'
-rasterFocalAreaPast = 'FocalAreaPast'
+rasterAgMaskRect = 'Ag_Mask_Rect'
 featureTempCountyManureArea = 'CtyManArea'
 featureTempCountyManureClip = 'CtyManClip'
 fieldAvgRate = 'AvgR'
-featureCAFOLocationPolys = 'DNRE_CAFO_Polys'
 rasterRequiredArea = 'Required_Area'
 rasterRequiredAreaPast = 'Required_Area_Past'
 featureExclusionArea = 'LoopExcluded_AgArea'
+rasterCountyZones = 'County_Ag_Zones'
+rasterPastureZones = 'County_Pasture_Zones'
 featureExclusionAreaCounties = 'LoopExcluded_AgArea_Counties'
 featureExclusionAreaCountiesDiss = 'LoopExcluded_AgArea_Counties_Diss'
 featureTempConfinedHerds = 'Confined_Herds'
@@ -126,10 +153,20 @@ featureTempConfinedFarms = 'ConfinedFarms'
 featurePointSourceFarms = 'PointSourceFarms'
 featureTempAllFertilzedCells = 'All_Fert_Cells'
 featureTempAllFertilzedCellsRect = 'All_Fert_Cells_Rect'
-featureTempCAFOFertilizedCells = 'All_Fert_Cells_with_CAFOs'
-featureTempCAFOFertilizedCellsNoPast = 'All_Fert_Cells_with_CAFOs_no_Past'
 tableManureClip = "S:\\Users\\roushjac\\Tipping Points\\Manure\\Script\\Python\\Outputs\\scratchGDB.gdb"
 pathCalcGDB = "S:\\Users\\roushjac\\Tipping Points\\Manure\\Script\\Python\\Outputs\\scratchGDB.gdb"
+pathPlacementScratch = 'S:\\Users\\roushjac\\Tipping Points\\Manure\\Script\\Python\\Outputs\\PlacementScratch' # Folder with a scratch folder for each placement worker
+pathRasterScratch = 'S:\\Users\\roushjac\\Tipping Points\\Manure\\Script\\Python\\Outputs\\RasterScratch' # Memory-mapped arrays evaluated with RasterAlgebra.py (ag masks, pasture zones)
+pathZoneCache = 'S:\\Users\\roushjac\\Tipping Points\\Manure\\Script\\Python\\Outputs\\ZoneCache' # County ID raster on the snap grid, only rebuilt when the counties change
+pathSparseRasters = 'S:\\Users\\roushjac\\Tipping Points\\Manure\\Script\\Python\\Outputs\\SparseRasters' # Layers that are almost all zero (unrecovered loads), stored as their non-zero cells
+pathAvailableMask = 'S:\\Users\\roushjac\\Tipping Points\\Manure\\Script\\Python\\Outputs\\SparseRasters\\Available_Area.npz' # Bit-packed cells confined manure can be spread on (see PackedMask.py)
+# Working rasters kept in compact form (see CompactRaster.py): masks as bits, focal sums as uint32 cell counts, rates as float32
+pathAgMaskBits = 'S:\\Users\\roushjac\\Tipping Points\\Manure\\Script\\Python\\Outputs\\RasterStore\\Ag_Mask_Rect.npy' # Fertilizable cells of the basin rectangle, saved so the stages after the ag mask don't need to rebuild it
+pathFocalCounts = 'S:\\Users\\roushjac\\Tipping Points\\Manure\\Script\\Python\\Outputs\\RasterStore\\FocalArea.npy' # Ag cells within paramFocalDist, FocalArea = count*cellSize^2
+pathFocalCountsPast = 'S:\\Users\\roushjac\\Tipping Points\\Manure\\Script\\Python\\Outputs\\RasterStore\\FocalAreaPast.npy'
+pathPastureNRates = 'S:\\Users\\roushjac\\Tipping Points\\Manure\\Script\\Python\\Outputs\\RasterStore\\RasterPastureNnoNull.npy'
+pathPasturePRates = 'S:\\Users\\roushjac\\Tipping Points\\Manure\\Script\\Python\\Outputs\\RasterStore\\RasterPasturePnoNull.npy'
+pathRunTrace = 'S:\\Users\\roushjac\\Tipping Points\\Manure\\Script\\Python\\Outputs\\RunTrace.jsonl' # Wall/CPU time and memory of stages, placement bins and convergence iterations, one JSON record per line (see RunTrace.py)
 tempCSVfile = 'S:\\Users\\roushjac\\Tipping Points\\Manure\\Script\\Python\\Outputs\\tempCSV.csv'
 CurrentBin = 'Current'
 fieldInitialRadius = 'RInit'
@@ -138,6 +175,7 @@ fieldNewRadius = 'RNew'
 featureWasteBuffers = 'Waste_Buff_New'
 featureWasteBuffersClip = 'Waste_Buff_Clip'
 featureWasteBuffersClipPast = 'Waste_Buff_Clip_Past'
+rasterPastureBufferCells = 'Pasture_Buffer_Cells'
 featureWasteBuffersPreDissolved = 'Waste_Buff_PreDiss'
 featureWasteBuffersDissolved = 'Waste_Buff_Diss'
 featureWasteBuffersClipArea = 'Waste_Buff_Clip_Area'
@@ -171,6 +209,8 @@ rasterPPastureRate = 'PPastureRate'
 rasterNPasture = 'NPasture'
 rasterPPasture = 'PPasture'
 pointSourceBinCounties = () # Making a tuple of all bin_cty values that we are treating as point sources due to lack of area
+currentStage = None # Set by ModelPipeline.py while a stage runs from RunManureModel.py, so the convergence loop can save its progress
+runTrace = RunTrace.RunTrace(pathRunTrace, paramTracePython) # runTrace.printSummary() gives the times so far when run by hand
 #-------------------------------------------------------------------------------
 #Set environment parameters
 #-------------------------------------------------------------------------------
@@ -194,25 +234,9 @@ arcpy.env.outputZFlag = "Disabled"
 arcpy.env.outputMFlag = "Disabled"
 
 #-------------------------------------------------------------------------------
-#Writing functions to be used as inputs to subprocess() for GME
-# Subprocess needs to be written into functions in order to successfully use threading - using these 
-def RunEnterKey():
-    subprocess.call(['python','PressEnterKeyboard.py'])
-    
-def RunGMEConf_NoExcl():
-    subprocess.Popen("C:\\Program Files (x86)\\SpatialEcology\\GME\\SEGME.exe -c run(in=\\\"S:\\Users\\roushjac\\Tipping Points\\Manure\\Script\\Python\\GMEAnimalWasteConfined_NoExclusion.txt\\\");").wait()
-#    subprocess.call(['python','RunGMEConfined_No_Exclusion.py']) #Old way of doing this where I call a different python script
-
-def RunGMEConf_Excl():
-    subprocess.Popen("C:\\Program Files (x86)\\SpatialEcology\\GME\\SEGME.exe -c run(in=\\\"S:\\Users\\roushjac\\Tipping Points\\Manure\\Script\\Python\\GMEAnimalWasteConfined.txt\\\");").wait()
-#    subprocess.call(['python','RunGMEConfined.py'])
-
-def RunGMEPast_NoExcl():
-    subprocess.Popen("C:\\Program Files (x86)\\SpatialEcology\\GME\\SEGME.exe -c run(in=\\\"S:\\Users\\roushjac\\Tipping Points\\Manure\\Script\\Python\\GMEAnimalWastePasture_NoExclusion.txt\\\");").wait()
-
-def RunGMEPast_Excl():
-    subprocess.Popen("C:\\Program Files (x86)\\SpatialEcology\\GME\\SEGME.exe -c run(in=\\\"S:\\Users\\roushjac\\Tipping Points\\Manure\\Script\\Python\\GMEAnimalWastePasture.txt\\\");").wait()
-
+#Functions used in the processing below
+# GME (SEGME.exe) and the PressEnterKeyboard.py thread that got it past its error window are no longer used - farms
+# are placed with FarmPlacement.py
 
 #def dissolveInSubprocess(in_fc, out_fc, dissolve_fields = '#', stat_fields = '#', multi_part = 'MULTI_PART', unsplit_lines = "DISSOLVE_LINES", xytol = '#'):
 #    """Execute dissolve tool in a subprocess"""
@@ -234,7 +258,14 @@ def dissolveInSubprocess():
 #    subprocess.Popen(cmd).wait()
     subprocess.call(['C:\Python27\ArcGIS10.2\python.exe','Dissolver_for_farms.py'])
 
-#%%
+def clipGroupsToMask(maskAvailable, storeFarms):
+    # Polygons of the available cells (Ag cells and CAFOs, no pasture buffers) inside each buffer group, dissolved by
+    # Near_FID with the group's area in F_AREA. Takes the place of buffering the farms and clipping the buffers by the
+    # available area polygons - do not want to spread confined farms in pasture buffers
+    cellGroups = maskAvailable.circleCells(storeFarms['SHAPE@X'], storeFarms['SHAPE@Y'], storeFarms[fieldInitialRadius], storeFarms[fieldFIDGroup])
+    groupPolygons(cellGroups, spatialRefGLB, featureWasteBuffersClip, fieldFIDGroup, fieldClipArea, featureWasteBuffersDissolved)
+
+#%% [stage: ag mask]
 
 #-------------------------------------------------------------------------------
 # Do the processing
@@ -248,64 +279,82 @@ arcpy.CopyFeatures_management(featureGolfCourses,featureTempGolfCourses)
 #arcpy.AddField_management(featureTempGolfCourses,fieldRaster)
 #arcpy.CalculateField_management(featureTempGolfCourses,fieldRaster,1,'PYTHON_9.3')
 
-# This chunk is replacing CalculateField
-arcpy.MakeTableView_management(featureTempGolfCourses, "GolfCourseTableView")
-arcpy.TableToTable_conversion("GolfCourseTableView", scratchFilePath, "GolfCourseTable")
-tempArray = arcpy.da.TableToNumPyArray(scratchFilePath+'\\GolfCourseTable', ['*'])
-dfGolfCourse = pd.DataFrame(tempArray)
-arcpy.Delete_management(scratchFilePath+'\\GolfCourseTable')
-del tempArray
-dfGolfCourse[fieldRaster] = 1 # This creates the field, then populates it - removes the need for AddField on the initial table
-dfGolfCourse.to_csv(tempCSVfile,index=False)
-arcpy.TableToTable_conversion(tempCSVfile,outDir,'tempGolfCourseTable')
-#arcpy.DeleteField_management(featureTempGolfCourses, ['raster']) # Getting rid of NA fields so that they may be added in the join
-arcpy.JoinField_management(featureTempGolfCourses,'OBJECTID','tempGolfCourseTable','OBJECTID', [fieldRaster])
-arcpy.Delete_management('tempGolfCourseTable')
+# This chunk is replacing CalculateField. The table is edited in memory (see AttributeStore.py) instead of
+# going through TableToTable -> NumPy -> CSV -> JoinField
+storeGolfCourse = AttributeStore.fromTable(featureTempGolfCourses, 'OBJECTID', ['OBJECTID'])
+storeGolfCourse[fieldRaster] = 1 # This creates the field, then populates it - removes the need for AddField on the initial table
+storeGolfCourse.toTable(featureTempGolfCourses, [fieldRaster])
+del storeGolfCourse
 
 arcpy.PolygonToRaster_conversion(featureTempGolfCourses,fieldRaster,rasterGolfCourses)
 
 #Next use NLCD and CDL to select Ag Cells
-inRasterCDLN = arcpy.Raster(rasterNFertilizerDemand)
-inRasterCDLP = arcpy.Raster(rasterPFertilizerDemand)
-inRasterNLCD = arcpy.Raster(rasterNLCD)
-inRasterGolf = arcpy.Raster(rasterGolfCourses)
-inRasterBasinRect = arcpy.Raster(rasterNLCDRect)
-conNLCD = arcpy.sa.Con((inRasterNLCD > 70) & (inRasterNLCD < 90),1,0)
-conNLCD1 = arcpy.sa.Con(arcpy.sa.IsNull(conNLCD),0,conNLCD)
+# The steps below only build an expression graph (see RasterAlgebra.py). Both masks are then evaluated together one
+# band of rows at a time, so the inputs are read once and none of the intermediate rasters are written out
+inRasterCDLN = RasterAlgebra.Raster(rasterNFertilizerDemand)
+inRasterCDLP = RasterAlgebra.Raster(rasterPFertilizerDemand)
+inRasterNLCD = RasterAlgebra.Raster(rasterNLCD)
+inRasterGolf = RasterAlgebra.Raster(rasterGolfCourses)
+inRasterBasinRect = RasterAlgebra.Raster(rasterNLCDRect)
+conNLCD = RasterAlgebra.Con((inRasterNLCD > 70) & (inRasterNLCD < 90),1,0)
+conNLCD1 = RasterAlgebra.Con(RasterAlgebra.IsNull(conNLCD),0,conNLCD)
 RectMinusBasin = (inRasterBasinRect - conNLCD1)
-conCDL_N = arcpy.sa.Con(inRasterCDLN==0,0,1)
-conCDL_N1 = arcpy.sa.Con(arcpy.sa.IsNull(conCDL_N),0,conCDL_N)
-conCDL_P = arcpy.sa.Con(inRasterCDLP==0,0,1)
-conCDL_P1 = arcpy.sa.Con(arcpy.sa.IsNull(conCDL_P),0,conCDL_P)
-nullGolf = arcpy.sa.IsNull(inRasterGolf)
-conGolf = arcpy.sa.Con(nullGolf,1,0)
+conCDL_N = RasterAlgebra.Con(inRasterCDLN==0,0,1)
+conCDL_N1 = RasterAlgebra.Con(RasterAlgebra.IsNull(conCDL_N),0,conCDL_N)
+conCDL_P = RasterAlgebra.Con(inRasterCDLP==0,0,1)
+conCDL_P1 = RasterAlgebra.Con(RasterAlgebra.IsNull(conCDL_P),0,conCDL_P)
+nullGolf = RasterAlgebra.IsNull(inRasterGolf)
+conGolf = RasterAlgebra.Con(nullGolf,1,0)
 # Making rectangle layer
 maskCDLRect = ((conCDL_N1+conCDL_P1)*conNLCD1*conGolf)+RectMinusBasin
-maskCDL2Rect = arcpy.sa.Con(maskCDLRect==0,0,1)
-maskCDL3Rect = arcpy.sa.SetNull(maskCDL2Rect==0,1)
-arcpy.RasterToPolygon_conversion(maskCDL3Rect, featureTempAllFertilzedCellsRect)
+maskCDL2Rect = RasterAlgebra.Con(maskCDLRect==0,0,1)
+maskCDL3Rect = RasterAlgebra.SetNull(maskCDL2Rect==0,1)
 # Now making basin-only layer
 maskCDLBasin = (conCDL_N1+conCDL_P1)*conNLCD1*conGolf
-maskCDL2Basin = arcpy.sa.Con(maskCDLBasin==0,0,1)
-maskCDL3Basin = arcpy.sa.SetNull(maskCDL2Basin==0,1)
-arcpy.RasterToPolygon_conversion(maskCDL3Basin, featureTempAllFertilzedCells)
-
+maskCDL2Basin = RasterAlgebra.Con(maskCDLBasin==0,0,1)
+maskCDL3Basin = RasterAlgebra.SetNull(maskCDL2Basin==0,1)
+gridNLCD = RasterGrid.fromRaster(rasterNLCD) # Same cells as the extent and snap raster set above
+masks = RasterAlgebra.evaluate([('AgMaskRect', maskCDL2Rect, np.uint8, 255), ('AgCellsRect', maskCDL3Rect, np.uint8, 0),
+                                ('AgCellsBasin', maskCDL3Basin, np.uint8, 0)], gridNLCD, workers=paramRasterWorkers, outFolder=pathRasterScratch)
+CompactRaster.saveMask(pathAgMaskBits, RasterAlgebra.Raster(masks['AgMaskRect'], 255), gridNLCD)
+inRasterAgCells = RasterAlgebra.toRaster(masks['AgCellsRect'], gridNLCD, 0, spatialRefGLB, rasterAgMaskRect+'_Cells')
+arcpy.RasterToPolygon_conversion(inRasterAgCells, featureTempAllFertilzedCellsRect)
+inRasterAgCells = RasterAlgebra.toRaster(masks['AgCellsBasin'], gridNLCD, 0, spatialRefGLB, rasterAgMaskRect+'_Cells_Basin')
+arcpy.RasterToPolygon_conversion(inRasterAgCells, featureTempAllFertilzedCells)
+del masks, inRasterAgCells
+arcpy.Delete_management(rasterAgMaskRect+'_Cells')
+arcpy.Delete_management(rasterAgMaskRect+'_Cells_Basin')
+
+#%% [stage: focal area]
 #Run Focal Stats on CDL
 # Since we are allowing buffers to spread further into the US than the basin,
 # FocalStatistics needs to be run on the total area we will be spreading manure
 # on. This is a different layer than the layer used to place down farms.
-start = time.ctime()
-startsec = time.time()
-neighborhood = arcpy.sa.NbrCircle(paramFocalDist,'CELL')
-FocalStats = arcpy.sa.FocalStatistics(maskCDL3Rect,neighborhood,'SUM','DATA')
+focalTimer = runTrace.start('focal sums')
+# FocalStatistics with a 667 cell circle was taking hours, so the focal sum is done in NumPy instead (see FocalSum.py).
+# Gives the same cell counts as FocalStatistics with 'DATA' on maskCDL3Rect, which is the 1 cells of the saved ag mask.
+#neighborhood = arcpy.sa.NbrCircle(paramFocalDist,'CELL')
+#FocalStats = arcpy.sa.FocalStatistics(maskCDL3Rect,neighborhood,'SUM','DATA')
+# The ag mask is read straight from its packed bits, and the sums are kept as uint32 cell counts with the cell area
+# as their scale (see CompactRaster.py) instead of a float FocalArea raster
+maskAgRect = CompactRaster.load(pathAgMaskBits)
 #Calculate Neighborhood Fertilizer Area Raster
-FocalArea = FocalStats*cellSize**2
-FocalArea.save(rasterFocalArea)
-end = time.ctime()
-endsec = time.time()
-print 'Start: '+start
-print 'End: '+end
-print 'FocalStats took '+str((endsec - startsec)/60)+' minutes!'
+# The radii of a focal distance sweep are summed in the same pass over the mask (see FocalSum.focalSumsTiled)
+focalRadii = [paramFocalDist] + [radius for radius in paramFocalDistSweep if radius != paramFocalDist]
+focalPaths = [pathFocalCounts] + [os.path.splitext(pathFocalCounts)[0]+'_'+str(radius)+'.npy' for radius in focalRadii[1:]]
+focalCounts = [CompactRaster.createCounts(path, maskAgRect.grid, cellSize**2) for path in focalPaths] # Max is ~1.4 million cells, fits in uint32
+FocalSum.focalSumsTiled(maskAgRect, focalRadii, out=focalCounts)
+# 'DATA' on maskCDL3Rect: NoData where there are no ag cells in the circle
+for counts in focalCounts:
+    for row0 in range(0, counts.shape[0], 1024):
+        focalBand = counts[row0:row0+1024]
+        focalBand[focalBand == 0] = CompactRaster.noDataCount
+    counts.flush()
+del maskAgRect, focalCounts, focalBand, counts
+timing = focalTimer.stop(radii=len(focalRadii))
+print 'Start: '+time.ctime(timing['started'])
+print 'End: '+time.ctime()
+print 'FocalStats took '+str(timing['wall']/60)+' minutes!'
 
 # Clipping focal stats raster to only be in the basin
 
@@ -313,6 +362,7 @@ print 'FocalStats took '+str((endsec - startsec)/60)+' minutes!'
 #Housekeeping!!
 arcpy.Delete_management(featureTempGolfCourses,rasterGolfCourses)
 
+#%% [stage: county rates]
 #Associate Manure Totals/Area with Counties
 arcpy.CopyFeatures_management(featureCounties,featureTempCountyManure)
 arcpy.JoinField_management(featureTempCountyManure, fieldCountyJoin, tableManureArea, fieldCountyJoin, ['Man_m2'])
@@ -323,21 +373,15 @@ arcpy.JoinField_management(featureTempCountyManure, fieldCountyJoin, tableManure
 #arcpy.CalculateField_management(featureTempCountyManure,fieldAvgRate,'!'+fieldManureCtyP+'!/!'+fieldManureAreaTotal+'!','PYTHON_9.3')
 
 ## For rates that are above 
-arcpy.MakeTableView_management(featureTempCountyManure, "CountyManureTableView")
-arcpy.TableToTable_conversion("CountyManureTableView", scratchFilePath, "CountyManureTable")
-tempArray = arcpy.da.TableToNumPyArray(scratchFilePath+'\\CountyManureTable', ['*'])
-dfCountyManure = pd.DataFrame(tempArray)
-arcpy.Delete_management(scratchFilePath+'\\CountyManureTable')
-del tempArray
-dfCountyManure[fieldAvgRate] =  dfCountyManure['kgP_year'] / dfCountyManure['Man_m2'] # This creates the field, then populates it - removes the need for AddField on the initial table
-dfCountyManure['AvgRHect'] = dfCountyManure['AvgR']*10000
-dfCountyManure['AvgRfromN'] = dfCountyManure['kgN_year'] / dfCountyManure['Man_m2']
-dfCountyManure.loc[dfCountyManure['AvgR'] > dfCountyManure.quantile(.9, axis = 0)['AvgR'], 'AvgR'] = dfCountyManure.quantile(.9, axis = 0)['AvgR']
-dfCountyManure.to_csv(tempCSVfile,index=False)
-arcpy.TableToTable_conversion(tempCSVfile,outDir,'tempManureCountyTable')
-arcpy.JoinField_management(featureTempCountyManure,fieldCountyJoin,'tempManureCountyTable',fieldCountyJoin, ['AvgR'])
-arcpy.Delete_management('tempManureCountyTable')
-arcpy.Delete_management(tempCSVfile) # Also deleting csv file - want to reuse the same filename for simplicity
+storeCountyManure = AttributeStore.fromTable(featureTempCountyManure, fieldCountyJoin)
+storeCountyManure[fieldAvgRate] = storeCountyManure['kgP_year'] / storeCountyManure['Man_m2'] # This creates the field, then populates it - removes the need for AddField on the initial table
+storeCountyManure['AvgRHect'] = storeCountyManure[fieldAvgRate]*10000
+storeCountyManure['AvgRfromN'] = storeCountyManure['kgN_year'] / storeCountyManure['Man_m2']
+# Capping rates at the paramAvgRCapPercentile (90th) percentile. nanpercentile skips Nulls the same way pandas quantile did
+AvgRCap = np.nanpercentile(storeCountyManure[fieldAvgRate], paramAvgRCapPercentile)
+storeCountyManure.update(fieldAvgRate, AvgRCap, storeCountyManure[fieldAvgRate] > AvgRCap)
+storeCountyManure.toTable(featureTempCountyManure, [fieldAvgRate])
+dfCountyManure = storeCountyManure.toDataFrame() # Still used for the histogram below
 
 #%% Plotting histogram of AvgR values in hectares to visualize if county loads are reasonable
 dfCountyManure['AvgRHect'] = dfCountyManure['AvgR']*10000
@@ -367,7 +411,7 @@ arcpy.CopyFeatures_management(featureTempCountyManure,featureTempCountyManureCli
 # Making a "clean" version of the manure clipped counties for easy resetting after each iteration of the loop
 arcpy.CopyFeatures_management(featureTempCountyManureClip,featureTempCountyManureClip+'clean')
 
-#%%
+#%% [stage: confined placement]
 ###Make CAFO Locations part of Ag Area
 # First converting lat/long coordinates from CAFO table into a new point layer
 ## as of 9/13/17, the MakeXYEventLayer function in arcpy does not seem to be working with Arc version 10.2.2.
@@ -384,9 +428,8 @@ arcpy.CopyFeatures_management(featureTempCountyManureClip,featureTempCountyManur
 # Creating copy of CAFO layer and converting into a feature layer in case I need to reset it
 
 
-# Creating layer of Ag cells in basin rectangle
-arcpy.Buffer_analysis(featureBasinCAFOs, featureCAFOLocationPolys,10,'','ROUND','NONE')
-arcpy.Merge_management([featureTempAllFertilzedCellsRect,featureCAFOLocationPolys],featureTempCAFOFertilizedCells)
+# The Ag cells in the basin rectangle with the CAFO locations added are kept as a bit mask, made at the end of the
+# pasture placement stage once the pasture buffers are known
 
 
 
@@ -399,110 +442,56 @@ for row in rows:
 
 #%%
 #loop Through Each Bin type and distribute to available cells based on availability of Ag Cells near by.
-#This loop opens up GME five times per iteration. It also uses a workaround to get around a pesky error window opening with GME.
-#Make sure that you have the correct version of Arc installed to run GME;as of 7/3/2017, GME cannot run on versions of Arc past 10.3.
-start = time.ctime()
-startsec = time.time()
+# Farms are placed with FarmPlacement.py instead of GME, which had to be opened five times per bin on 45 county
+# slices. The Ag cells of every county and their focal area are read once from rasters, so each bin only needs its
+# rows of the farm counts table. Bins don't depend on each other, so they are placed across paramPlacementWorkers
+# processes (see BinPlacement.py). Every bin has its own random stream, so the farms don't depend on the number of workers.
+placementTimer = runTrace.start('confined placement')
+arcpy.PolygonToRaster_conversion(featureTempCountyManureClip,fieldCountyJoin,rasterCountyZones,'CELL_CENTER','',cellSize)
+zonesConfined = FarmPlacement.PlacementZones.fromRasters(rasterCountyZones, CompactRaster.load(pathFocalCounts))
+storeCounties = AttributeStore.fromTable(featureTempCountyManureClip, fieldCountyJoin, [fieldAvgRate])
+storeBins = dict()
+tasksConfined = list()
 for binID in range(1,int(binIDmax+1)):
-    startlooptime = time.time()
-    arcpy.MakeTableView_management(tableFarmCountsCon,CurrentBin,fieldAnimalBin+'='+str(binID))
-    time.sleep(2)
-    arcpy.JoinField_management(featureTempCountyManureClip,fieldCountyJoin,CurrentBin,fieldCountyJoin)
-    # Removing Null rows
-    up_curs = arcpy.UpdateCursor(featureTempCountyManureClip, "BIN_CTY IS NULL")
-    for row in up_curs:
-        if not row.getValue('BIN_CTY'):
-            up_curs.deleteRow(row)
-
-    del up_curs
-    arcpy.MakeTableView_management(featureTempCountyManureClip, "ManureClipTableView")
-    arcpy.TableToTable_conversion("ManureClipTableView", tableManureClip, "ManureClipTable")
-    tempArray = arcpy.da.TableToNumPyArray(tableManureClip+'/ManureClipTable', ['*'])
-    dfManureClip = pd.DataFrame(tempArray)
-    arcpy.Delete_management(tableManureClip+'/ManureClipTable')
-    del tempArray
-    dfManureClip['RInit'] = (pd.to_numeric(dfManureClip['kgP_farm_y']) / (dfManureClip['AvgR'] * (22/7)))**0.5
-    dfManureClip['Req_Area'] = (22/7) * dfManureClip['RInit'] * dfManureClip['RInit']
-    dfManureClip.to_csv(tempCSVfile,index=False)
-    arcpy.TableToTable_conversion(tempCSVfile,outDir,'tempManureClipTable')
-    arcpy.DeleteField_management(featureTempCountyManureClip, ['RInit','Req_Area']) # Getting rid of NA Radius and Area fields, so that they may be added in the join
-    arcpy.JoinField_management(featureTempCountyManureClip,fieldCountyJoin,'tempManureClipTable',fieldCountyJoin, ['RInit', 'Req_Area'])
-    arcpy.Delete_management('tempManureClipTable') # Deleting temporary table
-    arcpy.Delete_management(tempCSVfile) # Also deleting csv file - want to reuse the same filename for simplicity
-    arcpy.PolygonToRaster_conversion(featureTempCountyManureClip,fieldAreaRequired,rasterRequiredArea)
-    inRasterRequiredArea = arcpy.Raster(rasterRequiredArea)
-    inRasterFocalArea = arcpy.Raster(rasterFocalArea)
-    conRequiredArea = arcpy.sa.Con((inRasterRequiredArea>inRasterFocalArea),1,0)
-    ExclusionResult = arcpy.GetRasterProperties_management(conRequiredArea,'MAXIMUM') # Gives memory errors if scratch workspace is not cleared frequently
-    ExclusionResultMax = ExclusionResult.getOutput(0)
-    if int(ExclusionResultMax) == 0:
-        for fifthmult in range(0,5): # Choosing 1 to 5 because we are splitting up GME into 5 parts. Has 225 counties - 45 counties each part
-            mult = 45*fifthmult
-#            arcpy.SelectLayerByAttribute_management('Near_Buffers','NEW_SELECTION',' "NEAR_DIST" = 0')
-            arcpy.MakeFeatureLayer_management(featureTempCountyManureClip,'CtyManClipOneFifth')
-            arcpy.SelectLayerByAttribute_management('CtyManClipOneFifth', 'NEW_SELECTION', ' "OBJECTID" >= '+str(1+mult)+' AND "OBJECTID" <= '+str(45+mult))
-            arcpy.CopyFeatures_management('CtyManClipOneFifth', 'CtyManClipOneFifthGME')
-            # Error window popping up in GME is preventing loop from continuing. Can't figure out how to stop it,
-            # so using this unnecessarily convoluted method to get around it.
-            # Using threading to start GME, then run a separate Python script that presses the "enter" key after 5 seconds
-            os.chdir("S:\\Users\\roushjac\\Tipping Points\\Manure\\Script\\Python")
-            thread1 = threading.Thread(target=RunGMEConf_NoExcl)
-            thread2 = threading.Thread(target=RunEnterKey)
-            thread1.start()
-            thread2.start()
-            thread1.join() # Stops python until thread closes, signaling the finish of GME
-    else:
-        nullRequiredArea = arcpy.sa.SetNull(conRequiredArea==0,1)
-        arcpy.RasterToPolygon_conversion(nullRequiredArea,featureExclusionArea) #This resets the python working directory!!! Need to reassign it
-        os.chdir("S:\\Users\\roushjac\\Tipping Points\\Manure\\Script\\Python")
-        # Some counties do not have any usable Ag cells after looking at excluded area - for these counties, ignore exclusion area
-        # and place farms down anyway. These farms need to be treated as point sources!
-        arcpy.SpatialJoin_analysis(featureExclusionArea, featureCounties, featureExclusionAreaCounties,'JOIN_ONE_TO_MANY','','','INTERSECT')
-        arcpy.Dissolve_management(featureExclusionAreaCounties, featureExclusionAreaCountiesDiss, fieldCountyJoin,'','MULTI_PART')
-#        arcpy.JoinField_management(featureExclusionAreaCountiesDiss, fieldCountyJoin, featureTempCountyManureClip, fieldCountyJoin, ['Req_Area'])
-        arcpy.RasterToPolygon_conversion(conRequiredArea, 'RequiredAreaPolygon', 'SIMPLIFY','Value')
-        arcpy.SpatialJoin_analysis('RequiredAreaPolygon', featureCounties, 'RequiredAreaPolygonCounties','JOIN_ONE_TO_MANY','','','INTERSECT')
-        arcpy.Dissolve_management('RequiredAreaPolygonCounties', 'RequiredAreaPolygonCounties_Diss', fieldCountyJoin,'gridcode MIN','MULTI_PART') 
-        # Dissolves counties together, but also finds the minimum 'gridcode' value for the county. A min of 1 means that every available Ag cell in the county is excluded.
-#        arcpy.Statistics_analysis('RequiredAreaPolygonCounties_Diss', 'tableRequiredArea_Stats', ['value', 'MIN'], [fieldCountyJoin])
-        arcpy.JoinField_management(featureExclusionAreaCountiesDiss, fieldCountyJoin, 'RequiredAreaPolygonCounties_Diss', fieldCountyJoin)
-        up_curs = arcpy.UpdateCursor(featureExclusionAreaCountiesDiss, "MIN_gridcode = 1")
-        for row in up_curs:
-            if int(row.getValue('MIN_gridcode')) == 1:
-                pointSourceBinCounties = (str(binID)+str(row.getValue(fieldCountyJoin)),)+pointSourceBinCounties
-                up_curs.deleteRow(row)
-
-        del up_curs
-        arcpy.CopyFeatures_management(featureExclusionAreaCountiesDiss, featureExclusionArea)
-        for fifthmult in range(0,5): # Choosing 1 to 5 because we are splitting up GME into 5 parts. Has 225 counties - 45 counties each part
-            mult = 45*fifthmult
-#           arcpy.SelectLayerByAttribute_management('Near_Buffers','NEW_SELECTION',' "NEAR_DIST" = 0')
-            arcpy.MakeFeatureLayer_management(featureTempCountyManureClip,'CtyManClipOneFifth')
-            arcpy.SelectLayerByAttribute_management('CtyManClipOneFifth', 'NEW_SELECTION', ' "OBJECTID" >= '+str(1+mult)+' AND "OBJECTID" <= '+str(45+mult))
-            arcpy.CopyFeatures_management('CtyManClipOneFifth', 'CtyManClipOneFifthGME')
-            os.chdir("S:\\Users\\roushjac\\Tipping Points\\Manure\\Script\\Python")
-            thread1 = threading.Thread(target=RunGMEConf_Excl)
-            thread2 = threading.Thread(target=RunEnterKey)
-            thread1.start()
-            thread2.start()
-            thread1.join() # Stops python until thread closes, signaling the finish of GME
-        del(nullRequiredArea)
-        arcpy.Delete_management(featureExclusionArea)
-        arcpy.Delete_management(featureExclusionAreaCounties)
-        arcpy.Delete_management(featureExclusionAreaCountiesDiss)
-        
-    print 'The bin is:',binID
-    endlooptime = time.time()
-    print 'This loop took '+str(endlooptime - startlooptime)+' seconds, '+str((endlooptime - startlooptime)/60.)+' minutes, or '+str((endlooptime - startlooptime)/3600.)+' hours.'
-    arcpy.CopyFeatures_management(featureTempCountyManureClip+'clean',featureTempCountyManureClip)
-    del(inRasterRequiredArea, inRasterFocalArea, conRequiredArea)
-
-end = time.ctime()
-endsec = time.time()
+    storeBin = AttributeStore.fromTable(tableFarmCountsCon, fieldLoadID, [fieldCountyJoin, fieldOperations, fieldPLoad], fieldAnimalBin+'='+str(binID))
+    storeBin.join(storeCounties, [fieldAvgRate], fieldCountyJoin)
+    storeBin[fieldInitialRadius] = (pd.to_numeric(storeBin[fieldPLoad]) / (storeBin[fieldAvgRate] * (22/7)))**0.5
+    storeBin[fieldAreaRequired] = (22/7) * storeBin[fieldInitialRadius] * storeBin[fieldInitialRadius]
+    # Farms can't go on cells where Req_Area > FocalArea
+    tasksConfined.append((binID, storeBin[fieldCountyJoin], storeBin[fieldOperations], storeBin[fieldAreaRequired]))
+    storeBins[binID] = storeBin
+# Some counties do not have any usable Ag cells after looking at the excluded area - for these counties, the exclusion
+# is ignored and farms are placed anyway. These farms need to be treated as point sources! Every bin and county is
+# checked in one call, from the county's Ag cells sorted by FocalArea (see PlacementZones.exclusion)
+taskBins = np.concatenate([np.repeat(binID, len(zoneIDs)) for binID, zoneIDs, counts, requiredArea in tasksConfined])
+taskCounties = np.concatenate([zoneIDs for binID, zoneIDs, counts, requiredArea in tasksConfined])
+taskOperations = np.concatenate([np.asarray(counts, dtype=np.float64) for binID, zoneIDs, counts, requiredArea in tasksConfined])
+excludedFraction, fullyExcluded = zonesConfined.exclusion(taskCounties, np.concatenate([requiredArea for binID, zoneIDs, counts, requiredArea in tasksConfined]))
+fullyExcluded = fullyExcluded & (np.nan_to_num(taskOperations).round() > 0)
+for binID, county in zip(taskBins[fullyExcluded], taskCounties[fullyExcluded]):
+    pointSourceBinCounties = (str(binID)+str(county),)+pointSourceBinCounties
+print 'Mean fraction of county Ag cells excluded:', np.nanmean(excludedFraction), ', bin/counties with every cell excluded:', int(fullyExcluded.sum())
+del taskBins, taskCounties, taskOperations, excludedFraction, fullyExcluded
+placedBins = BinPlacement.placeBins(zonesConfined, tasksConfined, paramPlacementSeed, 0, paramPlacementWorkers, os.path.join(pathPlacementScratch, 'Confined'), trace=runTrace)
+
+# Merging the bins in order and writing them to Confined_Herds at once, with the same BIN_CTY and PNTID fields GME made
+placedConfined = list()
+placedBinCty = list()
+for binID in range(1,int(binIDmax+1)):
+    placed = placedBins[binID]
+    placedConfined.append(placed)
+    placedBinCty.append(storeBins[binID][fieldLoadID])
+    print 'The bin is:',binID,', farms placed:',len(placed)
+placedConfined = FarmPlacement.concatenate(placedConfined)
+FarmPlacement.writePoints(featureTempConfinedHerds, spatialRefGLB, placedConfined.x, placedConfined.y,
+                          [(fieldLoadID, np.concatenate(placedBinCty)[placedConfined.request]), ('PNTID', placedConfined.pointIDs())])
+del zonesConfined, storeCounties, storeBins, tasksConfined, placedBins, placedConfined, placedBinCty
+
+timing = placementTimer.stop(bins=int(binIDmax))
 pointSourceBinCountiesFinal = pointSourceBinCounties
-print 'Start: '+start
-print 'End: '+end
-print 'Total time was '+str(endsec - startsec)+' seconds, '+str((endsec - startsec)/60)+' minutes, or '+str((endsec - startsec)/3600)+' hours!'
+print 'Start: '+time.ctime(timing['started'])
+print 'End: '+time.ctime()
+print 'Total time was '+str(timing['wall'])+' seconds, '+str(timing['wall']/60)+' minutes, or '+str(timing['wall']/3600)+' hours!'
 
 #%% Deleting extra points that were generated as a result of using 'operations' instead of 'corrected operations'
 #arcpy.MakeFeatureLayer_management(featureTempConfinedHerds, 'testConfinedHerds')
@@ -523,8 +512,17 @@ print 'Total time was '+str(endsec - startsec)+' seconds, '+str((endsec - starts
 # Housekeeping
 arcpy.DeleteField_management(featureTempConfinedHerds,['PNTID'])
 
-# Join randomly placed farms to counties, with rate info
-arcpy.SpatialJoin_analysis(featureTempConfinedHerds,featureTempCountyManureArea,featureTempConfinedFarms,'JOIN_ONE_TO_MANY','','','INTERSECT')
+# Join randomly placed farms to counties, with rate info. Each farm's county comes from the cached county raster
+# (see ZonalStats.pointZones) instead of SpatialJoin; only farms in cells on a county line get a polygon test.
+# Farms are placed anywhere in their cell, so one in a shoreline or basin edge cell can be just outside every
+# polygon; it keeps its cell's county. Only farms in cells outside every county get CtyID 0 and a Null AvgR
+arcpy.CopyFeatures_management(featureTempConfinedHerds,featureTempConfinedFarms)
+zonesCounty = ZonalStats.ZoneRaster.fromFeatures(featureCounties, fieldCountyJoin, RasterGrid.fromRaster(rasterNLCD), pathZoneCache)
+storeFarms = AttributeStore.fromTable(featureTempConfinedFarms, 'OBJECTID', ['SHAPE@X', 'SHAPE@Y'])
+storeFarms[fieldCountyJoin] = zonesCounty.pointZones(storeFarms['SHAPE@X'], storeFarms['SHAPE@Y'], featureCounties)
+storeFarms.join(AttributeStore.fromTable(featureTempCountyManureArea, fieldCountyJoin, [fieldAvgRate]), [fieldAvgRate], fieldCountyJoin)
+storeFarms.toTable(featureTempConfinedFarms, [fieldCountyJoin, fieldAvgRate])
+del zonesCounty, storeFarms
 
 #Join Loading Rates to Points based on bin/animal type and county. These fields have rates in kg/farm/year
 arcpy.JoinField_management(featureTempConfinedFarms,fieldLoadID,tableFarmCountsCon,fieldLoadID,['kgP_y_rec','kgN_y_rec','kgP_y_urec','kgN_y_urec','kgP_farm_y','kgN_farm_y'] )
@@ -555,22 +553,12 @@ for row in up_curs:
 del up_curs
 
 #Add Initial Radius Guess; minimum=cell size
-arcpy.MakeTableView_management(featureTempConfinedFarms, "ManureClipTableView")
-arcpy.TableToTable_conversion("ManureClipTableView", tableManureClip, "ManureClipTable")
-tempArray = arcpy.da.TableToNumPyArray(tableManureClip+'\ManureClipTable', ['OBJECTID','kgP_farm_y','AvgR'])
-dfManureClip = pd.DataFrame(tempArray)
-arcpy.Delete_management(tableManureClip+'/ManureClipTable')
-del tempArray
-dfManureClip['RInit'] = (pd.to_numeric(dfManureClip['kgP_farm_y']) / (dfManureClip['AvgR'] * (22/7)))**0.5
-dfManureClip['Req_Area'] = (22/7) * dfManureClip['RInit'] * dfManureClip['RInit']
-dfManureClip.to_csv(tempCSVfile,index=False)
-arcpy.TableToTable_conversion(tempCSVfile,outDir,'tempManureClipTable')
-# Getting rid of NA Radius and Area fields, so that they may be added in the join
-# Also getting rid of kg/farm rates so that they can be joined back as numeric fields
-arcpy.DeleteField_management(featureTempConfinedFarms, ['RInit','Req_Area'])
-arcpy.JoinField_management(featureTempConfinedFarms,'OBJECTID','tempManureClipTable','OBJECTID', ['RInit', 'Req_Area'])
-arcpy.Delete_management('tempManureClipTable') # Deleting temporary table
-arcpy.Delete_management(tempCSVfile) # Also deleting csv file - want to reuse the same filename for simplicity
+storeManureClip = AttributeStore.fromTable(featureTempConfinedFarms, 'OBJECTID', [fieldPLoad, fieldAvgRate])
+storeManureClip[fieldInitialRadius] = (pd.to_numeric(storeManureClip[fieldPLoad]) / (storeManureClip[fieldAvgRate] * (22/7)))**0.5
+storeManureClip[fieldAreaRequired] = (22/7) * storeManureClip[fieldInitialRadius] * storeManureClip[fieldInitialRadius]
+# toTable adds the RInit and Req_Area fields if they are missing and overwrites them otherwise
+storeManureClip.toTable(featureTempConfinedFarms, [fieldInitialRadius, fieldAreaRequired])
+del storeManureClip
 
 #arcpy.AddField_management(featureTempConfinedFarms,fieldInitialRadius,'FLOAT')
 #arcpy.AddField_management(featureTempConfinedFarms,fieldAreaRequired,'FLOAT')
@@ -578,7 +566,9 @@ arcpy.Delete_management(tempCSVfile) # Also deleting csv file - want to reuse th
 #arcpy.CalculateField_management(featureTempConfinedFarms,fieldAreaRequired,'!'+fieldInitialRadius+'!*!'+fieldInitialRadius+'!*(22/7)','PYTHON_9.3')
 arcpy.AddField_management(featureTempConfinedFarms,fieldNewRadius,'FLOAT') # Keep this field because it is calculated from UpdateCursor, not a pandas dataframe
 #arcpy.AddField_management(featureTempConfinedFarms,fieldAreaDiff,'FLOAT')
-arcpy.DeleteField_management(featureTempConfinedFarms,['Join_Count','STATEFP','COUNTYFP','COUNTYNS','NAME','NAMELSAD','LSAD','CLASSFP','MTFCC','CSAFP','CBSAFP','METDIVFP','FUNCSTAT','ALAND','AWATER','INTPTLAT','INTPTLON','F1','Census_Spe','CAFO_Speci','Bin','State','County','Physical_L','Zipcode','City','Operation','Latitude','Longitude','Animal_Num','OcFraction','AvgOfN__as','AvgOfP__as','Recoverabi'])
+# The county fields SpatialJoin used to add are no longer there, so only the fields that exist are deleted
+fieldsConfinedFarms = [f.name for f in arcpy.ListFields(featureTempConfinedFarms)]
+arcpy.DeleteField_management(featureTempConfinedFarms,[f for f in ['Join_Count','STATEFP','COUNTYFP','COUNTYNS','NAME','NAMELSAD','LSAD','CLASSFP','MTFCC','CSAFP','CBSAFP','METDIVFP','FUNCSTAT','ALAND','AWATER','INTPTLAT','INTPTLON','F1','Census_Spe','CAFO_Speci','Bin','State','County','Physical_L','Zipcode','City','Operation','Latitude','Longitude','Animal_Num','OcFraction','AvgOfN__as','AvgOfP__as','Recoverabi'] if f in fieldsConfinedFarms])
 arcpy.CopyFeatures_management(featureTempConfinedFarms, featureTempConfinedFarms+'clean')
 
 # Removing farms that were placed in areas that should have been excluded from GME, and treating their loads as point sources
@@ -615,39 +605,50 @@ arcpy.CopyFeatures_management(featureTempConfinedFarms, featureTempConfinedFarms
 #
 #
 
+#%% [stage: pasture placement]
 ## Need to create pasture buffers in order to mask out confined buffers
+inRasterNLCD = arcpy.Raster(rasterNLCD)
 maskNLCD = arcpy.sa.Con(inRasterNLCD == 81,1,0)
 
 maskNLCDCAFO = arcpy.sa.Con(maskNLCD==1,1,0)
 maskNLCDCAFO2 = arcpy.sa.SetNull(maskNLCDCAFO==0,1)
 #Run Focal Stats on Pasture Land
-neighborhood = arcpy.sa.NbrCircle(paramFocalDistPasture,'CELL')
-FocalStatsPast = arcpy.sa.FocalStatistics(maskNLCDCAFO,neighborhood,'SUM','NODATA')
-#Calculate Neighborhood Fertilizer Area Raster
-FocalAreaPast = FocalStatsPast*cellSize**2
-FocalAreaPast.save(rasterFocalAreaPast)
+# The pasture cells and the NLCD NoData cells are packed into bit masks and summed in NumPy (see FocalSum.py), giving
+# the same counts as FocalStatistics(maskNLCDCAFO, NbrCircle(paramFocalDistPasture,'CELL'), 'SUM', 'NODATA'). The sums
+# are kept as uint32 cell counts with the cell area as their scale (see CompactRaster.py)
+gridNLCD = RasterGrid.fromRaster(rasterNLCD)
+inRasterNLCDBands = RasterAlgebra.Raster(rasterNLCD)
+maskPasture = PackedMask.fromExpr(inRasterNLCDBands == 81, gridNLCD)
+maskNLCDNoData = PackedMask.fromExpr(RasterAlgebra.IsNull(inRasterNLCDBands), gridNLCD)
+# The radii of a focal distance sweep are summed in the same pass (see FocalSum.focalSumsTiled)
+focalRadiiPast = [paramFocalDistPasture] + [radius for radius in paramFocalDistPastureSweep if radius != paramFocalDistPasture]
+focalPathsPast = [pathFocalCountsPast] + [os.path.splitext(pathFocalCountsPast)[0]+'_'+str(radius)+'.npy' for radius in focalRadiiPast[1:]]
+focalCountsPast = [CompactRaster.createCounts(path, gridNLCD, cellSize**2) for path in focalPathsPast]
+FocalSum.focalSumsTiled(maskPasture, focalRadiiPast, out=focalCountsPast)
+if maskNLCDNoData.count() > 0:
+    # 'NODATA': NoData wherever the circle has an NLCD NoData cell
+    nearNoData = FocalSum.focalSumsTiled(maskNLCDNoData, focalRadiiPast,
+                                         out=[np.lib.format.open_memmap(os.path.join(pathRasterScratch, 'NearNoDataPast_'+str(radius)+'.npy'), 'w+', np.uint32, gridNLCD.shape)
+                                              for radius in focalRadiiPast])
+    for counts, near in zip(focalCountsPast, nearNoData):
+        for row0 in range(0, gridNLCD.nRows, 1024):
+            focalBand = counts[row0:row0+1024]
+            focalBand[near[row0:row0+1024] > 0] = CompactRaster.noDataCount
+    del nearNoData, near, focalBand
+for counts in focalCountsPast:
+    counts.flush()
+del inRasterNLCDBands, maskPasture, maskNLCDNoData, focalCountsPast, counts
 
 arcpy.RasterToPolygon_conversion(maskNLCDCAFO2,featureNLCDPasture)
 arcpy.Clip_analysis(featureNLCDPasture,featureTempAllFertilzedCellsRect,featurePastureCells)
-arcpy.SpatialJoin_analysis(featurePastureCells,featureCounties,featurePastureCounties)
-arcpy.Dissolve_management(featurePastureCounties,featurePastureGME,fieldCountyJoin,'','MULTI_PART')
-arcpy.Copy_management(featurePastureGME,featurePastureGME+'clean')
 
 # Converting the 'Operations' field in the pasture farms table to data type 'long' instead of 'string'
-arcpy.TableToTable_conversion(tableFarmCountsPast, pathCalcGDB, "calcfieldTable")
-tempArray = arcpy.da.TableToNumPyArray(pathCalcGDB+'/calcfieldTable', [fieldLoadID, 'Operations'])
-dfCalcField = pd.DataFrame(tempArray)
-arcpy.Delete_management(pathCalcGDB+'/calcfieldTable')
-del tempArray
-# Input fields to calculate and formula to calculate them
-dfCalcField['Operations'] = pd.to_numeric(dfCalcField['Operations'], errors='coerce')
-dfCalcField.to_csv(tempCSVfile,index=False)
-arcpy.TableToTable_conversion(tempCSVfile,outDir,'tempcalcfieldTable2')
-# Input original table to be joined back to
+storeCalcField = AttributeStore.fromTable(tableFarmCountsPast, fieldLoadID, ['Operations'])
+storeCalcField['Operations'] = pd.to_numeric(storeCalcField['Operations'], errors='coerce')
+# Deleting the text field so that it is added back as a numeric field
 arcpy.DeleteField_management(tableFarmCountsPast, ['Operations'])
-arcpy.JoinField_management(tableFarmCountsPast,fieldLoadID,'tempcalcfieldTable2',fieldLoadID, ['Operations']) # Need to make sure correct fields are being joined!
-arcpy.Delete_management('tempcalcfieldTable2') # Deleting temporary table
-arcpy.Delete_management(tempCSVfile) # Also deleting csv file - want to reuse the same filename for simplicity
+storeCalcField.toTable(tableFarmCountsPast, ['Operations'])
+del storeCalcField
 
 #Determine Total Number of Bins
 arcpy.Statistics_analysis(tableFarmCountsPast,'tableBinMax',[[fieldAnimalBin,'MAX'],['Operations','SUM']]) # Need to convert operations to long instead of string
@@ -657,173 +658,79 @@ for row in rows:
     TotalEstAnimals=row.getValue('SUM_Operations')
 
 #loop Through Each Bin type and distribute to available cells based on availability of Ag Cells near by.
-#This loop opens up GME once per iteration. Make sure that you have the correct version of Arc installed to run GME;
-#as of 7/3/2017, GME cannot run on versions of Arc past 10.3.
-start = time.ctime()
-startsec = time.time()
+# Farms are placed with FarmPlacement.py instead of GME, the same way as the confined farms
+placementTimer = runTrace.start('pasture placement')
+# Every pasture cell gets its county from the cached county raster (see ZonalStats.py) instead of SpatialJoin,
+# Dissolve and PolygonToRaster of the pasture polygons. A pasture polygon crossing a county line used to go to one
+# county; now each cell goes to the county it is in
+zonesCounty = ZonalStats.ZoneRaster.fromFeatures(featureCounties, fieldCountyJoin, gridNLCD, pathZoneCache)
+inRasterPastureCells = (RasterAlgebra.Raster(rasterNLCD) == 81) & CompactRaster.load(pathAgMaskBits)
+pastureArrays = RasterAlgebra.evaluate([('PastureZones', RasterAlgebra.Con(inRasterPastureCells, RasterAlgebra.Raster(zonesCounty.zones), 0), np.int32, 0),
+                                        ('FocalAreaPast', CompactRaster.load(pathFocalCountsPast), np.float32, -1)],
+                                       gridNLCD, workers=paramRasterWorkers, outFolder=pathRasterScratch)
+zonesPasture = FarmPlacement.PlacementZones.fromArrays(pastureArrays['PastureZones'], gridNLCD, pastureArrays['FocalAreaPast'])
+del zonesCounty, inRasterPastureCells, pastureArrays
+storeBins = dict()
+tasksPasture = list()
 for binID in range(1,int(binIDmax+1)):
-    arcpy.MakeTableView_management(tableFarmCountsPast,CurrentBin,fieldAnimalBin+'='+str(binID))
-    time.sleep(2)
-    arcpy.JoinField_management(featurePastureGME,fieldCountyJoin,CurrentBin,fieldCountyJoin)
-    # Removing Null rows
-    up_curs = arcpy.UpdateCursor(featurePastureGME, "BIN_CTY IS NULL")
-    for row in up_curs:
-        if not row.getValue('BIN_CTY'):
-            up_curs.deleteRow(row)
-
-    del up_curs
-    
-    # Input correct table
-    arcpy.MakeTableView_management(featurePastureGME, "calcfieldTableView")
-    arcpy.TableToTable_conversion("calcfieldTableView", pathCalcGDB, "calcfieldTable")
-    tempArray = arcpy.da.TableToNumPyArray(pathCalcGDB+'/calcfieldTable', ['*'])
-    dfCalcField = pd.DataFrame(tempArray)
-    arcpy.Delete_management(pathCalcGDB+'/calcfieldTable')
-    del tempArray
-    # Input fields to calculate and formula to calculate them
-    dfCalcField[fieldAreaRequired] = pd.to_numeric(dfCalcField[fieldPLoad]) / paramPastureAssimiliation
-    dfCalcField.to_csv(tempCSVfile,index=False)
-    arcpy.TableToTable_conversion(tempCSVfile,outDir,'tempcalcfieldTable2')
-    # Input original table to be joined back to
-    arcpy.JoinField_management(featurePastureGME,fieldCountyJoin,'tempcalcfieldTable2',fieldCountyJoin, [fieldAreaRequired]) # Need to make sure correct fields are being joined!
-    arcpy.Delete_management('tempcalcfieldTable2') # Deleting temporary table
-    arcpy.Delete_management(tempCSVfile) # Also deleting csv file - want to reuse the same filename for simplicity
-    del dfCalcField
-    
-    arcpy.PolygonToRaster_conversion(featurePastureGME,fieldAreaRequired,rasterRequiredAreaPast)
-    inRasterRequiredArea = arcpy.Raster(rasterRequiredAreaPast)
-    inRasterFocalArea = arcpy.Raster(rasterFocalAreaPast)
-    conRequiredArea = arcpy.sa.Con((inRasterRequiredArea>inRasterFocalArea),1,0)
-    ExclusionResult = arcpy.GetRasterProperties_management(conRequiredArea,'MAXIMUM')
-    ExclusionResultMax = ExclusionResult.getOutput(0)
-    if int(ExclusionResultMax) == 0:
-        for fifthmult in range(0,5):
-            mult = 45*fifthmult
-            arcpy.MakeFeatureLayer_management(featurePastureGME,'PastureClipOneFifth')
-            arcpy.SelectLayerByAttribute_management('PastureClipOneFifth', 'NEW_SELECTION', ' "OBJECTID" >= '+str(1+mult)+' AND "OBJECTID" <= '+str(45+mult))
-            arcpy.CopyFeatures_management('PastureClipOneFifth', 'PastureClipOneFifthGME')
-            # Error window popping up in GME is preventing loop from continuing. Can't figure out how to stop it,
-            # so using this unnecessarily convoluted method to get around it.
-            # Using threading to start GME, then run a separate Python script that presses the "enter" key after 5 seconds
-            os.chdir("S:\\Users\\roushjac\\Tipping Points\\Manure\\Script\\Python")
-            thread1 = threading.Thread(target=RunGMEPast_NoExcl)
-            thread2 = threading.Thread(target=RunEnterKey)
-            thread1.start()
-            thread2.start()
-            thread1.join() # Stops python until thread closes, signaling the finish of GME
-    else:
-        nullRequiredArea = arcpy.sa.SetNull(conRequiredArea==0,1)
-        arcpy.RasterToPolygon_conversion(nullRequiredArea,featureExclusionArea) #This resets the python working directory!!! Need to reassign it
-#        os.chdir("S:\\Users\\roushjac\\Tipping Points\\Manure\\Script\\Python")
-#        # Some counties do not have any usable Ag cells after looking at excluded area - for these counties, ignore exclusion area
-#        # and place farms down anyway. These farms need to be treated as point sources!
-#        arcpy.SpatialJoin_analysis(featureExclusionArea, featureCounties, featureExclusionAreaCounties,'JOIN_ONE_TO_MANY','','','INTERSECT')
-#        arcpy.Dissolve_management(featureExclusionAreaCounties, featureExclusionAreaCountiesDiss, fieldCountyJoin,'','MULTI_PART')
-##        arcpy.JoinField_management(featureExclusionAreaCountiesDiss, fieldCountyJoin, featureTempCountyManureClip, fieldCountyJoin, ['Req_Area'])
-#        arcpy.RasterToPolygon_conversion(conRequiredArea, 'RequiredAreaPolygon', 'SIMPLIFY','Value')
-#        arcpy.SpatialJoin_analysis('RequiredAreaPolygon', featureCounties, 'RequiredAreaPolygonCounties','JOIN_ONE_TO_MANY','','','INTERSECT')
-#        arcpy.Dissolve_management('RequiredAreaPolygonCounties', 'RequiredAreaPolygonCounties_Diss', fieldCountyJoin,'gridcode MIN','MULTI_PART')
-##        arcpy.Statistics_analysis('RequiredAreaPolygonCounties_Diss', 'tableRequiredArea_Stats', ['value', 'MIN'], [fieldCountyJoin])
-#        arcpy.JoinField_management(featureExclusionAreaCountiesDiss, fieldCountyJoin, 'RequiredAreaPolygonCounties_Diss', fieldCountyJoin)
-#        up_curs = arcpy.UpdateCursor(featureExclusionAreaCountiesDiss, "MIN_gridcode = 1")
-#        for row in up_curs:
-#            if int(row.getValue('MIN_gridcode')) == 1:
-#                up_curs.deleteRow(row)
-#
-#        del up_curs
-#        arcpy.CopyFeatures_management(featureExclusionAreaCountiesDiss, featureExclusionArea)
-        for fifthmult in range(0,5):
-            mult = 45*fifthmult
-            arcpy.MakeFeatureLayer_management(featurePastureGME,'PastureClipOneFifth')
-            arcpy.SelectLayerByAttribute_management('PastureClipOneFifth', 'NEW_SELECTION', ' "OBJECTID" >= '+str(1+mult)+' AND "OBJECTID" <= '+str(45+mult))
-            arcpy.CopyFeatures_management('PastureClipOneFifth', 'PastureClipOneFifthGME')
-            os.chdir("S:\\Users\\roushjac\\Tipping Points\\Manure\\Script\\Python")
-            thread1 = threading.Thread(target=RunGMEPast_Excl)
-            thread2 = threading.Thread(target=RunEnterKey)
-            thread1.start()
-            thread2.start()
-            thread1.join() # Stops python until thread closes, signaling the finish of GME
-#            del(nullRequiredArea)
-#            arcpy.Delete_management(featureExclusionArea)
-#            arcpy.Delete_management(featureExclusionAreaCounties)
-#            arcpy.Delete_management(featureExclusionAreaCountiesDiss)
-        
-    print 'The bin is:',binID
-    currenttime = time.time()
-    print 'Loop has been running for '+str(currenttime - startsec)+' seconds, or '+str((currenttime - startsec)/60)+' minutes.'
-    arcpy.CopyFeatures_management(featurePastureGME+'clean',featurePastureGME)
-    del(inRasterRequiredArea, inRasterFocalArea, conRequiredArea)
-
-end = time.ctime()
-endsec = time.time()
-print 'Start: '+start
-print 'End: '+end
-print 'Loop took '+str(endsec - startsec)+' seconds, or '+str((endsec - startsec)/60)+' minutes!'
+    storeBin = AttributeStore.fromTable(tableFarmCountsPast, fieldLoadID, [fieldCountyJoin, fieldOperations, fieldPLoad], fieldAnimalBin+'='+str(binID))
+    storeBin[fieldAreaRequired] = pd.to_numeric(storeBin[fieldPLoad]) / paramPastureAssimiliation
+    tasksPasture.append((binID, storeBin[fieldCountyJoin], storeBin[fieldOperations], storeBin[fieldAreaRequired]))
+    storeBins[binID] = storeBin
+# Stream 1, so pasture bins don't reuse the random numbers of the confined bins with the same ID
+placedBins = BinPlacement.placeBins(zonesPasture, tasksPasture, paramPlacementSeed, 1, paramPlacementWorkers, os.path.join(pathPlacementScratch, 'Pasture'), trace=runTrace)
+
+placedPasture = list()
+placedBinCty = list()
+for binID in range(1,int(binIDmax+1)):
+    placedPasture.append(placedBins[binID])
+    placedBinCty.append(storeBins[binID][fieldLoadID])
+    print 'The bin is:',binID,', farms placed:',len(placedBins[binID])
+placedPasture = FarmPlacement.concatenate(placedPasture)
+FarmPlacement.writePoints(featurePastureHerds, spatialRefGLB, placedPasture.x, placedPasture.y,
+                          [(fieldLoadID, np.concatenate(placedBinCty)[placedPasture.request]), ('PNTID', placedPasture.pointIDs())])
+del zonesPasture, storeBins, tasksPasture, placedBins, placedPasture, placedBinCty
+
+timing = placementTimer.stop(bins=int(binIDmax))
+print 'Start: '+time.ctime(timing['started'])
+print 'End: '+time.ctime()
+print 'Loop took '+str(timing['wall'])+' seconds, or '+str(timing['wall']/60)+' minutes!'
 
 #Join Loads to Pasture Herds
 arcpy.JoinField_management(featurePastureHerds,fieldLoadID,tableFarmCountsPast,fieldLoadID)
 #arcpy.AddField_management(featurePastureHerds,fieldInitialRadius)
 #arcpy.CalculateField_management(featurePastureHerds,fieldInitialRadius,'(['+fieldPLoad+']/('+str(paramPastureAssimiliation)+'))^.5','VB')
-# Input correct table
-arcpy.MakeTableView_management(featurePastureHerds, "calcfieldTableView")
-arcpy.TableToTable_conversion("calcfieldTableView", pathCalcGDB, "calcfieldTable")
-tempArray = arcpy.da.TableToNumPyArray(pathCalcGDB+'/calcfieldTable', ['*'])
-dfCalcField = pd.DataFrame(tempArray)
-arcpy.Delete_management(pathCalcGDB+'/calcfieldTable')
-del tempArray
-# Input fields to calculate and formula to calculate them
-dfCalcField[fieldInitialRadius] = (dfCalcField[fieldPLoad] / paramPastureAssimiliation)**.5
-dfCalcField.to_csv(tempCSVfile,index=False)
-arcpy.TableToTable_conversion(tempCSVfile,outDir,'tempcalcfieldTable2')
-# Input original table to be joined back to
-arcpy.JoinField_management(featurePastureHerds,fieldCountyJoin,'tempcalcfieldTable2',fieldCountyJoin, [fieldInitialRadius]) # Need to make sure correct fields are being joined!
-arcpy.Delete_management('tempcalcfieldTable2') # Deleting temporary table
-arcpy.Delete_management(tempCSVfile) # Also deleting csv file - want to reuse the same filename for simplicity
-del dfCalcField
-
-arcpy.Buffer_analysis(featurePastureHerds, featureWasteBuffers,fieldInitialRadius,'','ROUND','NONE')
-#Dissolve Overlapping Buffers
-arcpy.Near_analysis(featureWasteBuffers,featureWasteBuffers,0)
-arcpy.MakeFeatureLayer_management(featureWasteBuffers,'Near_Buffers')
-arcpy.SelectLayerByAttribute_management('Near_Buffers','NEW_SELECTION',' "NEAR_DIST" = 0')
-arcpy.Dissolve_management('Near_Buffers',featureWasteBuffersPreDissolved,'','','SINGLE_PART')
-arcpy.MakeFeatureLayer_management(featureWasteBuffersPreDissolved,'Diss_Near_Buffers')
-arcpy.SelectLayerByLocation_management('Near_Buffers','INTERSECT','Diss_Near_Buffers',0,'NEW_SELECTION')
-arcpy.DeleteFeatures_management('Near_Buffers')
-arcpy.Merge_management(['Near_Buffers','Diss_Near_Buffers'],featureWasteBuffersDissolved)
-arcpy.DeleteField_management(featureWasteBuffersDissolved,['COUNTY','Join_Count','TARGET_FID','JOIN_FID','GMEID','PNTID','CtyID','CTYID','COUNTY_NAM','YEAR','STATE_AVER','MAN_M2','CTYID_1','CTYID_12','CTYN_KGPY','CTYP_KGYR','AvgR','RInit','Req_Area','BIN_CTY','GMEID_1','CTYID_12_13','N_KGYEAR','P_KGYEAR','BIN_CTY_1','N_UNREC','P_UNREC','RNew','ADiff','BUFF_DIST','NEAR_FID','NEAR_FID_1','NEAR_DIST'])
+# Radius is calculated for each herd, so the table is matched on OBJECTID instead of CtyID. Joining on CtyID gave
+# every herd in a county the radius of the county's first herd.
+storeCalcField = AttributeStore.fromTable(featurePastureHerds, 'OBJECTID', [fieldPLoad])
+storeCalcField[fieldInitialRadius] = (storeCalcField[fieldPLoad] / paramPastureAssimiliation)**.5
+storeCalcField.toTable(featurePastureHerds, [fieldInitialRadius])
+del storeCalcField
+
+# Overlapping buffers are grouped from the herd points and radii (see BufferGroups.py) instead of Near_analysis and
+# Dissolve. The group ID is written to the herds as Near_FID and the buffers are dissolved by it as they are made.
+storeHerds = AttributeStore.fromTable(featurePastureHerds, 'OBJECTID', ['SHAPE@X', 'SHAPE@Y', fieldInitialRadius])
+storeHerds[fieldFIDGroup] = BufferGroups.groupCircles(storeHerds['SHAPE@X'], storeHerds['SHAPE@Y'], storeHerds[fieldInitialRadius])
+storeHerds.toTable(featurePastureHerds, [fieldFIDGroup])
+del storeHerds
+arcpy.Buffer_analysis(featurePastureHerds, featureWasteBuffersDissolved, fieldInitialRadius, 'FULL', 'ROUND', 'LIST', [fieldFIDGroup])
 #Clip Buffer by Ag Cells
 arcpy.Clip_analysis(featureWasteBuffersDissolved,featurePastureCells,featureWasteBuffersClip)
 arcpy.CalculateAreas_stats(featureWasteBuffersClip,featureWasteBuffersClipArea)
-arcpy.Intersect_analysis([featureWasteBuffersClipArea,featurePastureHerds],featureWasteBuffersClip,'ONLY_FID')
-arcpy.JoinField_management(featureWasteBuffersClipArea,fieldFIDFarm,featureWasteBuffersClip,'FID_'+featureWasteBuffersClipArea)
-arcpy.JoinField_management(featureWasteBuffersClipArea,'FID_'+featurePastureHerds,featurePastureHerds,fieldFIDFarm)
 
 #Calculate Dissolved Area Total and Dissolved Area Ag Land and Join to original Points
 statsFields = [[fieldNLoad,'SUM'],[fieldPLoad,'SUM']]
-arcpy.Statistics_analysis(featureWasteBuffersClipArea,tableGroupedBuffers,statsFields,'FID_'+featureWasteBuffersClipArea)
-arcpy.JoinField_management(featureWasteBuffersClipArea,'FID_'+featureWasteBuffersClipArea,tableGroupedBuffers,'FID_'+featureWasteBuffersClipArea)
+arcpy.Statistics_analysis(featurePastureHerds,tableGroupedBuffers,statsFields,fieldFIDGroup)
+arcpy.JoinField_management(featureWasteBuffersClipArea,fieldFIDGroup,tableGroupedBuffers,fieldFIDGroup)
 
 #Calculate Average Rate over Combined Pasture Area
 #arcpy.CalculateField_management(featureWasteBuffersClipArea,fieldNLoad,'['+'SUM_'+fieldNLoad+']/[F_AREA]')
 #arcpy.CalculateField_management(featureWasteBuffersClipArea,fieldPLoad,'['+'SUM_'+fieldPLoad+']/[F_AREA]')
-# Input correct table
-arcpy.MakeTableView_management(featureWasteBuffersClipArea, "calcfieldTableView")
-arcpy.TableToTable_conversion("calcfieldTableView", pathCalcGDB, "calcfieldTable")
-tempArray = arcpy.da.TableToNumPyArray(pathCalcGDB+'/calcfieldTable', ['OBJECTID',fieldNLoadSum, fieldPLoadSum, 'F_AREA',fieldNLoad,fieldPLoad])
-dfCalcField = pd.DataFrame(tempArray)
-arcpy.Delete_management(pathCalcGDB+'/calcfieldTable')
-del tempArray
-# Input fields to calculate and formula to calculate them
-dfCalcField[fieldNLoad] = dfCalcField['SUM_'+fieldNLoad] / dfCalcField['F_AREA']
-dfCalcField[fieldPLoad] = dfCalcField['SUM_'+fieldPLoad] / dfCalcField['F_AREA']
-dfCalcField.to_csv(tempCSVfile,index=False)
-arcpy.TableToTable_conversion(tempCSVfile,outDir,'tempcalcfieldTable2')
-# Input original table to be joined back to
-arcpy.JoinField_management(featureWasteBuffersClipArea,'OBJECTID','tempcalcfieldTable2','OBJECTID', [fieldNLoad, fieldPLoad]) # Need to make sure correct fields are being joined!
-arcpy.Delete_management('tempcalcfieldTable2') # Deleting temporary table
-arcpy.Delete_management(tempCSVfile) # Also deleting csv file - want to reuse the same filename for simplicity
-del dfCalcField
+storeCalcField = AttributeStore.fromTable(featureWasteBuffersClipArea, 'OBJECTID', [fieldNLoadSum, fieldPLoadSum, 'F_AREA'])
+storeCalcField[fieldNLoad] = storeCalcField[fieldNLoadSum] / storeCalcField['F_AREA']
+storeCalcField[fieldPLoad] = storeCalcField[fieldPLoadSum] / storeCalcField['F_AREA']
+storeCalcField.toTable(featureWasteBuffersClipArea, [fieldNLoad, fieldPLoad])
+del storeCalcField
 
 
 #Convert Pasture to Raster
@@ -835,115 +742,112 @@ arcpy.PolygonToRaster_conversion(featureWasteBuffersClipArea,fieldPLoad,rasterPP
 ##arcpy.PointToRaster_conversion(featurePastureHerds,fieldPLoad,rasterPPasture,'SUM')
 
 #Finalizing pasture rasters
-#Convert null values to 0 and Add All Contributions
-inRasterPastureNRate = arcpy.Raster(rasterNPastureRate)
+#Convert null values to 0 and Add All Contributions. The rates are stored as float32 on the snap grid (see CompactRaster.py)
+inRasterPastureNRate = RasterAlgebra.Raster(rasterNPastureRate)
 #inRasterPastureN = inRasterPastureNRate*cellSize*cellSize
 #RasterPastureNnull = arcpy.sa.IsNull(inRasterPastureN)
-RasterPastureNnoNull = arcpy.sa.Con(arcpy.sa.IsNull(inRasterPastureNRate),0,inRasterPastureNRate)
-RasterPastureNnoNull.save('RasterPastureNnoNull')
+RasterPastureNnoNull = RasterAlgebra.Con(RasterAlgebra.IsNull(inRasterPastureNRate),0,inRasterPastureNRate)
+CompactRaster.saveRates(pathPastureNRates, RasterPastureNnoNull, gridNLCD)
 del(inRasterPastureNRate,RasterPastureNnoNull)
 
-inRasterPasturePRate = arcpy.Raster(rasterPPastureRate)
+inRasterPasturePRate = RasterAlgebra.Raster(rasterPPastureRate)
 #inRasterPastureP = inRasterPasturePRate*cellSize*cellSize
 #RasterPasturePnull = arcpy.sa.IsNull(inRasterPastureP)
-RasterPasturePnoNull = arcpy.sa.Con(arcpy.sa.IsNull(inRasterPasturePRate),0,inRasterPasturePRate)
-RasterPasturePnoNull.save('RasterPasturePnoNull')
+RasterPasturePnoNull = RasterAlgebra.Con(RasterAlgebra.IsNull(inRasterPasturePRate),0,inRasterPasturePRate)
+CompactRaster.saveRates(pathPasturePRates, RasterPasturePnoNull, gridNLCD)
 del(inRasterPasturePRate,RasterPasturePnoNull)
 
 ## Copying pasture buffers to another layer to preserve them - using similar names for the confined
 ## farms buffers
 arcpy.CopyFeatures_management(featureWasteBuffersClipArea, featureWasteBuffersClipPast)
 
-# Don't want to spread confined manure owhere there is already pasture manure
-arcpy.Erase_analysis(featureTempCAFOFertilizedCells,featureWasteBuffersClipPast, featureTempCAFOFertilizedCellsNoPast+'prelim')
+# Don't want to spread confined manure owhere there is already pasture manure. The available area is a bit mask of
+# the Ag cells minus the pasture buffer cells (see PackedMask.py) instead of the Ag cell polygons with the pasture
+# buffers erased, so the convergence loop counts cells instead of clipping buffers
+arcpy.PolygonToRaster_conversion(featureWasteBuffersClipPast, 'OBJECTID', rasterPastureBufferCells)
+maskAvailable = PackedMask.fromExpr(RasterAlgebra.Con(RasterAlgebra.IsNull(RasterAlgebra.Raster(rasterPastureBufferCells)),
+                                                      CompactRaster.load(pathAgMaskBits), 0), gridNLCD)
 # Adding true CAFO locations back into total Ag area to make sure every point can be matched to a buffer
-arcpy.Merge_management([featureTempCAFOFertilizedCellsNoPast+'prelim',featureCAFOLocationPolys], featureTempCAFOFertilizedCellsNoPast)
-
-
-#%% Resetting ConfinedFarms in case buffer process does not work properly
-arcpy.CopyFeatures_management(featureTempConfinedFarms+'clean', featureTempConfinedFarms)
+storeCAFOs = AttributeStore.fromTable(featureBasinCAFOs, 'OBJECTID', ['SHAPE@X', 'SHAPE@Y'])
+maskAvailable.setPoints(storeCAFOs['SHAPE@X'], storeCAFOs['SHAPE@Y'])
+if not os.path.isdir(os.path.dirname(pathAvailableMask)):
+    os.makedirs(os.path.dirname(pathAvailableMask))
+maskAvailable.save(pathAvailableMask)
+print 'Available area for confined manure:', maskAvailable.count()*gridNLCD.cellArea/1e6, 'km2, mask size:', maskAvailable.nbytes/1e6, 'MB'
+del maskAvailable, storeCAFOs
+
+
+#%% [stage: convergence] Resetting ConfinedFarms in case buffer process does not work properly
+# When an interrupted run of this stage is started again by RunManureModel.py, the loop is picked up after its last
+# finished iteration instead, so ConfinedFarms is kept as it is
+resumeState = currentStage.resume() if currentStage is not None else None
+if resumeState is None:
+    arcpy.CopyFeatures_management(featureTempConfinedFarms+'clean', featureTempConfinedFarms)
+maskAvailable = PackedMask.load(pathAvailableMask) # Ag cells minus pasture buffers plus CAFOs, from the pasture placement stage
+
+#%% Initial radii from radial profiles of the available ag area (see RadialProfile.py)
+if resumeState is None:
+    # For each farm, the sorted distances to every available ag cell give the radius that holds Req_Area directly.
+    # Farms whose buffers don't overlap another farm's are done after this, so the loop below only has to work on the
+    # farms that share area. Available area is the same bit mask the loop counts cells in.
+    storeFarms = AttributeStore.fromTable(featureTempConfinedFarms, 'OBJECTID', ['SHAPE@X', 'SHAPE@Y', fieldAreaRequired, fieldInitialRadius])
+    profileTimer = runTrace.start('radial profiles', farms=len(storeFarms))
+    farmProfiles = RadialProfiles.build(maskAvailable, maskAvailable.grid, storeFarms['SHAPE@X'], storeFarms['SHAPE@Y'], storeFarms[fieldAreaRequired], paramFocalDist*cellSize)
+    radiiProfile = farmProfiles.radiusForArea(storeFarms[fieldAreaRequired])
+    timing = profileTimer.stop(unreached=int(np.isnan(radiiProfile).sum()))
+    print 'Radial profiles took '+str(timing['wall'])+' seconds. '+str(timing['unreached'])+' farms could not reach their required area.'
+    # Farms that can't reach Req_Area within the focal distance keep their original guess
+    storeFarms.update(fieldInitialRadius, radiiProfile, ~np.isnan(radiiProfile))
+    storeFarms.toTable(featureTempConfinedFarms, [fieldInitialRadius])
+    del storeFarms
 
 
 #%%
 # Create buffer around each farm to spread manure. If there is not enough area in the buffers, iteratively increase 
 # the buffer radius until 96% of confined farms meet their required area
 
-Conv = 1
-iteration = 0
-start = time.ctime()
-startsec = time.time()
-while Conv>ConvThreshold: # Had to stop this loop at 0.03 Conv after it ran over the weekend. Don't know if it ever would have finished!
-    startlooptime = time.time()
+if resumeState is None:
+    Conv = 1
+    iteration = 0
+    radiusHistory = RadiusUpdate.RadiusHistory(ReqAreaThreshold, paramRadiusUpdate) # Keeps each farm's earlier radii and areas between iterations
+    groupAreaCache = BufferGroups.GroupAreaCache() # Clipped area of groups that haven't changed since the last iteration
+else:
+    # The radii are put back too, since an iteration that was cut off may have written some of its fields already
+    iteration, Conv, radiusHistory, groupAreaCache, storeRadii = resumeState
+    storeRadii.toTable(featureTempConfinedFarms, [fieldInitialRadius])
+    del storeRadii, resumeState
+    print 'Resuming the loop after iteration', iteration, ', Conv =', Conv
+statsFields = [[fieldAreaRequired, 'SUM'],[fieldNLoad,'SUM'],[fieldPLoad,'SUM']]
+loopTimer = runTrace.start('convergence loop', firstIteration=iteration+1)
+while Conv>ConvThreshold and iteration<paramMaxIterations: # Had to stop this loop at 0.03 Conv after it ran over the weekend. Don't know if it ever would have finished!
+    iterationTimer = runTrace.start('convergence iteration', iteration=iteration+1)
     print 'This iteration started:',time.ctime()
     #Buffer CAFO Locations
 #    arcpy.Buffer_analysis(featureTempConfinedFarms, featureWasteBuffers,fieldInitialRadius,'','ROUND','NONE')
 
-    arcpy.Buffer_analysis(in_features="ConfinedFarms",out_feature_class="D:/Arc_Data/ManureOutputs.gdb/Waste_Buff_New",buffer_distance_or_field="RInit",line_side="FULL",line_end_type="ROUND",dissolve_option="NONE",dissolve_field="#")
-    #Dissolve Overlapping Buffers
-    arcpy.Near_analysis(featureWasteBuffers,featureWasteBuffers,0)
-    arcpy.MakeFeatureLayer_management(featureWasteBuffers,'Near_Buffers')
-    arcpy.SelectLayerByAttribute_management('Near_Buffers','NEW_SELECTION',' "NEAR_DIST" = 0')
-    arcpy.Dissolve_management('Near_Buffers',featureWasteBuffersPreDissolved,'','','SINGLE_PART') # This was freezing after a few iterations when it was set to "SINGLE_PART" because of memory issues. Changing to "MULTI_PART"
-
-#   �?� call the seperate subprocess function  
-#    dissolveInSubprocess(in_fc = 'Near_Buffers', out_fc = featureWasteBuffersPreDissolved, dissolve_fields = '#', stat_fields ='#', multi_part = 'MULTI_PART', unsplit_lines = "DISSOLVE_LINES", xytol = '#')
-#    dissolveInSubprocess()
-    
-    arcpy.SimplifyPolygon_cartography(featureWasteBuffersPreDissolved,featureWasteBuffersPreDissolved+'Simp','POINT_REMOVE',30,'','','')
-#    arcpy.AddField_management(featureWasteBuffersPreDissolved+'Simp','Diss')
-#    arcpy.CalculateField_management(featureWasteBuffersPreDissolved+'Simp','Diss',1,'VB')
-    # Input correct table
-    arcpy.MakeTableView_management(featureWasteBuffersPreDissolved+'Simp', "calcfieldTableView")
-    arcpy.TableToTable_conversion("calcfieldTableView", pathCalcGDB, "calcfieldTable")
-    tempArray = arcpy.da.TableToNumPyArray(pathCalcGDB+'/calcfieldTable', ['*'])
-    dfCalcField = pd.DataFrame(tempArray)
-    arcpy.Delete_management(pathCalcGDB+'/calcfieldTable')
-    del tempArray
-    # Input fields to calculate and formula to calculate them
-    dfCalcField['Diss'] = 1
-    dfCalcField.to_csv(tempCSVfile,index=False)
-    arcpy.TableToTable_conversion(tempCSVfile,outDir,'tempcalcfieldTable2')
-    # Input original table to be joined back to
-    arcpy.JoinField_management(featureWasteBuffersPreDissolved+'Simp','OBJECTID','tempcalcfieldTable2','OBJECTID', ['Diss']) # Need to make sure correct fields are being joined!
-    arcpy.Delete_management('tempcalcfieldTable2') # Deleting temporary table
-    arcpy.Delete_management(tempCSVfile) # Also deleting csv file - want to reuse the same filename for simplicity
-
-    arcpy.Dissolve_management(featureWasteBuffersPreDissolved+'Simp',featureWasteBuffersPreDissolved+'2',['Diss'],'','MULTI_PART')
-    arcpy.MultipartToSinglepart_management(featureWasteBuffersPreDissolved+'2',featureWasteBuffersPreDissolved)
-    arcpy.MakeFeatureLayer_management(featureWasteBuffersPreDissolved,'Diss_Near_Buffers')
-    arcpy.SelectLayerByLocation_management('Near_Buffers','INTERSECT','Diss_Near_Buffers',0,'NEW_SELECTION')
-    arcpy.DeleteFeatures_management('Near_Buffers')
-    arcpy.Merge_management(['Near_Buffers','Diss_Near_Buffers'],featureWasteBuffersDissolved) # I think this is a layer of (actual buffers) + (simplified buffers)?
-    arcpy.DeleteField_management(featureWasteBuffersDissolved,['COUNTY','Join_Count','TARGET_FID','JOIN_FID','GMEID','PNTID','CtyID','CTYID','COUNTY_NAM','YEAR','STATE_AVER','MAN_M2','CTYID_1','CTYID_12','CTYN_KGPY','CTYP_KGYR','AvgR','RInit','Req_Area','BIN_CTY','GMEID_1','CTYID_12_13','N_KGYEAR','P_KGYEAR','BIN_CTY_1','N_UNREC','P_UNREC','RNew','ADiff','BUFF_DIST','NEAR_FID','NEAR_FID_1','NEAR_DIST'])
-
-    #Clip Buffer by Ag cells and Pasture buffers - do not want to spread confined farms in pasture buffers
-    arcpy.Clip_analysis(featureWasteBuffersDissolved,featureTempCAFOFertilizedCellsNoPast,featureWasteBuffersClip)
-
-    # CalculateAreas is not working on Hydroiliad with Arc 10.2.2 as of 7/20. Proceed with caution
-#    arcpy.CalculateAreas_stats(featureWasteBuffersClip,featureWasteBuffersClipArea) #This calculates area taken up by clipped Ag buffers
-    # Repacing CalculateArea with a copy of Shape_Area created with the clip - but don't want to directly use the field since we cannot delete it later (it is a required field)
-    arcpy.AddField_management(featureWasteBuffersClip, fieldClipArea, 'DOUBLE')
-    up_curs = arcpy.da.UpdateCursor(featureWasteBuffersClip, ['Shape_Area',fieldClipArea])
-    for row in up_curs:
-        row[1] = row[0]
-        up_curs.updateRow(row)
-    del up_curs
-    arcpy.Near_analysis(featureTempConfinedFarms,featureWasteBuffersClip,0) # I think this function also creates a field, nearFID, that gives a unique value to each polygon
-    arcpy.JoinField_management(featureTempConfinedFarms,fieldFIDGroup,featureWasteBuffersClip,fieldFIDFarm, [fieldClipArea])
-    #Change Shape_Area field from CAFOs into F_AREA field to keep names consistent
-    areaFields = [fieldClipArea,'Shape_Area']
-    up_curs = arcpy.da.UpdateCursor(featureWasteBuffersClip, areaFields)
-    for row in up_curs:
-        if row[0] is None:
-            row[0] = row[1]
-            up_curs.updateRow(row)
-    del up_curs
-    #Remove Unecessary Fields
-    arcpy.DeleteField_management(featureTempConfinedFarms,['Near_Dist'])
-    #Calculate Dissolved Area Total and Dissolved Area Ag Land and Join to original Points
-    statsFields = [[fieldAreaRequired, 'SUM'],[fieldNLoad,'SUM'],[fieldPLoad,'SUM']]
-    arcpy.Statistics_analysis(featureTempConfinedFarms,tableGroupedBuffers,statsFields,fieldFIDGroup)
-    arcpy.JoinField_management(featureTempConfinedFarms,fieldFIDGroup,tableGroupedBuffers,fieldFIDGroup)
+    # Overlapping buffers are grouped from the farm points and radii (see BufferGroups.py) instead of Near_analysis,
+    # Dissolve, SimplifyPolygon, MultipartToSinglepart and the select/delete/merge steps - Dissolve kept freezing
+    # from memory issues. The group ID is written to the farms as Near_FID, and the buffers are dissolved by it as
+    # they are made, so every group is one polygon with the same Near_FID as its farms.
+    storeFarms = AttributeStore.fromTable(featureTempConfinedFarms, 'OBJECTID', ['SHAPE@X', 'SHAPE@Y', fieldInitialRadius, fieldAreaRequired, fieldNLoad, fieldPLoad])
+    storeFarms[fieldFIDGroup] = BufferGroups.groupCircles(storeFarms['SHAPE@X'], storeFarms['SHAPE@Y'], storeFarms[fieldInitialRadius])
+    # Only groups whose farms or radii changed since the last iteration are clipped again. The rest keep their
+    # clipped area from the cache, so late iterations only clip the farms that are still moving
+    rebuffer = groupAreaCache.dirtyFarms(storeFarms['OBJECTID'], storeFarms[fieldFIDGroup], storeFarms[fieldInitialRadius])
+    storeFarms.toTable(featureTempConfinedFarms, [fieldFIDGroup])
+    countRebuffer = int(rebuffer.sum())
+    print 'Buffer groups:', int(storeFarms[fieldFIDGroup].max()), ', reused from last iteration:', groupAreaCache.reused, ', farms to re-buffer:', countRebuffer
+    if countRebuffer > 0:
+        # A group's clipped area is the area of the available cells with centers inside its buffers, so no
+        # buffer polygons are made until the last iteration
+        groupAreaCache.record(*maskAvailable.groupAreas(storeFarms['SHAPE@X'][rebuffer], storeFarms['SHAPE@Y'][rebuffer],
+                                                        storeFarms[fieldInitialRadius][rebuffer], storeFarms[fieldFIDGroup][rebuffer]))
+    # Farms and clipped groups share Near_FID, so no Near_analysis is needed to match them up
+    storeFarms[fieldClipArea] = groupAreaCache.farmAreas()
+    #Calculate Dissolved Area Total and Dissolved Area Ag Land and Join to original Points. Sums are in memory (same as Statistics_analysis + JoinField)
+    storeFarms.join(storeFarms.groupStats(fieldFIDGroup, statsFields), onField=fieldFIDGroup)
+    storeFarms.toTable(featureTempConfinedFarms, [fieldClipArea, 'FREQUENCY', fieldAreaReqTotal, fieldNLoadSum, fieldPLoadSum])
+    del storeFarms
 
     #Calculate Area Percent Difference and Update Buffer Radius
 
@@ -965,23 +869,14 @@ while Conv>ConvThreshold: # Had to stop this loop at 0.03 Conv after it ran over
 #    arcpy.Delete_management(tempCSVfile) # Also deleting csv file - want to reuse the same filename for simplicity
 #    del dfCalcField
 
-    arcpy.MakeTableView_management(featureTempConfinedFarms, "calcfieldTableView")
-    arcpy.TableToTable_conversion("calcfieldTableView", pathCalcGDB, "calcfieldTable")
-    tempArray = arcpy.da.TableToNumPyArray(pathCalcGDB+'/calcfieldTable', [fieldAreaReqTotal, fieldClipArea, fieldFIDGroup])
-    dfCalcField = pd.DataFrame(tempArray)
-    arcpy.Delete_management(pathCalcGDB+'/calcfieldTable')
-    del tempArray
-    # Input fields to calculate and formula to calculate them
-    dfCalcField[fieldAreaDiff] = (dfCalcField[fieldAreaReqTotal]-dfCalcField[fieldClipArea])/dfCalcField[fieldClipArea] # Using 40 as a min to simplify if the % diff between clipped and req'd area is too big
-    dfCalcField.loc[(dfCalcField['ADiff'] > 40),'ADiff'] = 40
-    dfCalcField.loc[(dfCalcField['ADiff'] < 0),'ADiff'] = 0
-    print "Avg ADiff: ",dfCalcField.mean()['ADiff']
-    dfCalcField.to_csv(tempCSVfile,index=False)
-    arcpy.TableToTable_conversion(tempCSVfile,outDir,'tempcalcfieldTable2')
-    # Input original table to be joined back to
-    arcpy.JoinField_management(featureTempConfinedFarms,fieldFIDGroup,'tempcalcfieldTable2',fieldFIDGroup, [fieldAreaDiff]) # Need to make sure correct fields are being joined!
-    arcpy.Delete_management('tempcalcfieldTable2') # Deleting temporary table
-    arcpy.Delete_management(tempCSVfile) # Also deleting csv file - want to reuse the same filename for simplicity
+    # Every farm in a group has the same SUM_Req_Area and F_AREA, so ADiff is written farm by farm on OBJECTID
+    storeCalcField = AttributeStore.fromTable(featureTempConfinedFarms, 'OBJECTID', [fieldAreaReqTotal, fieldClipArea, fieldFIDGroup])
+    storeCalcField[fieldAreaDiff] = (storeCalcField[fieldAreaReqTotal]-storeCalcField[fieldClipArea])/storeCalcField[fieldClipArea] # Using 40 as a min to simplify if the % diff between clipped and req'd area is too big
+    storeCalcField[fieldAreaDiff] = np.clip(storeCalcField[fieldAreaDiff], 0, 40)
+    meanADiff = float(np.nanmean(storeCalcField[fieldAreaDiff]))
+    print "Avg ADiff: ",meanADiff
+    storeCalcField.toTable(featureTempConfinedFarms, [fieldAreaDiff])
+    del storeCalcField
     
 
     # If a farm takes up an area smaller than the cell, label it as converged
@@ -1004,7 +899,15 @@ while Conv>ConvThreshold: # Had to stop this loop at 0.03 Conv after it ran over
     countTotal = arcpy.GetCount_management(featureTempConfinedFarms)
     Conv = float(str(countConv))/float(str(countTotal))
     print 'Conv:', Conv
-    #Update Initial Guess.  Dampen magnitude of update based on the number CAFOs that have converged.
+    if Conv <= ConvThreshold or iteration >= paramMaxIterations:
+        # Last iteration: the clipped buffers of every group are made as polygons for the output, and the group sums
+        # that get joined to them after the loop are written
+        storeGroups = AttributeStore.fromTable(featureTempConfinedFarms, 'OBJECTID', ['SHAPE@X', 'SHAPE@Y', fieldInitialRadius, fieldFIDGroup])
+        clipGroupsToMask(maskAvailable, storeGroups)
+        del storeGroups
+        arcpy.Statistics_analysis(featureTempConfinedFarms,tableGroupedBuffers,statsFields,fieldFIDGroup)
+    #Update Initial Guess. With 'damped', the magnitude of the update is dampened based on the number CAFOs that have converged.
+    #With 'secant', each farm's step comes from how its own clipped area responded to its last radius change
     #Thinking the best way to do this is by using UpdateCursor, since it is easy to specify conditions - alternatives would be using pandas dataframes or CalculateField (if it works on your machine)
 #    arcpy.CalculateField_management(featureTempConfinedFarms,fieldNewRadius,'((['+fieldAreaDiff+'])+1)^.5*['+fieldInitialRadius+']','VB')
 #    # Input correct table
@@ -1024,42 +927,11 @@ while Conv>ConvThreshold: # Had to stop this loop at 0.03 Conv after it ran over
 #    arcpy.Delete_management(tempCSVfile) # Also deleting csv file - want to reuse the same filename for simplicity
 #    del dfCalcField
     
-    if Conv>.1:
-#        arcpy.CalculateField_management(BuffersNotConverged,fieldNewRadius,'((['+fieldAreaDiff+'])+1)^.5*['+fieldInitialRadius+']','VB')
-        convFields = [fieldNewRadius, fieldAreaDiff, fieldInitialRadius]
-        up_curs = arcpy.da.UpdateCursor(featureTempConfinedFarms, convFields)
-        for row in up_curs:
-            if row[1] > ReqAreaThreshold:
-                row[0] = (((row[1])+1)**0.5)*row[2]
-                up_curs.updateRow(row)
-        del up_curs
-    elif (Conv<.1 and Conv>.05):
-#        arcpy.CalculateField_management(BuffersNotConverged,fieldNewRadius,'((.75*['+fieldAreaDiff+'])+1)^.5*['+fieldInitialRadius+']','VB')
-        convFields = [fieldNewRadius, fieldAreaDiff, fieldInitialRadius]
-        up_curs = arcpy.da.UpdateCursor(featureTempConfinedFarms, convFields)
-        for row in up_curs:
-            if row[1] > ReqAreaThreshold:
-                row[0] = (((0.75*row[1])+1)**0.5)*row[2]
-                up_curs.updateRow(row)
-        del up_curs
-    elif (Conv<.05 and Conv>.02):
-#        arcpy.CalculateField_management(BuffersNotConverged,fieldNewRadius,'((.5*['+fieldAreaDiff+'])+1)^.5*['+fieldInitialRadius+']','VB')
-        convFields = [fieldNewRadius, fieldAreaDiff, fieldInitialRadius]
-        up_curs = arcpy.da.UpdateCursor(featureTempConfinedFarms, convFields)
-        for row in up_curs:
-            if row[1] > ReqAreaThreshold:
-                row[0] = (((0.5*row[1])+1)**0.5)*row[2]
-                up_curs.updateRow(row)
-        del up_curs
-    else:
-#        arcpy.CalculateField_management(BuffersNotConverged,fieldNewRadius,'((.1*['+fieldAreaDiff+'])+1)^.5*['+fieldInitialRadius+']','VB')
-        convFields = [fieldNewRadius, fieldAreaDiff, fieldInitialRadius]
-        up_curs = arcpy.da.UpdateCursor(featureTempConfinedFarms, convFields)
-        for row in up_curs:
-            if row[1] > ReqAreaThreshold:
-                row[0] = (((0.1*row[1])+1)**0.5)*row[2]
-                up_curs.updateRow(row)
-        del up_curs
+    # All radii are updated at once in memory instead of with one UpdateCursor per damping factor. Farms with
+    # ADiff <= ReqAreaThreshold keep their radius
+    storeCalcField = AttributeStore.fromTable(featureTempConfinedFarms, 'OBJECTID', [fieldInitialRadius, fieldAreaReqTotal, fieldClipArea, fieldAreaDiff])
+    storeCalcField[fieldNewRadius] = radiusHistory.update(storeCalcField['OBJECTID'], storeCalcField[fieldInitialRadius], storeCalcField[fieldClipArea],
+                                                          storeCalcField[fieldAreaReqTotal], storeCalcField[fieldAreaDiff], Conv)
 
     #Export preliminary output.  This can be ignored if when not debugging code
 #    arcpy.CopyFeatures_management(featureTempConfinedFarms,'FarmsPrelim')
@@ -1068,24 +940,9 @@ while Conv>ConvThreshold: # Had to stop this loop at 0.03 Conv after it ran over
 
     #Update initial guess radius to new radius
 #    arcpy.CalculateField_management(featureTempConfinedFarms,fieldInitialRadius,'['+fieldNewRadius+']','VB')
-    # Input correct table
-    arcpy.MakeTableView_management(featureTempConfinedFarms, "calcfieldTableView")
-    arcpy.TableToTable_conversion("calcfieldTableView", pathCalcGDB, "calcfieldTable")
-    tempArray = arcpy.da.TableToNumPyArray(pathCalcGDB+'/calcfieldTable', [fieldInitialRadius, fieldNewRadius, fieldFIDGroup])
-    dfCalcField = pd.DataFrame(tempArray)
-    arcpy.Delete_management(pathCalcGDB+'/calcfieldTable')
-    del tempArray
-    # Input fields to calculate and formula to calculate them
-    dfCalcField.loc[pd.notnull(dfCalcField.RNew),'RInit'] = dfCalcField.loc[pd.notnull(dfCalcField.RNew),'RNew']
-#    dfCalcField.dropna(how='any').loc[:,fieldInitialRadius] = dfCalcField.dropna(how='any').loc[:,fieldNewRadius]
-    dfCalcField.to_csv(tempCSVfile,index=True)
-    arcpy.TableToTable_conversion(tempCSVfile,outDir,'tempcalcfieldTable2')
-    # Input original table to be joined back to and correct field name
-    arcpy.DeleteField_management(featureTempConfinedFarms,[fieldInitialRadius])
-    arcpy.JoinField_management(featureTempConfinedFarms,fieldFIDGroup,'tempcalcfieldTable2',fieldFIDGroup, [fieldInitialRadius]) # Need to make sure correct fields are being joined!
-    arcpy.Delete_management('tempcalcfieldTable2') # Deleting temporary table
-    arcpy.Delete_management(tempCSVfile) # Also deleting csv file - want to reuse the same filename for simplicity
-    del dfCalcField
+    storeCalcField[fieldInitialRadius] = storeCalcField[fieldNewRadius]
+    storeCalcField.toTable(featureTempConfinedFarms, [fieldNewRadius, fieldInitialRadius])
+    del storeCalcField
 
     #Delete Uneeded Fields and Files
 #    fields = arcpy.ListFields(featureTempConfinedFarms)
@@ -1104,38 +961,53 @@ while Conv>ConvThreshold: # Had to stop this loop at 0.03 Conv after it ran over
     if Conv > ConvThreshold:
         arcpy.DeleteField_management(featureTempConfinedFarms,[fieldNLoadSum,fieldPLoadSum,fieldFIDGroup,fieldFIDGroup+'_1'])
 #        arcpy.Delete_management(featureWasteBuffersClipArea)
-    endlooptime = time.time()
-    print 'This iteration took '+str(endlooptime - startlooptime)+' seconds, '+str((endlooptime - startlooptime)/60.)+' minutes, or '+str((endlooptime - startlooptime)/3600.)+' hours.'
-print 'Buffer area has converged #winning'
-end = time.ctime()
-endsec = time.time()
-print 'Start: '+start
-print 'End: '+end
-print 'Total time was '+str(endsec - startsec)+' seconds, '+str((endsec - startsec)/60)+' minutes, or '+str((endsec - startsec)/3600)+' hours!'
-
-#%%
+    if currentStage is not None:
+        # Saved after every iteration, so a crash only loses the iteration it happened in
+        storeRadii = AttributeStore.fromTable(featureTempConfinedFarms, 'OBJECTID', [fieldInitialRadius])
+        currentStage.checkpoint((iteration, Conv, radiusHistory, groupAreaCache, storeRadii))
+        del storeRadii
+    timing = iterationTimer.stop(Conv=Conv, meanADiff=meanADiff, notConverged=int(str(countConv)))
+    print 'This iteration took '+str(timing['wall'])+' seconds, '+str(timing['wall']/60.)+' minutes, or '+str(timing['wall']/3600.)+' hours.'
+if Conv > ConvThreshold:
+    print 'WARNING: Buffer area has not converged after', iteration, 'iterations, Conv =', Conv
+else:
+    print 'Buffer area has converged #winning'
+radiusHistory.printReport()
+timing = loopTimer.stop(iterations=iteration, Conv=Conv)
+print 'Start: '+time.ctime(timing['started'])
+print 'End: '+time.ctime()
+print 'Total time was '+str(timing['wall'])+' seconds, '+str(timing['wall']/60)+' minutes, or '+str(timing['wall']/3600)+' hours!'
+
+#%% [stage: final rasters]
 
 #Join points to dissolved buffers
-arcpy.JoinField_management(featureWasteBuffersClip,fieldFIDFarm,tableGroupedBuffers,fieldFIDGroup)
+arcpy.JoinField_management(featureWasteBuffersClip,fieldFIDGroup,tableGroupedBuffers,fieldFIDGroup) # Clipped groups carry the farms' Near_FID
 
 #Output CAFO polys for Use in Commercial Fertilizer Script
 arcpy.Copy_management(featureWasteBuffersClip,outCAFOArea)
 
 
 #Apply Unrecovered Loads to Points
-arcpy.PointToRaster_conversion(featureTempConfinedFarms,fieldNUnrecovered,rasterNConfUnrec,'SUM')
-arcpy.PointToRaster_conversion(featureTempConfinedFarms,fieldPUnrecovered,rasterPConfUnrec,'SUM')
+# The farm points are summed straight onto the snap grid (see PointRaster.py), N and P in one pass, with 0 instead of
+# NoData where there are no farms. Same result as PointToRaster with 'SUM' followed by Con(IsNull(...),0,...)
+gridNLCD = RasterGrid.fromRaster(rasterNLCD)
+storeFarms = AttributeStore.fromTable(featureTempConfinedFarms, 'OBJECTID', ['SHAPE@X', 'SHAPE@Y', fieldNUnrecovered, fieldPUnrecovered])
+unrecoveredLoads = PointRaster.accumulate(gridNLCD, storeFarms['SHAPE@X'], storeFarms['SHAPE@Y'],
+                                          [(fieldNUnrecovered, storeFarms[fieldNUnrecovered]), (fieldPUnrecovered, storeFarms[fieldPUnrecovered])])
+print 'Unrecovered loads are in', len(unrecoveredLoads), 'cells,', unrecoveredLoads.dropped, 'farms are outside the grid'
+del storeFarms
 
 
 #Finalizing unrecovered load rasters
-inRasterNUnrec = arcpy.Raster(rasterNConfUnrec)
-inRasterPUnrec = arcpy.Raster(rasterPConfUnrec)
-#RasterUnrecNnull = arcpy.sa.IsNull(inRasterNUnrec)
-RasterUnrecNnoNull = arcpy.sa.Con(arcpy.sa.IsNull(inRasterNUnrec),0,inRasterNUnrec)
-#RasterUnrecPnull = arcpy.sa.IsNull(inRasterPUnrec)
-RasterUnrecPnoNull = arcpy.sa.Con(arcpy.sa.IsNull(inRasterPUnrec),0,inRasterPUnrec)
-RasterUnrecNnoNull.save('RasterUnrecNnoNull')
-RasterUnrecPnoNull.save('RasterUnrecPnoNull')
+# Only a few thousand cells have an unrecovered load, so these are kept sparse (see SparseRaster.py) instead of as
+# full basin rasters, and are only made dense band by band when they are added to the totals below
+RasterUnrecNnoNull = unrecoveredLoads.sparse(fieldNUnrecovered)
+RasterUnrecPnoNull = unrecoveredLoads.sparse(fieldPUnrecovered)
+if not os.path.isdir(pathSparseRasters):
+    os.makedirs(pathSparseRasters)
+RasterUnrecNnoNull.save(os.path.join(pathSparseRasters, 'RasterUnrecNnoNull.npz'))
+RasterUnrecPnoNull.save(os.path.join(pathSparseRasters, 'RasterUnrecPnoNull.npz'))
+del unrecoveredLoads
 
 #Finalizing point source farms raster
 #inRasterNPointSource = arcpy.Raster(rasterNPointSourceFarms)
@@ -1158,5 +1030,39 @@ RasterUnrecPnoNull.save('RasterUnrecPnoNull')
 # As of 7/18/2017, we have rasters for all inputs except confined farms. These need to be debiased using the new method before
 # the correct raster can be generated
 
-NManureTotal = RasterPastureNnoNull + RasterUnrecNnoNull + RasterNManurenoNull
-PManureTotal = RasterPasturePnoNull + RasterUnrecPnoNull + RasterPManurenoNull
\ No newline at end of file
+# The pasture rates are saved in the pasture stage and deleted from memory there
+RasterPastureNnoNull = CompactRaster.load(pathPastureNRates)
+RasterPasturePnoNull = CompactRaster.load(pathPasturePRates)
+# The kg of each layer are summed per county in the same pass as the totals (see MassBalance.py) and checked against
+# the county loads of the confined and pasture tables. The confined county loads are the recovered manure spread in
+# the buffers plus the unrecovered loads at the farms. Pasture and confined manure are rates in kg/m2, the unrecovered
+# loads are kg per cell
+zonesCounty = ZonalStats.ZoneRaster.fromFeatures(featureCounties, fieldCountyJoin, gridNLCD, pathZoneCache)
+massBalance = MassBalance.MassBalance(zonesCounty)
+pastureN = massBalance.addComponent('Pasture N', RasterPastureNnoNull, gridNLCD.cellArea)
+pastureP = massBalance.addComponent('Pasture P', RasterPasturePnoNull, gridNLCD.cellArea)
+unrecoveredN = massBalance.addComponent('Unrecovered N', RasterUnrecNnoNull)
+unrecoveredP = massBalance.addComponent('Unrecovered P', RasterUnrecPnoNull)
+confinedN = massBalance.addComponent('Confined N', RasterAlgebra.Raster(RasterNManurenoNull), gridNLCD.cellArea)
+confinedP = massBalance.addComponent('Confined P', RasterAlgebra.Raster(RasterPManurenoNull), gridNLCD.cellArea)
+storeConfinedLoads = AttributeStore.fromTable(tableManureTotal, fieldCountyJoin, ['kgN_year', 'kgP_year'])
+storePastureLoads = AttributeStore.fromTable(tableFarmCountsPast, fieldLoadID, [fieldCountyJoin, fieldOperations, fieldNLoad, fieldPLoad])
+storePastureLoads['kgN_year'] = pd.to_numeric(storePastureLoads[fieldOperations]) * storePastureLoads[fieldNLoad]
+storePastureLoads['kgP_year'] = pd.to_numeric(storePastureLoads[fieldOperations]) * storePastureLoads[fieldPLoad]
+storePastureLoads = storePastureLoads.groupStats(fieldCountyJoin, [['kgN_year', 'SUM'], ['kgP_year', 'SUM']])
+massBalance.addCheck('Confined N', ['Confined N', 'Unrecovered N'], storeConfinedLoads, 'kgN_year')
+massBalance.addCheck('Confined P', ['Confined P', 'Unrecovered P'], storeConfinedLoads, 'kgP_year')
+massBalance.addCheck('Pasture N', ['Pasture N'], storePastureLoads, 'SUM_kgN_year')
+massBalance.addCheck('Pasture P', ['Pasture P'], storePastureLoads, 'SUM_kgP_year')
+del storeConfinedLoads, storePastureLoads
+# Dense and sparse layers are added together one band at a time (see RasterAlgebra.py)
+manureTotals = RasterAlgebra.evaluate([('NManureTotal', pastureN + unrecoveredN + confinedN, np.float32, -1),
+                                       ('PManureTotal', pastureP + unrecoveredP + confinedP, np.float32, -1)],
+                                      gridNLCD, workers=paramRasterWorkers, outFolder=pathRasterScratch,
+                                      onBand=massBalance.observe, keep=massBalance.nodes())
+# The report is written next to the total arrays
+massBalance.report(os.path.join(pathRasterScratch, 'Manure_Mass_Balance.csv'))
+del massBalance
+NManureTotal = RasterAlgebra.toRaster(manureTotals['NManureTotal'], gridNLCD, -1, spatialRefGLB, 'NManureTotal')
+PManureTotal = RasterAlgebra.toRaster(manureTotals['PManureTotal'], gridNLCD, -1, spatialRefGLB, 'PManureTotal')
+del manureTotals
\ No newline at end of file
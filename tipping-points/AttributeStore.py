@@ -0,0 +1,246 @@
+# In-memory attribute table for the manure model. The model script used to "replace CalculateField" by copying a
+# table to the scratch GDB, reading it with TableToNumPyArray, editing it in pandas, writing a temp CSV, importing
+# the CSV as a table, then JoinField-ing the result back and deleting the temp files. That's four disk writes and
+# two full table parses for every field update. An AttributeStore keeps the table as one NumPy array per field,
+# keyed by an ID field (OBJECTID, CtyID, BIN_CTY, Near_FID...), so computing a field is just an array operation and
+# joins are done with a sorted key lookup. Only the fields that changed are written back, with one UpdateCursor pass.
+#
+# arcpy is only imported by fromTable/toTable, everything else works with plain NumPy.
+
+import numpy as np
+
+
+class AttributeStore(object):
+
+    def __init__(self, columns, key):
+        # columns: dict (or list of (name, values) pairs) of equal length arrays. key: name of the ID field
+        self.columns = dict()
+        self.fieldOrder = list()
+        self.key = key
+        items = columns.items() if isinstance(columns, dict) else columns
+        for name, values in items:
+            self[name] = values
+        if key not in self.columns:
+            raise KeyError('Key field '+str(key)+' is not one of the columns')
+
+    #---------------------------------------------------------------------------
+    # Building stores
+    #---------------------------------------------------------------------------
+    @classmethod
+    def fromArray(cls, array, key):
+        # From a NumPy structured array, e.g. the output of arcpy.da.TableToNumPyArray
+        return cls([(name, array[name]) for name in array.dtype.names], key)
+
+    @classmethod
+    def fromDataFrame(cls, df, key):
+        return cls([(name, df[name].values) for name in df.columns], key)
+
+    @classmethod
+    def fromTable(cls, table, key, fields=None, where=None):
+        # Reads a feature class or table straight into memory with a SearchCursor. Unlike TableToNumPyArray,
+        # the cursor doesn't fail on Null values, so there is no need to copy the table to the scratch GDB first.
+        # Nulls become NaN in numeric fields and None in text fields.
+        import arcpy
+        if fields is None:
+            fields = [f.name for f in arcpy.ListFields(table) if f.type not in ('Geometry', 'Blob', 'Raster')]
+        fields = list(fields)
+        if key not in fields:
+            fields = [key]+fields
+        with arcpy.da.SearchCursor(table, fields, where) as cursor:
+            rows = [row for row in cursor]
+        columns = [(name, _column([row[i] for row in rows])) for i, name in enumerate(fields)]
+        return cls(columns, key)
+
+    #---------------------------------------------------------------------------
+    # Field access
+    #---------------------------------------------------------------------------
+    def __len__(self):
+        return len(self.columns[self.key])
+
+    def __contains__(self, name):
+        return name in self.columns
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def __setitem__(self, name, values):
+        # Adds or overwrites a field. Scalars are broadcast to every row, like AddField + CalculateField with a constant
+        values = np.asarray(values)
+        if self.columns:
+            nRows = len(self)
+            if values.ndim == 0:
+                values = np.repeat(values, nRows)
+            elif len(values) != nRows:
+                raise ValueError('Field '+str(name)+' has '+str(len(values))+' rows, table has '+str(nRows))
+        if name not in self.columns:
+            self.fieldOrder.append(name)
+        self.columns[name] = values
+
+    def fields(self):
+        return list(self.fieldOrder)
+
+    def update(self, name, values, where):
+        # Same as df.loc[where, name] = values. Creates the field (filled with NaN) if it doesn't exist yet
+        values = np.asarray(values)
+        if name not in self.columns:
+            self[name] = np.full(len(self), np.nan)
+        column = self.columns[name]
+        if values.ndim > 0 and len(values) == len(self):
+            values = values[where]
+        if column.dtype.kind in 'iub' and np.asarray(values).dtype.kind == 'f':
+            column = column.astype(np.float64)
+        column[where] = values
+        self.columns[name] = column
+
+    def deleteFields(self, names):
+        for name in names:
+            if name == self.key:
+                continue
+            if name in self.columns:
+                del self.columns[name]
+                self.fieldOrder.remove(name)
+
+    def select(self, where):
+        # New store with only the rows where 'where' is True (or the given row indices)
+        return AttributeStore([(name, self.columns[name][where]) for name in self.fieldOrder], self.key)
+
+    #---------------------------------------------------------------------------
+    # Keys and joins
+    #---------------------------------------------------------------------------
+    def lookup(self, keys, keyField=None):
+        # Row index in this store for each value in 'keys', -1 where the key is missing. If a key is repeated,
+        # the first row is used, which matches what JoinField does
+        keyField = keyField or self.key
+        own = self.columns[keyField]
+        keys = np.asarray(keys)
+        rows = np.full(len(keys), -1, dtype=np.int64)
+        if len(own) == 0:
+            return rows
+        order = np.argsort(own, kind='mergesort') # Stable, so the first of any repeated keys comes first
+        ownSorted = own[order]
+        pos = np.minimum(np.searchsorted(ownSorted, keys, side='left'), len(ownSorted)-1)
+        found = ownSorted[pos] == keys
+        rows[found] = order[pos[found]]
+        return rows
+
+    def join(self, other, fields=None, onField=None, otherField=None, prefixExisting=False):
+        # Keyed join of 'fields' from another store, the in-memory version of
+        # JoinField_management(self, onField, other, otherField, fields). Rows with no match get NaN
+        # (or None for text fields). Existing fields are overwritten unless prefixExisting is set, in which case
+        # the joined field gets a '_1' suffix like ArcGIS does.
+        onField = onField or self.key
+        otherField = otherField or other.key
+        if fields is None:
+            fields = [name for name in other.fieldOrder if name != otherField]
+        rows = other.lookup(self.columns[onField], otherField)
+        missing = rows < 0
+        for name in fields:
+            values = other.columns[name][np.where(missing, 0, rows)] if len(other) else np.full(len(self), np.nan)
+            if missing.any():
+                if values.dtype.kind in 'iub':
+                    values = values.astype(np.float64)
+                if values.dtype.kind == 'f':
+                    values[missing] = np.nan
+                else:
+                    values = values.astype(object)
+                    values[missing] = None
+            outName = name
+            if prefixExisting and name in self.columns:
+                outName = name+'_1'
+            self[outName] = values
+        return self
+
+    def groupStats(self, byField, statsFields):
+        # In-memory Statistics_analysis. statsFields is a list of [field, 'SUM'|'MEAN'|'MIN'|'MAX'|'COUNT'] pairs.
+        # Returns a new store keyed by byField with a FREQUENCY field and one <STAT>_<field> field per pair
+        groups, inverse = np.unique(self.columns[byField], return_inverse=True)
+        inverse = inverse.ravel()
+        frequency = np.bincount(inverse, minlength=len(groups))
+        out = AttributeStore([(byField, groups), ('FREQUENCY', frequency)], byField)
+        for field, stat in statsFields:
+            values = np.asarray(self.columns[field], dtype=np.float64)
+            stat = stat.upper()
+            if stat == 'SUM':
+                result = np.bincount(inverse, weights=np.nan_to_num(values), minlength=len(groups))
+            elif stat == 'COUNT':
+                result = np.bincount(inverse, weights=~np.isnan(values), minlength=len(groups))
+            elif stat == 'MEAN':
+                valid = ~np.isnan(values)
+                sums = np.bincount(inverse, weights=np.where(valid, values, 0), minlength=len(groups))
+                counts = np.bincount(inverse, weights=valid, minlength=len(groups))
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    result = sums/counts
+            elif stat in ('MIN', 'MAX'):
+                fill = np.inf if stat == 'MIN' else -np.inf
+                result = np.full(len(groups), fill)
+                ufunc = np.minimum if stat == 'MIN' else np.maximum
+                valid = ~np.isnan(values)
+                ufunc.at(result, inverse[valid], values[valid])
+                result[np.isinf(result)] = np.nan
+            else:
+                raise ValueError('Unsupported statistic '+stat)
+            out[stat+'_'+field] = result
+        return out
+
+    #---------------------------------------------------------------------------
+    # Output
+    #---------------------------------------------------------------------------
+    def toArray(self, fields=None):
+        fields = fields or self.fieldOrder
+        array = np.zeros(len(self), dtype=[(str(name), self.columns[name].dtype) for name in fields])
+        for name in fields:
+            array[name] = self.columns[name]
+        return array
+
+    def toDataFrame(self, fields=None):
+        import pandas as pd
+        fields = fields or self.fieldOrder
+        return pd.DataFrame(dict((name, self.columns[name]) for name in fields), columns=fields)
+
+    def toTable(self, table, fields, keyField=None):
+        # Writes 'fields' back to a feature class or table in a single UpdateCursor pass, matching rows on keyField
+        # (the store's key by default). Fields that don't exist yet are added. NaN is written as Null.
+        import arcpy
+        keyField = keyField or self.key
+        existing = set(f.name.upper() for f in arcpy.ListFields(table))
+        for name in fields:
+            if name.upper() not in existing:
+                arcpy.AddField_management(table, name, arcFieldType(self.columns[name].dtype))
+        keys = self.columns[self.key]
+        index = dict((_toPython(k), i) for i, k in enumerate(keys))
+        columns = [self.columns[name] for name in fields]
+        with arcpy.da.UpdateCursor(table, [keyField]+list(fields)) as cursor:
+            for row in cursor:
+                i = index.get(row[0])
+                if i is None:
+                    continue
+                cursor.updateRow([row[0]]+[_toPython(column[i]) for column in columns])
+
+
+def arcFieldType(dtype):
+    # ArcGIS field type for a NumPy dtype
+    dtype = np.dtype(dtype)
+    if dtype.kind == 'f':
+        return 'DOUBLE'
+    if dtype.kind in 'iub':
+        return 'LONG'
+    return 'TEXT'
+
+
+def _column(values):
+    # Turns a list of cursor values into an array. Numeric fields with Nulls become float with NaN
+    if any(v is None for v in values):
+        nonNull = [v for v in values if v is not None]
+        if nonNull and all(isinstance(v, (int, float, np.number)) for v in nonNull):
+            return np.array([np.nan if v is None else v for v in values], dtype=np.float64)
+        return np.array(values, dtype=object)
+    return np.array(values)
+
+
+def _toPython(value):
+    # NumPy scalar -> plain Python value for cursors. NaN -> None (Null)
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and value != value:
+        return None
+    return value
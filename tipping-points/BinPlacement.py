@@ -0,0 +1,141 @@
+# Places the farms of every animal bin (GMEID) across several processes. Bins only share read-only inputs (the
+# PlacementZones of FarmPlacement.py), so they can run in any order:
+#   - the zones are saved once to the scratch folder, and every worker memory-maps them
+#   - bins are split between workers so each gets about the same number of farms
+#   - each worker has its own scratch folder with its task files and results, so nothing is shared while they run
+#   - every bin has its own random stream seeded from (seed, stream, binID), so the farms are the same no matter
+#     how many workers are used or which worker gets which bin
+#   - results are merged back in bin order
+# Workers are separate Python processes running this file, not multiprocessing, because multiprocessing on Windows
+# re-runs the calling script in every worker and the manure model script isn't guarded by __main__.
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+import FarmPlacement
+import RunTrace
+
+
+def binRandomState(seed, stream, binID):
+    # Random stream for one bin. stream keeps e.g. confined and pasture bins with the same ID apart
+    return np.random.RandomState([int(seed), int(stream), int(binID)])
+
+
+def placeBins(zones, tasks, seed, stream=0, workers=1, scratchFolder=None, pythonExe=None, trace=None):
+    # tasks: list of (binID, zoneIDs, counts, requiredArea) - the arguments of PlacementZones.sample for each bin
+    # (requiredArea can be None). Returns a dict of binID -> PlacedPoints.
+    # With workers <= 1 (or no scratch folder) every bin is placed in this process, with the same random streams.
+    # trace: RunTrace.RunTrace that gets a 'placement bin' record per bin, timed in the process that placed it
+    if workers <= 1 or len(tasks) <= 1 or scratchFolder is None:
+        placed = dict()
+        for binID, zoneIDs, counts, requiredArea in tasks:
+            timer = trace.start('placement bin', binID=binID, stream=stream) if trace is not None else None
+            placed[binID] = zones.sample(zoneIDs, counts, requiredArea, binRandomState(seed, stream, binID))
+            if timer is not None:
+                timer.stop(farms=len(placed[binID]))
+        return placed
+    if pythonExe is None:
+        pythonExe = _pythonExe()
+    zonesFolder = os.path.join(scratchFolder, 'zones')
+    zones.save(zonesFolder)
+    workerScript = os.path.splitext(os.path.abspath(__file__))[0]+'.py'
+    processes = list()
+    failed = list()
+    try:
+        for w, taskIndices in enumerate(_balance(tasks, workers)):
+            if not taskIndices:
+                continue
+            workerFolder = os.path.join(scratchFolder, 'worker'+str(w))
+            if os.path.isdir(workerFolder):
+                shutil.rmtree(workerFolder)
+            os.makedirs(workerFolder)
+            for k in taskIndices:
+                binID, zoneIDs, counts, requiredArea = tasks[k]
+                np.savez(os.path.join(workerFolder, 'task_'+str(binID)+'.npz'), binID=binID, zoneIDs=np.asarray(zoneIDs),
+                         counts=np.asarray(counts, dtype=np.float64), hasRequiredArea=requiredArea is not None,
+                         requiredArea=np.zeros(0) if requiredArea is None else np.asarray(requiredArea, dtype=np.float64))
+            command = [pythonExe, workerScript, 'worker', workerFolder, zonesFolder, str(int(seed)), str(int(stream))]
+            processes.append((workerFolder, [tasks[k][0] for k in taskIndices], subprocess.Popen(command)))
+        # Every worker is waited for, so none is still writing to its folder when this returns or raises
+        for workerFolder, binIDs, process in processes:
+            if process.wait() != 0:
+                failed.append(workerFolder+' (code '+str(process.returncode)+')')
+    finally:
+        # Workers still running when this is cut short (a worker that couldn't be started, Ctrl+C) are stopped
+        for workerFolder, binIDs, process in processes:
+            if process.poll() is None:
+                process.terminate()
+                process.wait()
+    if failed:
+        raise RuntimeError('Placement workers failed: '+', '.join(failed))
+    # Merge step
+    placed = dict()
+    for workerFolder, binIDs, process in processes:
+        for binID in binIDs:
+            placed[binID] = _loadPlaced(os.path.join(workerFolder, 'placed_'+str(binID)+'.npz'))
+            if trace is not None:
+                with open(os.path.join(workerFolder, 'timing_'+str(binID)+'.json')) as f:
+                    timing = json.load(f)
+                trace.record('placement bin', timing.pop('wall'), timing.pop('cpu'), binID=binID, stream=stream,
+                             farms=len(placed[binID]), worker=workerFolder, **timing)
+    return placed
+
+
+def runWorker(workerFolder, zonesFolder, seed, stream):
+    # Places every bin with a task file in workerFolder
+    zones = FarmPlacement.PlacementZones.load(zonesFolder)
+    for name in sorted(os.listdir(workerFolder)):
+        if not (name.startswith('task_') and name.endswith('.npz')):
+            continue
+        task = np.load(os.path.join(workerFolder, name))
+        binID = task['binID'].item()
+        requiredArea = task['requiredArea'] if task['hasRequiredArea'] else None
+        started = time.time()
+        cpuStarted = RunTrace.cpuSeconds()
+        placed = zones.sample(task['zoneIDs'], task['counts'], requiredArea, binRandomState(seed, stream, binID))
+        np.savez(os.path.join(workerFolder, 'placed_'+str(binID)+'.npz'), x=placed.x, y=placed.y, request=placed.request,
+                 fullyExcluded=placed.fullyExcluded, missingZone=placed.missingZone)
+        # Timing of the bin for the caller's RunTrace
+        rss, peakRSS = RunTrace.memoryMB()
+        with open(os.path.join(workerFolder, 'timing_'+str(binID)+'.json'), 'w') as f:
+            json.dump({'wall': time.time()-started, 'cpu': RunTrace.cpuSeconds()-cpuStarted, 'started': started,
+                       'rssMB': rss, 'peakRSSMB': peakRSS}, f)
+
+
+def _loadPlaced(path):
+    data = np.load(path)
+    return FarmPlacement.PlacedPoints(data['x'], data['y'], data['request'], data['fullyExcluded'], data['missingZone'])
+
+
+def _balance(tasks, workers):
+    # Splits the tasks between workers, biggest bins first, always to the worker with the fewest farms so far
+    sizes = [np.nansum(np.asarray(counts, dtype=np.float64)) for binID, zoneIDs, counts, requiredArea in tasks]
+    loads = np.zeros(workers)
+    assignment = [list() for w in range(workers)]
+    for k in np.argsort(sizes, kind='mergesort')[::-1]:
+        w = int(np.argmin(loads))
+        assignment[w].append(int(k))
+        loads[w] += sizes[k]
+    return assignment
+
+
+def _pythonExe():
+    # Inside ArcMap sys.executable is ArcMap.exe, so look for python.exe next to the Python install first
+    for name in ('python.exe', 'python'):
+        path = os.path.join(sys.exec_prefix, name)
+        if os.path.isfile(path):
+            return path
+    return sys.executable
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 6 and sys.argv[1] == 'worker':
+        runWorker(sys.argv[2], sys.argv[3], int(sys.argv[4]), int(sys.argv[5]))
+    else:
+        sys.exit('usage: python BinPlacement.py worker <worker folder> <zones folder> <seed> <stream>')
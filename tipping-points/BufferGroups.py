@@ -0,0 +1,184 @@
+# Groups overlapping manure buffers without building any polygons. Buffers are circles (farm point + radius), so two
+# buffers touch when the distance between the farms is <= r1 + r2. Touching pairs are found with a KD-tree and joined
+# into groups with union-find, which replaces the Near_analysis -> select NEAR_DIST = 0 -> Dissolve -> SimplifyPolygon
+# -> Dissolve -> MultipartToSinglepart -> SelectLayerByLocation/DeleteFeatures/Merge chain in the manure model.
+# That chain was freezing from memory use; this handles tens of thousands of farms in well under a second.
+#
+# Group IDs are numbered 1..nGroups, so they can be written to the farms as Near_FID and the buffers can be
+# dissolved by that field directly in Buffer_analysis.
+#
+# scipy's cKDTree is used if it's installed (it isn't in every ArcGIS Python). Without it, touching pairs are found
+# by sorting the farms along x and sweeping.
+
+import numpy as np
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+
+
+def groupCircles(x, y, radii, useTree=None):
+    # Group ID (1..nGroups) for each circle. Circles that touch or overlap, directly or through a chain of other
+    # circles, get the same ID. Groups are numbered in order of their lowest input row.
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    radii = np.nan_to_num(np.asarray(radii, dtype=np.float64))
+    if len(x) == 0:
+        return np.zeros(0, dtype=np.int64)
+    i, j = touchingPairs(x, y, radii, useTree)
+    roots = unionFind(len(x), i, j)
+    # Renumber roots to 1..nGroups. The root of a group is its lowest row, so np.unique keeps that order
+    _, groups = np.unique(roots, return_inverse=True)
+    return groups.ravel() + 1
+
+
+def touchingPairs(x, y, radii, useTree=None):
+    # Index pairs (i < j) of circles with distance <= r_i + r_j
+    if useTree is None:
+        useTree = cKDTree is not None
+    if useTree:
+        i, j = _pairsTree(x, y, radii)
+    else:
+        i, j = _pairsSweep(x, y, radii)
+    # 1e-9 m of slack so circles that exactly touch aren't lost to rounding, like NEAR_DIST = 0
+    touching = np.hypot(x[i]-x[j], y[i]-y[j]) <= radii[i] + radii[j] + 1e-9
+    return i[touching], j[touching]
+
+
+def _pairsTree(x, y, radii):
+    # Candidate pairs from a KD-tree. Farms are split into radius classes (powers of 2) so that a handful of huge
+    # buffers don't make every query search out to the largest radius.
+    points = np.column_stack((x, y))
+    classes = np.floor(np.log2(np.maximum(radii, 1.))).astype(np.int64)
+    piecesI = list()
+    piecesJ = list()
+    classIDs = np.unique(classes)
+    members = dict((c, np.nonzero(classes == c)[0]) for c in classIDs)
+    trees = dict((c, cKDTree(points[members[c]])) for c in classIDs)
+    for a in classIDs:
+        idxA = members[a]
+        maxRadiusA = radii[idxA].max()
+        for b in classIDs:
+            if b < a:
+                continue
+            idxB = members[b]
+            maxRadiusB = radii[idxB].max()
+            if a == b:
+                pairs = trees[a].query_pairs(2*maxRadiusA, output_type='ndarray')
+                pi = idxA[pairs[:, 0]]
+                pj = idxA[pairs[:, 1]]
+            else:
+                near = trees[a].sparse_distance_matrix(trees[b], maxRadiusA + maxRadiusB, output_type='ndarray')
+                pi = idxA[near['i']]
+                pj = idxB[near['j']]
+            piecesI.append(np.minimum(pi, pj))
+            piecesJ.append(np.maximum(pi, pj))
+    if not piecesI:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    return np.concatenate(piecesI), np.concatenate(piecesJ)
+
+
+def _pairsSweep(x, y, radii):
+    # Candidate pairs from a sweep along x: farm j can only touch farm i (sorted by x) if x_j - x_i <= r_i + maxRadius
+    order = np.argsort(x, kind='mergesort')
+    xs = x[order]
+    reach = np.searchsorted(xs, xs + radii[order] + radii.max(), side='right')
+    piecesI = list()
+    piecesJ = list()
+    for k in range(len(xs)):
+        if reach[k] <= k+1:
+            continue
+        others = np.arange(k+1, reach[k])
+        piecesI.append(np.repeat(order[k], len(others)))
+        piecesJ.append(order[others])
+    if not piecesI:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    pi = np.concatenate(piecesI)
+    pj = np.concatenate(piecesJ)
+    return np.minimum(pi, pj), np.maximum(pi, pj)
+
+
+def unionFind(n, i, j):
+    # Vectorized union-find over n items joined by the pairs (i, j). Returns the root of each item, which is the
+    # lowest index in its group. Each pass hooks the larger root of every pair onto the smaller one, then
+    # compresses paths by pointer jumping until every item points straight at its root.
+    parent = np.arange(n, dtype=np.int64)
+    i = np.asarray(i, dtype=np.int64)
+    j = np.asarray(j, dtype=np.int64)
+    while len(i):
+        rootI = parent[i]
+        rootJ = parent[j]
+        differ = rootI != rootJ
+        if not differ.any():
+            break
+        low = np.minimum(rootI[differ], rootJ[differ])
+        high = np.maximum(rootI[differ], rootJ[differ])
+        np.minimum.at(parent, high, low)
+        while True:
+            grandparent = parent[parent]
+            if (grandparent == parent).all():
+                break
+            parent = grandparent
+        # Pairs whose ends are already in the same group never need to be looked at again
+        i = i[differ]
+        j = j[differ]
+    return parent
+
+
+def groupSizes(groups):
+    # Number of farms in each farm's group
+    counts = np.bincount(groups)
+    return counts[groups]
+
+
+class GroupAreaCache(object):
+    # Clipped area of each buffer group, kept between iterations of the convergence loop. Late in the loop only a few
+    # hundred farms still change radius, but every group used to be buffered and clipped again. A group's clipped area
+    # only depends on which farms are in it and their radii, so that is what the cache is keyed on (group IDs are
+    # renumbered every time groupCircles runs, so they can't be used). Groups whose key was seen in the last iteration
+    # reuse that area; only farms in the other ("dirty") groups need to be buffered and clipped again.
+
+    def __init__(self):
+        self.areas = dict()
+        self.keys = list()
+        self.groups = np.zeros(0, dtype=np.int64)
+        self.dirty = np.zeros(0, dtype=bool)
+        self.reused = 0 # Number of groups whose area came from the cache in the last iteration
+
+    def dirtyFarms(self, ids, groups, radii):
+        # True for farms whose group has to be buffered and clipped again. Call record() with the clip results after
+        ids = np.asarray(ids, dtype=np.int64)
+        groups = np.asarray(groups, dtype=np.int64)
+        radii = np.asarray(radii, dtype=np.float64)
+        nGroups = int(groups.max()) if len(groups) else 0
+        order = np.lexsort((ids, groups))
+        starts = np.searchsorted(groups[order], np.arange(1, nGroups+2))
+        members = ids[order]
+        memberRadii = radii[order]
+        self.keys = [None]+[members[starts[g]:starts[g+1]].tobytes()+memberRadii[starts[g]:starts[g+1]].tobytes()
+                            for g in range(nGroups)]
+        self.groups = groups
+        self.dirty = np.array([False]+[key not in self.areas for key in self.keys[1:]], dtype=bool)
+        self.reused = nGroups - int(self.dirty.sum())
+        # Forget groups that no longer exist, so the cache doesn't grow with every iteration
+        self.areas = dict((key, self.areas[key]) for key in self.keys[1:] if key in self.areas)
+        return self.dirty[groups]
+
+    def record(self, clipGroups, clipAreas):
+        # Clipped areas of the dirty groups (group ID and area of every clipped polygon). Dirty groups with no
+        # clipped polygon get NaN, the same as the Null F_AREA a JoinField would give them
+        clipGroups = np.asarray(clipGroups, dtype=np.int64)
+        clipAreas = np.nan_to_num(np.asarray(clipAreas, dtype=np.float64))
+        nGroups = len(self.keys)
+        sums = np.bincount(clipGroups, weights=clipAreas, minlength=nGroups)[:nGroups]
+        found = np.bincount(clipGroups, minlength=nGroups)[:nGroups] > 0
+        for g in np.nonzero(self.dirty)[0]:
+            self.areas[self.keys[g]] = sums[g] if found[g] else np.nan
+        self.dirty[:] = False
+
+    def farmAreas(self):
+        # Clipped area of each farm's group, in the order the farms were given to dirtyFarms()
+        groupAreas = np.array([np.nan]+[self.areas.get(key, np.nan) for key in self.keys[1:]])
+        return groupAreas[self.groups]
+
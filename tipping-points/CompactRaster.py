@@ -0,0 +1,159 @@
+# Compact storage for the model's working rasters, so the whole basin fits in memory on one machine. A 30 m raster of
+# the Great Lakes rectangle has over a billion cells; as float64 (what arcpy.RasterToNumPyArray gives for the focal
+# area) that is ~10 GB a layer. Each kind of layer is kept in the narrowest type that holds it exactly:
+#   - masks (ag cells, pasture cells): one bit per cell, as a PackedMask
+#   - focal sums: uint32 cell counts, with the area of a cell as a scale in the metadata (FocalArea = count*scale),
+#     and 2**32-1 for NoData
+#   - rates (kg/m^2): float32, NaN for NoData
+# Every layer is a .npy file, memory-mapped when it's loaded, with a .json file of metadata (kind, grid, scale) next to
+# it. load() gives back a RasterAlgebra expression node that decodes to the real values one band at a time, so a
+# layer can go straight into RasterAlgebra.evaluate, FocalSum or FarmPlacement in place of the raster it replaces.
+# Counts and rates can also be sliced (layer[row0:row1, col0:col1]) to get decoded values.
+
+import json
+import os
+
+import numpy as np
+
+import RasterAlgebra
+from PackedMask import PackedMask
+from RasterGrid import RasterGrid
+
+noDataCount = 2**32-1
+
+
+class ScaledCounts(RasterAlgebra.Expr):
+    # uint32 counts decoded as count*scale (e.g. number of ag cells in a circle -> ag area in m^2)
+
+    def __init__(self, counts, grid, scale):
+        self.counts = counts
+        self.grid = grid
+        self.scale = scale
+
+    @property
+    def shape(self):
+        return self.grid.shape
+
+    @property
+    def nbytes(self):
+        return self.counts.nbytes
+
+    def band(self, row0, row1, noDataValue=np.nan):
+        # Decoded rows row0:row1 with NoData as noDataValue
+        values = self[row0:row1, :]
+        values[np.isnan(values)] = noDataValue
+        return values
+
+    def __getitem__(self, key):
+        counts = np.asarray(self.counts[key])
+        values = counts*float(self.scale)
+        values[counts == noDataCount] = np.nan
+        return values
+
+    def _evaluate(self, band, memo):
+        _checkGrid(self.grid, memo['grid'])
+        counts = np.asarray(self.counts[band[0]:band[1]])
+        return counts*float(self.scale), counts != noDataCount
+
+
+class Rates(RasterAlgebra.Expr):
+    # float32 values, NaN for NoData
+
+    def __init__(self, values, grid):
+        self.values = values
+        self.grid = grid
+
+    @property
+    def shape(self):
+        return self.grid.shape
+
+    @property
+    def nbytes(self):
+        return self.values.nbytes
+
+    def band(self, row0, row1, noDataValue=np.nan):
+        values = self[row0:row1, :]
+        values[np.isnan(values)] = noDataValue
+        return values
+
+    def __getitem__(self, key):
+        return np.array(self.values[key])
+
+    def _evaluate(self, band, memo):
+        _checkGrid(self.grid, memo['grid'])
+        values = np.asarray(self.values[band[0]:band[1]])
+        return values, ~np.isnan(values)
+
+
+def saveMask(path, mask, grid, bandRows=1024):
+    # mask: 2D array, PackedMask or RasterAlgebra expression (cells that are nonzero and not NoData are in the mask)
+    bits = _create(path, np.uint8, (grid.nRows, (grid.nCols+7)//8), grid, 'mask')
+    if isinstance(mask, PackedMask):
+        bits[:] = mask.bits
+    else:
+        if not isinstance(mask, RasterAlgebra.Expr):
+            mask = RasterAlgebra.Raster(np.asarray(mask))
+        PackedMask.fromExpr(mask, grid, bandRows, bits)
+    bits.flush()
+    del bits
+    return load(path)
+
+
+def createCounts(path, grid, scale):
+    # Empty uint32 count layer to be filled in place, e.g. as the out array of FocalSum.focalSumTiled. Set NoData
+    # cells to noDataCount
+    return _create(path, np.uint32, grid.shape, grid, 'counts', {'scale': scale})
+
+
+def createRates(path, grid):
+    # Empty float32 rate layer to be filled in place, NaN for NoData
+    return _create(path, np.float32, grid.shape, grid, 'rates')
+
+
+def saveRates(path, values, grid, bandRows=1024):
+    # values: 2D array or RasterAlgebra expression, stored as float32 with NaN where it is NoData
+    if not isinstance(values, RasterAlgebra.Expr):
+        values = RasterAlgebra.Raster(np.asarray(values))
+    out = createRates(path, grid)
+    for row0 in range(0, grid.nRows, bandRows):
+        row1 = min(row0+bandRows, grid.nRows)
+        bandValues, valid = values.evaluateBand((row0, row1), {'grid': grid})
+        # Assignment broadcasts constants to the whole band
+        out[row0:row1] = bandValues if valid is None else np.where(valid, bandValues, np.nan)
+    out.flush()
+    del out
+    return load(path)
+
+
+def load(path, mmapMode='r'):
+    with open(_infoPath(path)) as f:
+        info = json.load(f)
+    xMin, yMax, cellSize, nRows, nCols = info['grid']
+    grid = RasterGrid(xMin, yMax, cellSize, int(nRows), int(nCols))
+    array = np.load(path, mmap_mode=mmapMode)
+    if info['kind'] == 'mask':
+        return PackedMask(array, grid)
+    if info['kind'] == 'counts':
+        return ScaledCounts(array, grid, info['scale'])
+    return Rates(array, grid)
+
+
+def _create(path, dtype, shape, grid, kind, extra=None):
+    folder = os.path.dirname(path)
+    if folder and not os.path.isdir(folder):
+        os.makedirs(folder)
+    info = {'kind': kind, 'dtype': np.dtype(dtype).name,
+            'grid': [grid.xMin, grid.yMax, grid.cellSize, grid.nRows, grid.nCols]}
+    info.update(extra or {})
+    with open(_infoPath(path), 'w') as f:
+        json.dump(info, f)
+    return np.lib.format.open_memmap(path, 'w+', dtype, shape)
+
+
+def _infoPath(path):
+    return os.path.splitext(path)[0]+'.json'
+
+
+def _checkGrid(grid, other):
+    if not grid.sameAs(other):
+        raise ValueError('Stored layer is on a different grid than the one being evaluated')
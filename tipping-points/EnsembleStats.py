@@ -0,0 +1,85 @@
+# Per-cell statistics of an ensemble of model runs (e.g. one per farm placement seed, see RunEnsemble.py) without
+# keeping every run's raster: each realization is added band by band with Welford's algorithm to running memory-mapped
+# arrays of the count, mean and sum of squared differences of every cell, plus a count of the realizations above each
+# exceedance threshold. Memory and disk use are the same for 5 realizations as for 500, and a band of a realization
+# only has to be read once.
+#
+# save() writes the mean, variance, standard deviation and the probability of exceeding each threshold as float32
+# rate layers (see CompactRaster.py), NaN where a cell had no valid value in any realization.
+
+import os
+
+import numpy as np
+
+import CompactRaster
+
+
+class CellStats(object):
+
+    def __init__(self, folder, grid, thresholds=(), bandRows=1024):
+        # folder: where the running arrays are kept. thresholds: values to count exceedances of (value > threshold)
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        self.folder = folder
+        self.grid = grid
+        self.thresholds = list(thresholds)
+        self.bandRows = bandRows
+        self.realizations = 0
+        self.count = self._array('Count', np.uint32)
+        self.mean = self._array('Mean', np.float64)
+        self.m2 = self._array('M2', np.float64)
+        self.exceed = [self._array('Exceed_'+str(i), np.uint32) for i in range(len(self.thresholds))]
+
+    def _array(self, name, dtype):
+        array = np.lib.format.open_memmap(os.path.join(self.folder, name+'.npy'), 'w+', dtype, self.grid.shape)
+        for row0 in range(0, self.grid.nRows, self.bandRows):
+            array[row0:row0+self.bandRows] = 0
+        return array
+
+    def add(self, values, noDataValue=-1):
+        # Adds one realization: a 2D array (or memmap, e.g. NManureTotal.npy) on the grid, or a RasterAlgebra layer
+        # with band() like CompactRaster.Rates. NoData and NaN cells are left out of that cell's statistics
+        if values.shape != self.grid.shape:
+            raise ValueError('Realization is not on the ensemble grid')
+        for row0 in range(0, self.grid.nRows, self.bandRows):
+            row1 = min(row0+self.bandRows, self.grid.nRows)
+            if hasattr(values, 'band'):
+                band = np.asarray(values.band(row0, row1), dtype=np.float64)
+            else:
+                band = np.asarray(values[row0:row1], dtype=np.float64)
+            valid = ~np.isnan(band)
+            if noDataValue is not None:
+                valid &= band != noDataValue
+            count = self.count[row0:row1] + valid
+            mean = np.asarray(self.mean[row0:row1])
+            delta = np.where(valid, band-mean, 0.)
+            mean = mean + delta/np.maximum(count, 1)
+            self.m2[row0:row1] += np.where(valid, delta*(band-mean), 0.)
+            self.mean[row0:row1] = mean
+            self.count[row0:row1] = count
+            for threshold, exceed in zip(self.thresholds, self.exceed):
+                exceed[row0:row1] += valid & (band > threshold)
+        self.realizations += 1
+
+    def save(self, prefix):
+        # Writes <prefix>_Mean, _Variance (sample), _StdDev and _Exceed_<threshold> (fraction of the cell's valid
+        # realizations above it) layers next to each other. Returns a dict of name -> path
+        paths = dict()
+        names = ['Mean', 'Variance', 'StdDev'] + ['Exceed_'+str(threshold) for threshold in self.thresholds]
+        for name in names:
+            paths[name] = prefix+'_'+name+'.npy'
+        outs = dict((name, CompactRaster.createRates(paths[name], self.grid)) for name in names)
+        for row0 in range(0, self.grid.nRows, self.bandRows):
+            row1 = min(row0+self.bandRows, self.grid.nRows)
+            count = np.asarray(self.count[row0:row1], dtype=np.float64)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                variance = np.where(count > 1, self.m2[row0:row1]/(count-1), np.nan)
+                outs['Mean'][row0:row1] = np.where(count > 0, self.mean[row0:row1], np.nan)
+                outs['Variance'][row0:row1] = variance
+                outs['StdDev'][row0:row1] = np.sqrt(variance)
+                for threshold, exceed in zip(self.thresholds, self.exceed):
+                    outs['Exceed_'+str(threshold)][row0:row1] = np.where(count > 0, exceed[row0:row1]/count, np.nan)
+        for out in outs.values():
+            out.flush()
+        del outs
+        return paths
@@ -0,0 +1,254 @@
+# Random placement of farm points for the manure model, replacing GME's genrandompnts. GME was run five times per
+# animal bin on 45-county slices, with a second thread pressing Enter to get past an error dialog, and it only runs
+# on ArcGIS 10.3 or older. Here the available cells are read from rasters instead:
+#   - a zone raster with the county ID (CtyID) of every cell where farms can go (ag cells, or pasture cells)
+#   - optionally the focal area raster, for the exclusion test: a farm can't be placed on a cell whose neighborhood
+#     has less fertilizable area than the farm needs (Req_Area > FocalArea)
+# Each farm is put on a cell drawn uniformly from its county's available cells, at a uniform random spot inside the
+# cell, so the points are uniform over the available area like GME's. Counties where every cell is excluded get their
+# farms placed ignoring the exclusion and are reported back, since the model treats those as point sources.
+#
+# Available cells are kept grouped by county (CSR style): cells[offsets[k]:offsets[k+1]] are the flat cell indices
+# for county zoneIDs[k], with the focal area of each cell in focal[...] alongside. Within a county the cells are sorted
+# by focal area, so the cells left after the exclusion test are always the end of the county's slice, and the number
+# of excluded cells for any required area is a binary search (excludedCells). That answers the exclusion test for
+# every bin and county in one call, instead of rasterizing Req_Area and polygonizing Con(Required_Area > FocalArea)
+# for each bin.
+
+import os
+
+import numpy as np
+
+from AttributeStore import arcFieldType
+
+
+class PlacementZones(object):
+
+    def __init__(self, zoneIDs, offsets, cells, focal, grid):
+        self.zoneIDs = np.asarray(zoneIDs)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.cells = cells
+        self.focal = focal
+        self.grid = grid
+
+    @classmethod
+    def fromArrays(cls, zones, grid, focal=None, noDataZone=0):
+        # zones: 2D array of county IDs, noDataZone where nothing can be placed. focal: 2D focal area array or None
+        zones = np.asarray(zones)
+        flat = np.flatnonzero(zones.ravel() != noDataZone)
+        cellZones = zones.ravel()[flat]
+        cellFocal = None if focal is None else np.asarray(focal).ravel()[flat]
+        return cls._grouped(flat, cellZones, cellFocal, grid)
+
+    @classmethod
+    def fromRasters(cls, zoneRaster, focalRaster=None, bandRows=1024):
+        # Reads the zone raster (and the focal area raster over the same grid) in bands of rows, keeping only the
+        # cells that are in a county, so the whole raster is never in memory at once. focalRaster can also be a
+        # stored layer on the same grid (see CompactRaster.py), which is decoded band by band
+        import arcpy
+        from RasterGrid import RasterGrid
+        grid = RasterGrid.fromRaster(zoneRaster)
+        focalStored = hasattr(focalRaster, 'band')
+        if focalStored and not grid.sameAs(focalRaster.grid):
+            raise ValueError('The focal area layer is on a different grid than the zone raster')
+        flatPieces = list()
+        zonePieces = list()
+        focalPieces = list()
+        for row0 in range(0, grid.nRows, bandRows):
+            row1 = min(row0+bandRows, grid.nRows)
+            band = grid.window(row0, row1, 0, grid.nCols)
+            zones = arcpy.RasterToNumPyArray(zoneRaster, band.lowerLeft(), band.nCols, band.nRows, 0)
+            rows, cols = np.nonzero(zones)
+            flatPieces.append(grid.flatIndex(rows+row0, cols))
+            zonePieces.append(zones[rows, cols])
+            if focalRaster is not None:
+                if focalStored:
+                    focal = focalRaster.band(row0, row1, -1)
+                else:
+                    focal = arcpy.RasterToNumPyArray(focalRaster, band.lowerLeft(), band.nCols, band.nRows, -1)
+                focalPieces.append(focal[rows, cols])
+        flat = np.concatenate(flatPieces)
+        cellZones = np.concatenate(zonePieces)
+        cellFocal = np.concatenate(focalPieces) if focalRaster is not None else None
+        return cls._grouped(flat, cellZones, cellFocal, grid)
+
+    @classmethod
+    def _grouped(cls, flat, cellZones, cellFocal, grid):
+        if cellFocal is None:
+            order = np.argsort(cellZones, kind='mergesort')
+        else:
+            order = np.lexsort((cellFocal, cellZones))
+        zoneIDs, starts = np.unique(cellZones[order], return_index=True)
+        offsets = np.append(starts, len(order)).astype(np.int64)
+        # Flat indices fit in 32 bits for any grid up to ~4 billion cells, which halves the memory
+        indexType = np.uint32 if grid.nRows*grid.nCols < 2**32 else np.int64
+        cells = flat[order].astype(indexType)
+        focal = None if cellFocal is None else cellFocal[order].astype(np.float32)
+        return cls(zoneIDs, offsets, cells, focal, grid)
+
+    def save(self, folder):
+        # One .npy file per array, so load() can memory-map them instead of reading everything in
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        np.save(os.path.join(folder, 'zoneIDs.npy'), self.zoneIDs)
+        np.save(os.path.join(folder, 'offsets.npy'), self.offsets)
+        np.save(os.path.join(folder, 'cells.npy'), self.cells)
+        if self.focal is not None:
+            np.save(os.path.join(folder, 'focal.npy'), self.focal)
+        elif os.path.exists(os.path.join(folder, 'focal.npy')):
+            os.remove(os.path.join(folder, 'focal.npy'))
+        grid = self.grid
+        np.save(os.path.join(folder, 'grid.npy'), np.array([grid.xMin, grid.yMax, grid.cellSize, grid.nRows, grid.nCols]))
+
+    @classmethod
+    def load(cls, folder, mmapMode='r'):
+        from RasterGrid import RasterGrid
+        xMin, yMax, cellSize, nRows, nCols = np.load(os.path.join(folder, 'grid.npy'))
+        focalPath = os.path.join(folder, 'focal.npy')
+        focal = np.load(focalPath, mmap_mode=mmapMode) if os.path.exists(focalPath) else None
+        return cls(np.load(os.path.join(folder, 'zoneIDs.npy')), np.load(os.path.join(folder, 'offsets.npy')),
+                   np.load(os.path.join(folder, 'cells.npy'), mmap_mode=mmapMode), focal,
+                   RasterGrid(xMin, yMax, cellSize, int(nRows), int(nCols)))
+
+    def __len__(self):
+        return len(self.zoneIDs)
+
+    def counts(self):
+        # Number of cells in each county
+        return np.diff(self.offsets)
+
+    def zoneIndex(self, zoneIDs):
+        # Position of each county ID in self.zoneIDs, -1 for counties with no cells
+        zoneIDs = np.asarray(zoneIDs)
+        pos = np.minimum(np.searchsorted(self.zoneIDs, zoneIDs), max(len(self.zoneIDs)-1, 0))
+        found = (self.zoneIDs[pos] == zoneIDs) if len(self.zoneIDs) else np.zeros(len(zoneIDs), dtype=bool)
+        return np.where(found, pos, -1)
+
+    def excludedCells(self, zoneIDs, requiredArea):
+        # Number of cells of county zoneIDs[...] with a focal area below requiredArea[...]. The two can be any shapes
+        # that broadcast together, e.g. a column of county IDs against a bins x counties table of required areas.
+        # Every pair is binary searched at once, one vectorized step per halving of the biggest county. Missing
+        # counties and NaN required areas give 0
+        zoneIDs, requiredArea = np.broadcast_arrays(np.asarray(zoneIDs), np.asarray(requiredArea, dtype=np.float64))
+        shape = zoneIDs.shape
+        if self.focal is None:
+            return np.zeros(shape, dtype=np.int64)
+        index = self.zoneIndex(zoneIDs.ravel())
+        found = index >= 0
+        low = np.where(found, self.offsets[np.maximum(index, 0)], 0)
+        high = np.where(found, self.offsets[np.maximum(index, 0)+1], 0)
+        start = low.copy()
+        required = requiredArea.ravel()
+        while True:
+            active = np.flatnonzero(low < high)
+            if len(active) == 0:
+                break
+            mid = (low[active] + high[active]) // 2
+            below = self.focal[mid] < required[active]
+            low[active[below]] = mid[below] + 1
+            high[active[~below]] = mid[~below]
+        return (low - start).reshape(shape)
+
+    def exclusion(self, zoneIDs, requiredArea):
+        # Fraction of each county's cells that are excluded for the required area, and whether all of them are
+        # (NaN and False for counties with no cells). Same broadcasting as excludedCells
+        excluded = self.excludedCells(zoneIDs, requiredArea)
+        index = self.zoneIndex(np.ravel(zoneIDs))
+        total = np.where(index >= 0, self.counts()[np.maximum(index, 0)], 0).reshape(np.shape(zoneIDs))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            fraction = excluded/total.astype(np.float64)
+        fraction = np.where(total > 0, fraction, np.nan)
+        return fraction, (total > 0) & (excluded == total)
+
+    def sample(self, zoneIDs, counts, requiredArea=None, rng=None):
+        # Places counts[k] points in county zoneIDs[k] for every request k. requiredArea[k] (optional) excludes
+        # cells with a focal area below it. Returns a PlacedPoints with the coordinates and the request each
+        # point belongs to
+        if rng is None:
+            rng = np.random.RandomState()
+        counts = np.nan_to_num(np.asarray(counts, dtype=np.float64)).round().astype(np.int64)
+        counts = np.maximum(counts, 0)
+        index = self.zoneIndex(zoneIDs)
+        if requiredArea is not None and self.focal is not None:
+            excluded = self.excludedCells(zoneIDs, requiredArea)
+        else:
+            excluded = np.zeros(len(counts), dtype=np.int64)
+        picked = list()
+        requests = list()
+        fullyExcluded = np.zeros(len(counts), dtype=bool)
+        for k in range(len(counts)):
+            if index[k] < 0 or counts[k] == 0:
+                continue
+            start = self.offsets[index[k]]
+            end = self.offsets[index[k]+1]
+            if start + excluded[k] < end:
+                cells = self.cells[start+excluded[k]:end]
+            else:
+                # No cell in the county has enough area around it - place the farms anyway
+                cells = self.cells[start:end]
+                fullyExcluded[k] = True
+            picked.append(cells[rng.randint(0, len(cells), counts[k])])
+            requests.append(np.repeat(k, counts[k]))
+        if picked:
+            flat = np.concatenate(picked).astype(np.int64)
+            request = np.concatenate(requests)
+        else:
+            flat = np.zeros(0, dtype=np.int64)
+            request = np.zeros(0, dtype=np.int64)
+        rows = flat // self.grid.nCols
+        cols = flat % self.grid.nCols
+        # Uniform spot inside each cell
+        x, y = self.grid.cellCenters(rows, cols)
+        x = x + (rng.random_sample(len(x))-0.5)*self.grid.cellSize
+        y = y + (rng.random_sample(len(y))-0.5)*self.grid.cellSize
+        return PlacedPoints(x, y, request, fullyExcluded, index < 0)
+
+
+class PlacedPoints(object):
+    # Points from one PlacementZones.sample call. request[i] is the row of the request point i was placed for
+
+    def __init__(self, x, y, request, fullyExcluded, missingZone):
+        self.x = x
+        self.y = y
+        self.request = request
+        self.fullyExcluded = fullyExcluded
+        self.missingZone = missingZone
+
+    def __len__(self):
+        return len(self.x)
+
+    def pointIDs(self):
+        # Point number within each request, starting at 1 like GME's PNTID
+        if len(self.request) == 0:
+            return np.zeros(0, dtype=np.int64)
+        starts = np.flatnonzero(np.r_[True, self.request[1:] != self.request[:-1]])
+        runLengths = np.diff(np.append(starts, len(self.request)))
+        return np.arange(len(self.request)) - np.repeat(starts, runLengths) + 1
+
+
+def concatenate(placed):
+    # One PlacedPoints from several, e.g. from every animal bin. request, fullyExcluded and missingZone are
+    # renumbered so they index into the concatenated requests
+    shift = np.cumsum([0]+[len(p.fullyExcluded) for p in placed[:-1]])
+    return PlacedPoints(np.concatenate([p.x for p in placed]), np.concatenate([p.y for p in placed]),
+                        np.concatenate([p.request + s for p, s in zip(placed, shift)]),
+                        np.concatenate([p.fullyExcluded for p in placed]),
+                        np.concatenate([p.missingZone for p in placed]))
+
+
+def writePoints(featureClass, spatialReference, x, y, fields):
+    # Writes points to a new point feature class in the current workspace (overwriting it). fields is a list of
+    # (name, values) pairs, one value per point
+    import arcpy
+    if arcpy.Exists(featureClass):
+        arcpy.Delete_management(featureClass)
+    arcpy.CreateFeatureclass_management(arcpy.env.workspace, featureClass, 'POINT', '', 'DISABLED', 'DISABLED', spatialReference)
+    columns = list()
+    for name, values in fields:
+        values = np.asarray(values)
+        arcpy.AddField_management(featureClass, name, arcFieldType(values.dtype))
+        columns.append(values)
+    with arcpy.da.InsertCursor(featureClass, ['SHAPE@XY']+[name for name, values in fields]) as cursor:
+        for i in range(len(x)):
+            cursor.insertRow([(float(x[i]), float(y[i]))]+[column[i].item() if isinstance(column[i], np.generic) else column[i]
+                                                             for column in columns])
@@ -0,0 +1,203 @@
+# Circular focal sums of a 0/1 mask raster using only NumPy. This replaces
+# arcpy.sa.FocalStatistics(mask, NbrCircle(radius,'CELL'), 'SUM') for the manure model, which takes hours
+# at a 667 cell radius because every output cell looks at ~1.4 million neighbors.
+#
+# Two methods are available and both return exact integer cell counts:
+#   'runs' - the circle is split into one horizontal run per row offset, and each run is summed with a
+#            row-wise cumulative sum (2 lookups per row of the circle). Integer math, always exact.
+#   'fft'  - convolution of the mask with the circle kernel through numpy.fft, rounded back to integers.
+#            Much faster for big radii, and exact after rounding since counts are far below 2**52.
+# Large rasters are processed tile by tile. Each tile is read with a halo equal to the radius, so tiled
+# output is identical to running on the whole raster at once. Anything that supports 2D slicing
+# (numpy arrays, numpy memmaps) can be passed in as the mask or the output.
+#
+# Matching ArcGIS: a cell is in NbrCircle(r,'CELL') if its center is within r cells of the processing
+# cell's center. Cells outside the raster are ignored, so edge cells get a truncated circle.
+#
+# focalSumsTiled does the same for a list of radii in one pass, for focal distance sensitivity runs. Each tile is
+# read once with the halo of the largest radius, and the work that doesn't depend on the radius is shared: the
+# row-wise cumulative sum for the 'runs' radii, the forward FFT of the tile for the 'fft' radii. Each radius then
+# only costs its own runs, or one kernel product and inverse FFT.
+
+import numpy as np
+
+
+def circleHalfWidths(radius):
+    # Half width (in cells) of the circle for each row offset -radius..radius. Row offset dy covers
+    # columns -w..w where w = floor(sqrt(r^2 - dy^2))
+    radius = int(radius)
+    dy = np.arange(-radius, radius+1)
+    halfWidths = np.floor(np.sqrt(radius*radius - dy*dy)).astype(np.int64)
+    # Fix any floating point misses on perfect squares so the circle matches dx^2 + dy^2 <= r^2 exactly
+    halfWidths[(halfWidths+1)**2 + dy*dy <= radius*radius] += 1
+    halfWidths[halfWidths**2 + dy*dy > radius*radius] -= 1
+    return halfWidths
+
+
+def circleKernel(radius):
+    # 0/1 array of the circular neighborhood, shape (2r+1, 2r+1)
+    radius = int(radius)
+    halfWidths = circleHalfWidths(radius)
+    kernel = np.zeros((2*radius+1, 2*radius+1), dtype=np.uint8)
+    for i in range(2*radius+1):
+        kernel[i, radius-halfWidths[i]:radius+halfWidths[i]+1] = 1
+    return kernel
+
+
+def _rowCumsum(padded):
+    # Cumulative sum along rows with a leading column of zeros, so a run from column a to b (inclusive)
+    # is cs[:, b+1] - cs[:, a]
+    cs = np.zeros((padded.shape[0], padded.shape[1]+1), dtype=np.int64)
+    np.cumsum(padded, axis=1, out=cs[:, 1:])
+    return cs
+
+
+def _sumRuns(padded, radius, nRows, nCols):
+    # padded is the tile with a halo of 'radius' cells on every side
+    return _sumRunsCs(_rowCumsum(padded), radius, radius, nRows, nCols)
+
+
+def _sumRunsCs(cs, halo, radius, nRows, nCols):
+    # Circle sums of 'radius' from the row cumulative sums of a tile padded with a halo of 'halo' >= radius cells
+    halfWidths = circleHalfWidths(radius)
+    shift = halo - radius
+    out = np.zeros((nRows, nCols), dtype=np.int64)
+    for i in range(2*radius+1):
+        w = halfWidths[i]
+        rowsCs = cs[shift+i:shift+i+nRows]
+        out += rowsCs[:, halo+w+1:halo+w+1+nCols]
+        out -= rowsCs[:, halo-w:halo-w+nCols]
+    return out
+
+
+def _sumFFT(padded, radius, nRows, nCols, kernelFFT=None):
+    # Circular convolution over the padded tile. The 'valid' region (everything past the first 2r rows
+    # and columns) is not touched by wraparound, so it equals the linear convolution.
+    shape = padded.shape
+    if kernelFFT is None:
+        kernelFFT = np.fft.rfft2(circleKernel(radius), s=shape)
+    conv = np.fft.irfft2(np.fft.rfft2(padded, s=shape)*kernelFFT, s=shape)
+    valid = conv[2*radius:2*radius+nRows, 2*radius:2*radius+nCols]
+    return np.rint(valid).astype(np.int64)
+
+
+def chooseMethod(radius):
+    # The run method costs 2r+1 passes over the tile, FFT costs about log2(tile size) passes, so runs are
+    # only worth it for small neighborhoods like the pasture radius of 15
+    if int(radius) <= 24:
+        return 'runs'
+    return 'fft'
+
+
+def focalSumTiled(mask, radius, tileSize=2048, method='auto', out=None):
+    # Sum of 'mask' over a circle of 'radius' cells around every cell.
+    # mask: 2D array-like of 0/1 (NoData should already be converted to 0)
+    # out: optional 2D array-like (e.g. a memmap) to write into. Returns the output array, int64 if created here
+    radius = int(radius)
+    if method == 'auto':
+        method = chooseMethod(radius)
+    if method not in ('runs', 'fft'):
+        raise ValueError("method must be 'runs', 'fft' or 'auto', not "+str(method))
+    nRowsTotal, nColsTotal = mask.shape
+    if out is None:
+        out = np.zeros((nRowsTotal, nColsTotal), dtype=np.int64)
+    kernelFFT = None
+    kernelShape = None
+    for row0 in range(0, nRowsTotal, tileSize):
+        row1 = min(row0+tileSize, nRowsTotal)
+        for col0 in range(0, nColsTotal, tileSize):
+            col1 = min(col0+tileSize, nColsTotal)
+            padded = readWindowWithHalo(mask, row0, row1, col0, col1, radius)
+            if method == 'runs':
+                tileSum = _sumRuns(padded, radius, row1-row0, col1-col0)
+            else:
+                # The kernel transform only depends on the padded shape, which is the same for all interior tiles
+                if kernelShape != padded.shape:
+                    kernelShape = padded.shape
+                    kernelFFT = np.fft.rfft2(circleKernel(radius), s=kernelShape)
+                tileSum = _sumFFT(padded, radius, row1-row0, col1-col0, kernelFFT)
+            out[row0:row1, col0:col1] = tileSum
+    return out
+
+
+def focalSumsTiled(mask, radii, tileSize=2048, method='auto', out=None):
+    # focalSumTiled for several radii in one pass over the mask. Returns a list with one output per radius, in the
+    # order of radii. out: optional list of 2D array-likes (e.g. memmaps) to write into, one per radius
+    radii = [int(radius) for radius in radii]
+    methods = [chooseMethod(radius) if method == 'auto' else method for radius in radii]
+    for m in methods:
+        if m not in ('runs', 'fft'):
+            raise ValueError("method must be 'runs', 'fft' or 'auto', not "+str(m))
+    nRowsTotal, nColsTotal = mask.shape
+    if out is None:
+        out = [np.zeros((nRowsTotal, nColsTotal), dtype=np.int64) for radius in radii]
+    halo = max(radii)
+    kernelFFTs = dict()
+    kernelShape = None
+    for row0 in range(0, nRowsTotal, tileSize):
+        row1 = min(row0+tileSize, nRowsTotal)
+        for col0 in range(0, nColsTotal, tileSize):
+            col1 = min(col0+tileSize, nColsTotal)
+            nRows = row1-row0
+            nCols = col1-col0
+            padded = readWindowWithHalo(mask, row0, row1, col0, col1, halo)
+            cs = None
+            paddedFFT = None
+            for k, radius in enumerate(radii):
+                if methods[k] == 'runs':
+                    if cs is None:
+                        cs = _rowCumsum(padded)
+                    tileSum = _sumRunsCs(cs, halo, radius, nRows, nCols)
+                else:
+                    # Kernel transforms are kept for as long as the padded shape stays the same
+                    if kernelShape != padded.shape:
+                        kernelShape = padded.shape
+                        kernelFFTs = dict()
+                    if radius not in kernelFFTs:
+                        kernelFFTs[radius] = np.fft.rfft2(circleKernel(radius), s=kernelShape)
+                    if paddedFFT is None:
+                        paddedFFT = np.fft.rfft2(padded)
+                    conv = np.fft.irfft2(paddedFFT*kernelFFTs[radius], s=kernelShape)
+                    # A kernel of 'radius' over a halo of 'halo' is valid from halo+radius on
+                    tileSum = np.rint(conv[halo+radius:halo+radius+nRows, halo+radius:halo+radius+nCols]).astype(np.int64)
+                out[k][row0:row1, col0:col1] = tileSum
+    return out
+
+
+def readWindowWithHalo(arr, row0, row1, col0, col1, halo):
+    # Reads arr[row0:row1, col0:col1] plus 'halo' cells on every side. Parts of the halo that fall outside
+    # the raster are filled with 0, which makes them drop out of the sum like ArcGIS does at raster edges.
+    nRowsTotal, nColsTotal = arr.shape
+    padded = np.zeros((row1-row0+2*halo, col1-col0+2*halo), dtype=np.int32)
+    r0 = max(row0-halo, 0)
+    r1 = min(row1+halo, nRowsTotal)
+    c0 = max(col0-halo, 0)
+    c1 = min(col1+halo, nColsTotal)
+    padded[r0-(row0-halo):r1-(row0-halo), c0-(col0-halo):c1-(col0-halo)] = np.asarray(arr[r0:r1, c0:c1])
+    return padded
+
+
+def focalArea(mask, radius, cellSize, ignoreNoData=True, noData=None, tileSize=2048, method='auto', noDataValue=-1):
+    # Equivalent of FocalStatistics(mask, NbrCircle(radius,'CELL'), 'SUM', ...)*cellSize**2.
+    # mask: 0/1 array with NoData already set to 0
+    # noData: optional boolean array marking the NoData cells of the original raster
+    # ignoreNoData=True is the 'DATA' option - output is NoData only where the whole circle is NoData.
+    # ignoreNoData=False is the 'NODATA' option - output is NoData if any cell in the circle is NoData.
+    # NoData cells of the output are set to noDataValue, so the result can go straight into
+    # arcpy.NumPyArrayToRaster(..., value_to_nodata=noDataValue)
+    counts = focalSumTiled(mask, radius, tileSize, method)
+    if ignoreNoData:
+        if noData is None:
+            # mask is 1 or NoData (like maskCDL3Rect), so a count of 0 means every cell in the circle was NoData
+            outNoData = counts == 0
+        else:
+            dataCounts = focalSumTiled(~np.asarray(noData, dtype=bool), radius, tileSize, method)
+            outNoData = dataCounts == 0
+    else:
+        if noData is None:
+            outNoData = np.zeros(counts.shape, dtype=bool)
+        else:
+            outNoData = focalSumTiled(np.asarray(noData, dtype=np.uint8), radius, tileSize, method) > 0
+    area = counts*int(cellSize)**2
+    area[outNoData] = noDataValue
+    return area
@@ -0,0 +1,129 @@
+# Mass balance check of the final manure rasters: the kg of every layer that goes into NManureTotal/PManureTotal are
+# summed per county (zone) while the totals are worked out, as the onBand of RasterAlgebra.evaluate, so the check
+# costs no extra pass over the rasters. Each layer's band is taken from the same evaluation the totals use. The sums are
+# then compared with the county loads of the input tables (Total_Confined_County_Loads, Pasture_Animals) and written to
+# a CSV report with one row per check and county:
+#   Check, Scope ('County', 'Outside counties' or 'Basin'), zone field (CtyID), kg of each layer of the check, RasterKg,
+#   ExpectedKg, DiffKg, DiffPercent
+# Buffers cross county lines, so loads move between neighbouring counties and the county rows don't have to match.
+# The Basin row (every cell of the grid, CtyID 0) is the one that shows manure lost or made up by the model.
+#
+#   massBalance = MassBalance(zonesCounty)
+#   pastureN = massBalance.addComponent('Pasture N', RasterPastureNnoNull, gridNLCD.cellArea)
+#   massBalance.addCheck('Pasture N', ['Pasture N'], storePastureLoads, 'SUM_kgN_year')
+#   RasterAlgebra.evaluate([('NManureTotal', pastureN + ..., np.float32, -1)], gridNLCD, onBand=massBalance.observe,
+#                          keep=massBalance.nodes())
+#   massBalance.report(path)
+
+import threading
+
+import numpy as np
+import pandas as pd
+
+import RasterAlgebra
+
+
+class MassBalance(object):
+
+    def __init__(self, zones):
+        # zones: ZonalStats.ZoneRaster of the counties on the grid of the totals
+        self.zones = zones
+        self.components = list()
+        self.checks = list()
+        self.sums = dict()
+        self._lock = threading.Lock()
+
+    def addComponent(self, name, layer, kgPerUnit=1.):
+        # One layer of the totals. kgPerUnit turns its cell values into kg in the cell: the cell area for rates in
+        # kg/m2, 1 for loads in kg. Returns the layer as a RasterAlgebra node, which has to be the one used in the
+        # totals for its bands to be shared
+        node = RasterAlgebra._node(layer)
+        self.components.append((name, node, float(kgPerUnit)))
+        self.sums[name] = np.zeros(1)
+        return node
+
+    def nodes(self):
+        # The component nodes, to be kept in the band memo for observe (keep of RasterAlgebra.evaluate)
+        return [node for name, node, kgPerUnit in self.components]
+
+    def addCheck(self, name, componentNames, expected, field):
+        # Compares the sum of componentNames with expected[field], kg per county. expected has a field named like the
+        # zone field (e.g. an AttributeStore keyed by CtyID)
+        unknown = [c for c in componentNames if c not in self.sums]
+        if unknown:
+            raise ValueError('No component named '+', '.join(unknown))
+        zoneIDs = np.asarray(expected[self.zones.zoneField]).astype(np.int64)
+        kg = np.nan_to_num(np.asarray(pd.to_numeric(expected[field]), dtype=np.float64))
+        self.checks.append((name, list(componentNames), zoneIDs, kg))
+
+    def observe(self, band, memo):
+        # onBand of RasterAlgebra.evaluate: adds the kg of every component in the band to its zone sums
+        row0, row1 = band
+        zones = np.asarray(self.zones.zones[row0:row1]).ravel()
+        size = int(zones.max())+1 if zones.size else 1
+        # Constants are spread over the band, like in ZonalStats.stats
+        blank = np.zeros((row1-row0, self.zones.grid.nCols))
+        bandSums = dict()
+        for name, node, kgPerUnit in self.components:
+            values, valid = node.evaluateBand(band, memo)
+            values = (blank + values).ravel()
+            keep = ~np.isnan(values)
+            if valid is not None:
+                keep &= ((blank == 0) & valid).ravel()
+            bandSums[name] = np.bincount(zones[keep], weights=values[keep], minlength=size)*kgPerUnit
+        with self._lock:
+            for name, sums in bandSums.items():
+                if len(sums) > len(self.sums[name]):
+                    self.sums[name] = np.append(self.sums[name], np.zeros(len(sums)-len(self.sums[name])))
+                self.sums[name][:len(sums)] += sums
+
+    def _zoneSums(self, name, size):
+        sums = np.zeros(size)
+        sums[:len(self.sums[name])] = self.sums[name][:size]
+        return sums
+
+    def report(self, path=None, tolerance=0.01):
+        # Table of the checks (see the top of this file), written to path as CSV. The basin totals are printed, with a
+        # warning for checks off by more than tolerance (a fraction of the expected kg)
+        zoneField = self.zones.zoneField
+        tables = list()
+        for name, componentNames, zoneIDs, expectedKg in self.checks:
+            size = max([len(self.sums[c]) for c in componentNames] + [int(zoneIDs.max())+1 if len(zoneIDs) else 1])
+            expected = np.zeros(size)
+            np.add.at(expected, zoneIDs[zoneIDs > 0], expectedKg[zoneIDs > 0])
+            components = [(c, self._zoneSums(c, size)) for c in componentNames]
+            raster = np.sum([sums for _, sums in components], axis=0)
+            counties = np.flatnonzero((expected != 0) | (raster != 0))
+            counties = counties[counties > 0]
+            table = pd.DataFrame({'Check': name, 'Scope': 'County', zoneField: counties})
+            outside = {'Check': name, 'Scope': 'Outside counties', zoneField: 0}
+            basin = {'Check': name, 'Scope': 'Basin', zoneField: 0}
+            for component, sums in components:
+                table[component] = sums[counties]
+                outside[component] = sums[0]
+                basin[component] = sums.sum()
+            table['RasterKg'] = raster[counties]
+            table['ExpectedKg'] = expected[counties]
+            outside['RasterKg'], outside['ExpectedKg'] = raster[0], 0.
+            # Loads in the table for zone IDs that aren't in the zone raster still count for the basin
+            basin['RasterKg'], basin['ExpectedKg'] = raster.sum(), expectedKg.sum()
+            table = pd.concat([table, pd.DataFrame([outside, basin])], ignore_index=True)
+            tables.append(table)
+            difference = basin['RasterKg'] - basin['ExpectedKg']
+            percent = 100.*difference/basin['ExpectedKg'] if basin['ExpectedKg'] else np.nan
+            print('%s: %.1f kg in the rasters, %.1f kg in the tables (%+.2f%%)' % (
+                name, basin['RasterKg'], basin['ExpectedKg'], percent))
+            if not abs(difference) <= tolerance*abs(basin['ExpectedKg']):
+                print('WARNING: '+name+' does not balance')
+        if not tables:
+            return None
+        table = pd.concat(tables, ignore_index=True)
+        table['DiffKg'] = table['RasterKg'] - table['ExpectedKg']
+        with np.errstate(invalid='ignore', divide='ignore'):
+            table['DiffPercent'] = 100.*table['DiffKg']/table['ExpectedKg'].where(table['ExpectedKg'] != 0)
+        columns = ['Check', 'Scope', zoneField] + [name for name, _, _ in self.components if name in table.columns] + \
+                  ['RasterKg', 'ExpectedKg', 'DiffKg', 'DiffPercent']
+        table = table[columns]
+        if path is not None:
+            table.to_csv(path, index=False)
+        return table
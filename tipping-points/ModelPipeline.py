@@ -0,0 +1,265 @@
+# Runs a model script made of #%% cells (like Animal_Waste_Update2017_JAR.py) as a sequence of named stages, with
+# cached results, instead of rerunning the cells by hand. A cell header tags where each stage starts:
+#   #%% [setup] ...          - always run (parameters, environment settings, functions)
+#   #%% [stage: focal area]  - first cell of the 'focal area' stage. Untagged cells belong to the stage above them
+# Cells before the first tag are run every time too (imports).
+#
+# Every stage gets a key: a hash of the stage's code, the values of its parameters (cellSize, paramFocalDist...),
+# the contents of its input files, and the key of the stage before it. If the key matches the one stored after the
+# last successful run and all of the stage's outputs still exist, the stage is skipped and the script variables it
+# left behind for later stages (its 'values') are restored from the cache. Changing a parameter reruns that stage and
+# everything after it.
+#
+# Long loops can save their progress with currentStage.checkpoint(state) and pick it up with currentStage.resume()
+# after a crash. The checkpoint is only used if the stage key hasn't changed, and is deleted once the stage finishes.
+# currentStage is None when the script is run by hand.
+#
+# If the script sets runTrace (a RunTrace.RunTrace), every stage that runs is timed with it as 'stage: <name>', and
+# its summary is printed at the end of the run.
+
+import hashlib
+import json
+import os
+import re
+import time
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+# Input files up to this size are hashed by content, bigger files and folders (file geodatabases) by size and date
+maxHashBytes = 256*1024*1024
+
+cellTag = re.compile(r'#%%\s*\[\s*(setup|stage\s*:\s*([^\]]+?))\s*\]')
+
+
+class Stage(object):
+
+    def __init__(self, name, params=(), inputs=(), outputs=(), values=(), manual=False):
+        # params: names of script variables whose values go into the key
+        # inputs: names of script variables holding paths of input files or datasets, whose contents go into the key
+        # outputs: datasets the stage makes in the workspace (script variable names or dataset names). The stage is
+        #          run again if any of them is missing
+        # values: names of script variables the stage sets that later stages use, restored when the stage is skipped
+        # manual: the stage's cells are run by hand (e.g. in ArcMap) and never by the pipeline
+        self.name = name
+        self.params = list(params)
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.values = list(values)
+        self.manual = manual
+
+
+def parseCells(path):
+    # Splits a script into blocks of cells: a list of (kind, stageName, source, firstLine), where kind is 'always'
+    # or 'stage'. Consecutive cells of the same stage are joined into one block
+    with open(path) as f:
+        lines = f.read().splitlines()
+    blocks = list()
+    kind, name, start = 'always', None, 0
+    for i, line in enumerate(lines):
+        match = cellTag.match(line)
+        if not match:
+            continue
+        newKind, newName = ('always', None) if match.group(1) == 'setup' else ('stage', match.group(2).strip())
+        if (newKind, newName) != (kind, name):
+            blocks.append((kind, name, '\n'.join(lines[start:i]), start+1))
+            kind, name, start = newKind, newName, i
+    blocks.append((kind, name, '\n'.join(lines[start:]), start+1))
+    return [block for block in blocks if block[2].strip()]
+
+
+def signature(path):
+    # Fingerprint of an input file, shapefile, file geodatabase dataset or folder
+    path = str(path)
+    lower = path.lower()
+    if '.gdb' in lower and not lower.endswith('.gdb'):
+        # Datasets inside a file geodatabase aren't separate files, so the whole geodatabase is used
+        path = path[:lower.index('.gdb')+4]
+    if os.path.isdir(path):
+        entries = list()
+        for folder, subfolders, files in os.walk(path):
+            subfolders.sort()
+            for name in sorted(files):
+                stat = os.stat(os.path.join(folder, name))
+                entries.append((os.path.relpath(os.path.join(folder, name), path), stat.st_size, int(stat.st_mtime)))
+        return hashlib.sha1(json.dumps(entries).encode('utf-8')).hexdigest()
+    if os.path.isfile(path):
+        stem, extension = os.path.splitext(path)
+        if extension.lower() == '.shp':
+            # A shapefile's attributes and projection are in its .dbf and .prj, so hash every part
+            folder = os.path.dirname(path) or '.'
+            base = os.path.basename(stem).lower()
+            parts = sorted(os.path.join(folder, name) for name in os.listdir(folder)
+                           if os.path.splitext(name)[0].lower() == base)
+            return hashlib.sha1(''.join(_fileHash(part) for part in parts).encode('utf-8')).hexdigest()
+        return _fileHash(path)
+    return 'missing'
+
+
+def _fileHash(path):
+    stat = os.stat(path)
+    if stat.st_size > maxHashBytes:
+        return 'size:'+str(stat.st_size)+',mtime:'+str(int(stat.st_mtime))
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024*1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _datasetExists(name):
+    # Plain files (e.g. .npz arrays) aren't always datasets arcpy knows about
+    if os.path.isfile(name):
+        return True
+    import arcpy
+    return arcpy.Exists(name)
+
+
+class StageCache(object):
+    # Stage keys in <folder>/stages.json, restored values and checkpoints in pickles next to it
+
+    def __init__(self, folder):
+        self.folder = folder
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        self.manifestPath = os.path.join(folder, 'stages.json')
+        self.manifest = dict()
+        if os.path.exists(self.manifestPath):
+            with open(self.manifestPath) as f:
+                self.manifest = json.load(f)
+
+    def _path(self, name, suffix):
+        return os.path.join(self.folder, re.sub(r'\W+', '_', name)+suffix)
+
+    def key(self, name):
+        entry = self.manifest.get(name)
+        return entry['key'] if entry else None
+
+    def record(self, name, key, values, seconds):
+        _dumpAtomic(values, self._path(name, '.values.pkl'))
+        self.manifest[name] = {'key': key, 'finished': time.ctime(), 'seconds': round(seconds, 1)}
+        with open(self.manifestPath+'.tmp', 'w') as f:
+            json.dump(self.manifest, f, indent=1, sort_keys=True)
+        _replace(self.manifestPath+'.tmp', self.manifestPath)
+
+    def values(self, name):
+        with open(self._path(name, '.values.pkl'), 'rb') as f:
+            return pickle.load(f)
+
+    def forget(self, name):
+        self.manifest.pop(name, None)
+
+    def saveCheckpoint(self, name, key, state):
+        _dumpAtomic({'key': key, 'state': state, 'saved': time.ctime()}, self._path(name, '.checkpoint.pkl'))
+
+    def loadCheckpoint(self, name, key):
+        path = self._path(name, '.checkpoint.pkl')
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            checkpoint = pickle.load(f)
+        return checkpoint['state'] if checkpoint['key'] == key else None
+
+    def clearCheckpoint(self, name):
+        path = self._path(name, '.checkpoint.pkl')
+        if os.path.exists(path):
+            os.remove(path)
+
+
+class StageRun(object):
+    # Given to the script as currentStage while a stage runs
+
+    def __init__(self, cache, name, key):
+        self.cache = cache
+        self.name = name
+        self.key = key
+
+    def resume(self):
+        # State saved by the last checkpoint() of an interrupted run of this stage, or None
+        return self.cache.loadCheckpoint(self.name, self.key)
+
+    def checkpoint(self, state):
+        self.cache.saveCheckpoint(self.name, self.key, state)
+
+
+class Pipeline(object):
+
+    def __init__(self, scriptPath, cacheFolder, stages, datasetExists=_datasetExists):
+        self.scriptPath = os.path.abspath(scriptPath)
+        self.cache = StageCache(cacheFolder)
+        self.stages = dict((stage.name, stage) for stage in stages)
+        self.datasetExists = datasetExists
+
+    def run(self, force=(), stopAfter=None, afterSetup=None):
+        # Runs the script, skipping stages that are up to date. force: stage names to rerun anyway (and so
+        # everything after them). stopAfter: name of the last stage to run. afterSetup: called with the script's
+        # variables after every cell that always runs, e.g. to change parameters for a sweep (see ModelSweep.py)
+        namespace = {'__name__': '__pipeline__', '__file__': self.scriptPath}
+        previousKey = ''
+        rerunFollowing = False
+        for kind, name, source, firstLine in parseCells(self.scriptPath):
+            # Padding keeps the line numbers in tracebacks the same as in the script
+            code = compile('\n'*(firstLine-1)+source, self.scriptPath, 'exec')
+            if kind == 'always':
+                exec(code, namespace)
+                if afterSetup is not None:
+                    afterSetup(namespace)
+                continue
+            if name not in self.stages:
+                raise KeyError('Cell tagged with unknown stage: '+name)
+            stage = self.stages[name]
+            if stage.manual:
+                print('Stage '+name+' is run by hand, skipping it')
+                continue
+            key = self._key(stage, source, namespace, previousKey)
+            rerunFollowing = rerunFollowing or name in force
+            if not rerunFollowing and self.cache.key(name) == key and self._outputsExist(stage, namespace):
+                namespace.update(self.cache.values(name))
+                print('Stage '+name+' is up to date, skipping it')
+            else:
+                print('Running stage '+name+' - '+time.ctime())
+                started = time.time()
+                self.cache.forget(name)
+                namespace['currentStage'] = StageRun(self.cache, name, key)
+                trace = namespace.get('runTrace')
+                timer = trace.start('stage: '+name) if trace is not None else None
+                exec(code, namespace)
+                if timer is not None:
+                    timer.stop()
+                namespace['currentStage'] = None
+                # The key is worked out again after the run, so a stage that edits its own inputs (e.g. converting a
+                # field of an input table) doesn't look out of date the next time
+                key = self._key(stage, source, namespace, previousKey)
+                self.cache.record(name, key, dict((v, namespace[v]) for v in stage.values), time.time()-started)
+                self.cache.clearCheckpoint(name)
+                print('Finished stage '+name+' in '+str(round((time.time()-started)/60., 2))+' minutes')
+            previousKey = key
+            if name == stopAfter:
+                break
+        if namespace.get('runTrace') is not None:
+            namespace['runTrace'].printSummary()
+        return namespace
+
+    def _key(self, stage, source, namespace, previousKey):
+        params = [(p, repr(namespace[p])) for p in stage.params]
+        inputs = [(i, signature(namespace[i])) for i in stage.inputs]
+        text = json.dumps([stage.name, source, params, inputs, previousKey])
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+    def _outputsExist(self, stage, namespace):
+        return all(self.datasetExists(namespace.get(output, output)) for output in stage.outputs)
+
+
+def _dumpAtomic(obj, path):
+    with open(path+'.tmp', 'wb') as f:
+        pickle.dump(obj, f, 2)
+    _replace(path+'.tmp', path)
+
+
+def _replace(source, destination):
+    # os.rename doesn't overwrite on Windows in Python 2
+    if os.path.exists(destination):
+        os.remove(destination)
+    os.rename(source, destination)
@@ -0,0 +1,179 @@
+# Parameter sweeps of the staged model script (see ModelPipeline.py): the model is run once for every combination of
+# a grid of parameter values, e.g. ReqAreaThreshold x ConvThreshold x paramPastureAssimiliation x
+# paramAvgRCapPercentile, and a table of results (N and P totals) is made with a row per scenario.
+#
+# A parameter only changes the stages from the first one that has it in its params on (stage keys are chained), so
+# the stages before the first stage any swept parameter affects are the same in every scenario. Those are run once,
+# in the normal workspace and stage cache. Every scenario then gets a folder of its own with:
+#   - a copy of the stage cache, without the affected stages, so the shared stages are skipped like in a rerun
+#   - a copy of each workspace geodatabase (outDir, scratchWork), and every script path inside them pointed at it
+#   - empty scratch folders (pathRasterScratch...) in place of the shared ones
+#   - the file outputs of the affected stages (pathAvailableMask...) in the scenario folder
+# and the affected stages are run there, one scenario per worker process. Everything else (inputs, layers of the
+# shared stages like pathFocalCounts) is read from where the shared run left it.
+
+import itertools
+import os
+import re
+import shutil
+import time
+import traceback
+from multiprocessing import Pool
+
+import numpy as np
+
+from ModelPipeline import Pipeline, StageCache
+
+
+def scenarios(grid):
+    # Every combination of the values in grid (parameter name -> list of values), as a list of dicts
+    names = sorted(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*[grid[name] for name in names])]
+
+
+def affectedStages(stages, params):
+    # Names of the stages a change to any of params reruns: the first stage with one of them in its params and every
+    # (non-manual) stage after it. Raises if a parameter isn't in any stage's params, since changing it would rerun
+    # nothing
+    unused = [p for p in params if not any(p in stage.params for stage in stages)]
+    if unused:
+        raise ValueError('Not a parameter of any stage: '+', '.join(unused))
+    for i, stage in enumerate(stages):
+        if any(p in stage.params for p in params):
+            return [later.name for later in stages[i:] if not later.manual]
+    return []
+
+
+def rasterTotal(path, noDataValue=-1, bandRows=4096):
+    # Sum of the cells of a .npy raster (e.g. NManureTotal from RasterAlgebra.evaluate) that aren't NoData
+    values = np.load(path, mmap_mode='r')
+    total = 0.
+    for row0 in range(0, values.shape[0], bandRows):
+        band = np.asarray(values[row0:row0+bandRows], dtype=np.float64)
+        total += band[(band != noDataValue) & ~np.isnan(band)].sum()
+    return total
+
+
+class Sweep(object):
+
+    def __init__(self, scriptPath, cacheFolder, stages, sweepFolder, workspaces=(), folders=(), environment=None,
+                 collect=None, workers=1):
+        # scriptPath, cacheFolder, stages: as for ModelPipeline.Pipeline
+        # sweepFolder: folder the scenario folders are made in
+        # workspaces: names of script variables holding the output geodatabases, copied for every scenario
+        # folders: names of script variables holding scratch folders the affected stages write to
+        # environment: arcpy.env setting -> script variable, set again after the paths are moved, e.g.
+        #              {'workspace': 'outDir', 'scratchWorkspace': 'scratchWork'}
+        # collect: function of the script's variables after a scenario's run, returning a dict of results for its
+        #          row of the table. Must be a module-level function so it can be sent to the worker processes
+        # workers: scenarios run at the same time
+        self.scriptPath = os.path.abspath(scriptPath)
+        self.cacheFolder = cacheFolder
+        self.stages = list(stages)
+        self.sweepFolder = sweepFolder
+        self.workspaces = list(workspaces)
+        self.folders = list(folders)
+        self.environment = dict(environment or {})
+        self.collect = collect
+        self.workers = workers
+
+    def run(self, grid, onResult=None):
+        # Runs every scenario of grid (parameter name -> list of values). Returns a list of rows (dicts) with the
+        # scenario name, its parameter values, the results of collect, the minutes it took and the error if it failed.
+        # onResult: called with each row in this process as soon as its scenario finishes (in scenario order)
+        affected = affectedStages(self.stages, list(grid))
+        names = [stage.name for stage in self.stages if not stage.manual]
+        shared = [name for name in names if name not in affected]
+        if shared:
+            print('Running the shared stages, up to '+shared[-1])
+            Pipeline(self.scriptPath, self.cacheFolder, self.stages).run(stopAfter=shared[-1])
+        affectedOutputs = [output for stage in self.stages if stage.name in affected for output in stage.outputs]
+        tasks = list()
+        for i, params in enumerate(scenarios(grid)):
+            name = 'Scenario_'+str(i+1).zfill(3)
+            tasks.append((self, name, params, shared, affectedOutputs))
+        print('Running '+str(len(tasks))+' scenarios of stages '+', '.join(affected))
+        rows = list()
+        pool = None
+        if self.workers > 1 and len(tasks) > 1:
+            pool = Pool(min(self.workers, len(tasks)))
+            results = pool.imap(_runScenario, tasks, 1)
+        else:
+            results = (_runScenario(task) for task in tasks)
+        try:
+            for row in results:
+                if onResult is not None:
+                    onResult(row)
+                rows.append(row)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        return rows
+
+    def _prepare(self, folder, shared):
+        # Empty scenario folder with a stage cache that only knows the shared stages. Returns the cache folder
+        if os.path.isdir(folder):
+            shutil.rmtree(folder)
+        source = StageCache(self.cacheFolder)
+        cache = StageCache(os.path.join(folder, 'StageCache'))
+        for name in shared:
+            if source.key(name) is not None:
+                cache.record(name, source.key(name), source.values(name), source.manifest[name]['seconds'])
+        return cache.folder
+
+    def _rebase(self, namespace, folder, affectedOutputs, copied):
+        # Points the script's output paths at the scenario folder (see the top of this file). Called after every
+        # cell that always runs, so it has to leave paths that were already moved alone
+        if not all(name in namespace for name in self.workspaces + self.folders):
+            return
+        for name in self.workspaces:
+            original = namespace[name]
+            target = os.path.join(folder, os.path.basename(original))
+            if original == target:
+                continue
+            if original not in copied:
+                # Lock files belong to the processes that have the shared geodatabase open
+                shutil.copytree(original, target, ignore=shutil.ignore_patterns('*.lock'))
+                copied.add(original)
+            prefix = re.compile(re.escape(original)+r'(?=$|[\\/])', re.IGNORECASE)
+            for variable, value in list(namespace.items()):
+                if isinstance(value, str) and prefix.match(value):
+                    namespace[variable] = target+value[len(original):]
+        for name in self.folders:
+            namespace[name] = os.path.join(folder, os.path.basename(namespace[name]))
+            if not os.path.isdir(namespace[name]):
+                os.makedirs(namespace[name])
+        for name in affectedOutputs:
+            value = namespace.get(name)
+            if isinstance(value, str) and os.path.isabs(value) and not value.startswith(folder):
+                namespace[name] = os.path.join(folder, os.path.basename(value))
+        if self.environment:
+            import arcpy
+            for setting, name in self.environment.items():
+                setattr(arcpy.env, setting, namespace[name])
+
+
+def _runScenario(task):
+    sweep, name, params, shared, affectedOutputs = task
+    folder = os.path.join(sweep.sweepFolder, name)
+    row = {'Scenario': name}
+    row.update(params)
+    started = time.time()
+    try:
+        cacheFolder = sweep._prepare(folder, shared)
+        copied = set()
+
+        def afterSetup(namespace):
+            namespace.update(params)
+            sweep._rebase(namespace, folder, affectedOutputs, copied)
+
+        namespace = Pipeline(sweep.scriptPath, cacheFolder, sweep.stages).run(afterSetup=afterSetup)
+        if sweep.collect is not None:
+            row.update(sweep.collect(namespace))
+    except Exception:
+        # One failed scenario shouldn't lose the results of the others
+        row['Error'] = traceback.format_exc().strip().splitlines()[-1]
+        print(name+' failed:\n'+traceback.format_exc())
+    row['Minutes'] = round((time.time()-started)/60., 2)
+    return row
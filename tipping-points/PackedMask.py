@@ -0,0 +1,164 @@
+# Bit-packed masks on the snap grid, for the area confined manure can be spread on: Ag cells in the basin rectangle,
+# minus the cells under pasture buffers, plus the cells with a CAFO in them. The model used to build this as polygons
+# (RasterToPolygon of the ag mask, Merge with 10 m CAFO buffers, Erase of the pasture buffers, Merge again) and clip
+# every farm buffer by that layer in every iteration of the convergence loop. Here it is one bit per cell (a 30 m
+# Great Lakes rectangle is a few hundred MB as bytes, an eighth of that as bits), and the area of a buffer group is
+# the number of available cells whose centers fall inside any of the group's circles.
+#
+# Rows are packed with np.packbits, so a window of rows and columns is unpacked with a slice and np.unpackbits.
+# mask[row0:row1, col0:col1] gives a boolean array, so a PackedMask can be used wherever a 2D mask array is read in
+# windows (e.g. RadialProfiles.build, FocalSum.focalSumTiled). It is also a RasterAlgebra expression node (1 in the
+# mask, 0 elsewhere), unpacked one band at a time when evaluate() reaches it.
+
+import numpy as np
+
+import RasterAlgebra
+from RasterGrid import RasterGrid
+from SparseRaster import SparseRaster
+
+
+class PackedMask(RasterAlgebra.Expr):
+
+    def __init__(self, bits, grid):
+        # bits: uint8 array of shape (nRows, ceil(nCols/8)), rows packed with np.packbits
+        self.bits = bits
+        self.grid = grid
+
+    @classmethod
+    def fromArray(cls, mask, grid):
+        return cls(np.packbits(np.asarray(mask, dtype=bool), axis=1), grid)
+
+    @classmethod
+    def fromExpr(cls, expr, grid, bandRows=1024, bits=None):
+        # Mask of the cells where a RasterAlgebra expression (or raster path) is nonzero. NoData cells are left out.
+        # bits: optional packed array (e.g. a memmap) to write into
+        if not isinstance(expr, RasterAlgebra.Expr):
+            expr = RasterAlgebra.Raster(expr)
+        if bits is None:
+            bits = np.zeros((grid.nRows, (grid.nCols+7)//8), dtype=np.uint8)
+        for row0 in range(0, grid.nRows, bandRows):
+            row1 = min(row0+bandRows, grid.nRows)
+            values, valid = expr.evaluateBand((row0, row1), {'grid': grid})
+            # Constants are spread over the band
+            band = np.zeros((row1-row0, grid.nCols), dtype=bool)
+            band |= np.asarray(values) != 0
+            if valid is not None:
+                band &= valid
+            bits[row0:row1] = np.packbits(band, axis=1)
+        return cls(bits, grid)
+
+    @property
+    def shape(self):
+        return self.grid.shape
+
+    @property
+    def nbytes(self):
+        return self.bits.nbytes
+
+    def window(self, row0, row1, col0, col1):
+        # Boolean array of rows row0:row1 and columns col0:col1
+        unpacked = np.unpackbits(self.bits[row0:row1, col0//8:(col1+7)//8], axis=1)
+        return unpacked[:, col0 % 8:col0 % 8 + col1-col0].astype(bool)
+
+    def __getitem__(self, key):
+        rows, cols = key
+        row0, row1, _ = rows.indices(self.grid.nRows)
+        col0, col1, _ = cols.indices(self.grid.nCols)
+        return self.window(row0, max(row1, row0), col0, max(col1, col0))
+
+    def _evaluate(self, band, memo):
+        if not self.grid.sameAs(memo['grid']):
+            raise ValueError('Packed mask is on a different grid than the one being evaluated')
+        return self.window(band[0], band[1], 0, self.grid.nCols).astype(np.uint8), None
+
+    def count(self, bandRows=4096):
+        # Number of cells in the mask
+        total = 0
+        for row0 in range(0, self.grid.nRows, bandRows):
+            total += int(np.unpackbits(self.bits[row0:row0+bandRows], axis=1)[:, :self.grid.nCols].sum())
+        return total
+
+    def setPoints(self, x, y):
+        # Adds the cells the points fall in (e.g. CAFO locations, so every farm has at least its own cell)
+        rows, cols = self.grid.rowCol(x, y)
+        inside = self.grid.inside(rows, cols)
+        rows = rows[inside]
+        cols = cols[inside]
+        np.bitwise_or.at(self.bits, (rows, cols//8), (128 >> (cols % 8)).astype(np.uint8))
+
+    def circleCells(self, x, y, radii, groups):
+        # SparseRaster of group IDs on the mask cells whose centers are inside any circle (x, y, radius) of the
+        # group. Circles of different groups don't touch (see BufferGroups.groupCircles), so no cell is in two groups
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        radii = np.nan_to_num(np.asarray(radii, dtype=np.float64))
+        groups = np.asarray(groups, dtype=np.int64)
+        grid = self.grid
+        rows, cols = grid.rowCol(x, y)
+        pieces = list()
+        pieceGroups = list()
+        for i in range(len(x)):
+            halo = int(np.ceil(radii[i]/grid.cellSize)) + 1
+            row0 = max(rows[i]-halo, 0)
+            row1 = min(rows[i]+halo+1, grid.nRows)
+            col0 = max(cols[i]-halo, 0)
+            col1 = min(cols[i]+halo+1, grid.nCols)
+            if row0 >= row1 or col0 >= col1:
+                continue
+            cellRows, cellCols = np.nonzero(self.window(row0, row1, col0, col1))
+            cellRows += row0
+            cellCols += col0
+            cx, cy = grid.cellCenters(cellRows, cellCols)
+            inCircle = np.hypot(cx-x[i], cy-y[i]) <= radii[i]
+            pieces.append(grid.flatIndex(cellRows[inCircle], cellCols[inCircle]))
+            pieceGroups.append(np.repeat(groups[i], inCircle.sum()))
+        if not pieces:
+            return SparseRaster(grid, np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int32))
+        cells, first = np.unique(np.concatenate(pieces), return_index=True)
+        return SparseRaster(grid, cells, np.concatenate(pieceGroups)[first].astype(np.int32))
+
+    def groupAreas(self, x, y, radii, groups):
+        # (group IDs, areas) of every group that covers at least one mask cell, for GroupAreaCache.record
+        counts = np.bincount(self.circleCells(x, y, radii, groups).values)
+        found = np.flatnonzero(counts)
+        return found, counts[found]*self.grid.cellArea
+
+    def save(self, path):
+        grid = self.grid
+        np.savez_compressed(path, bits=self.bits,
+                            grid=np.array([grid.xMin, grid.yMax, grid.cellSize, grid.nRows, grid.nCols]))
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        xMin, yMax, cellSize, nRows, nCols = data['grid']
+        return cls(data['bits'], RasterGrid(xMin, yMax, cellSize, int(nRows), int(nCols)))
+
+
+def groupPolygons(cellGroups, spatialReference, outFeatures, groupField, areaField, scratchFeatures):
+    # Writes the cells of a SparseRaster of group IDs (from circleCells) as polygons dissolved by group, with the
+    # group ID in groupField and the group's cell area in areaField. Only the window around the groups is made dense
+    import arcpy
+    grid = cellGroups.grid
+    if len(cellGroups) == 0:
+        raise ValueError('No cells to write')
+    rows = cellGroups.cells // grid.nCols
+    cols = cellGroups.cells % grid.nCols
+    row0, row1 = int(rows.min()), int(rows.max())+1
+    col0, col1 = int(cols.min()), int(cols.max())+1
+    window = grid.window(row0, row1, col0, col1)
+    array = np.zeros(window.shape, dtype=np.int32)
+    array[rows-row0, cols-col0] = cellGroups.values
+    raster = RasterAlgebra.toRaster(array, window, 0)
+    del array
+    arcpy.RasterToPolygon_conversion(raster, scratchFeatures, 'NO_SIMPLIFY', 'Value')
+    arcpy.DefineProjection_management(scratchFeatures, spatialReference)
+    arcpy.Dissolve_management(scratchFeatures, outFeatures, 'gridcode', '', 'MULTI_PART')
+    arcpy.Delete_management(scratchFeatures)
+    counts = np.bincount(cellGroups.values)
+    arcpy.AddField_management(outFeatures, groupField, 'LONG')
+    arcpy.AddField_management(outFeatures, areaField, 'DOUBLE')
+    with arcpy.da.UpdateCursor(outFeatures, ['gridcode', groupField, areaField]) as cursor:
+        for row in cursor:
+            cursor.updateRow([row[0], row[0], float(counts[row[0]]*grid.cellArea)])
+    arcpy.DeleteField_management(outFeatures, ['gridcode'])
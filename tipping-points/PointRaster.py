@@ -0,0 +1,53 @@
+# Sums point attributes onto the snap grid, in place of PointToRaster_conversion(..., 'SUM') followed by
+# Con(IsNull(...), 0, ...). A few thousand farm points only touch a few thousand cells, but PointToRaster writes a full
+# basin raster for every attribute and Con(IsNull) writes another one. Here each point is mapped to its cell index on
+# the grid once, and every attribute is summed per cell with np.bincount, so N and P (and any other loads) come out of
+# one pass. Cells without points are 0, not NoData.
+#
+# accumulate() returns the occupied cells and their sums. sparse() gives one attribute as a SparseRaster, which can be
+# added to dense rasters band by band, and dense() spreads it onto a full array.
+
+import numpy as np
+
+from SparseRaster import SparseRaster
+
+
+class PointSums(object):
+    # Sums of point attributes per occupied cell. cells are sorted flat cell indices on grid, sums[name][k] is the
+    # sum for cells[k]
+
+    def __init__(self, grid, cells, sums, dropped=0):
+        self.grid = grid
+        self.cells = cells
+        self.sums = sums
+        self.dropped = dropped # Points outside the grid, or with NaN coordinates
+
+    def __len__(self):
+        return len(self.cells)
+
+    def sparse(self, name, dtype=np.float32):
+        # One attribute as a SparseRaster
+        return SparseRaster(self.grid, self.cells, self.sums[name].astype(dtype))
+
+    def dense(self, name, dtype=np.float32):
+        # Full 2D array of one attribute, 0 where there are no points
+        out = np.zeros(self.grid.shape, dtype=dtype)
+        out.ravel()[self.cells] = self.sums[name]
+        return out
+
+
+def accumulate(grid, x, y, fields):
+    # Sum of each (name, values) in fields over the points falling in each cell. NaN values (Nulls) count as 0, the
+    # same as the NoData cells PointToRaster leaves out of its SUM
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    rows, cols = grid.rowCol(np.nan_to_num(x), np.nan_to_num(y))
+    inside = grid.inside(rows, cols) & ~np.isnan(x) & ~np.isnan(y)
+    flat = grid.flatIndex(rows[inside], cols[inside])
+    cells, inverse = np.unique(flat, return_inverse=True)
+    inverse = inverse.ravel()
+    sums = dict()
+    for name, values in fields:
+        values = np.asarray(values, dtype=np.float64)[inside]
+        sums[name] = np.bincount(inverse, weights=np.nan_to_num(values), minlength=len(cells))
+    return PointSums(grid, cells, sums, int((~inside).sum()))
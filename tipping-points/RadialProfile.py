@@ -0,0 +1,110 @@
+# Radial profiles of fertilizable area around each confined farm. For every farm, the distances from the farm to
+# the centers of all available ag cells nearby are sorted, so the available area inside any radius r is
+# (number of cells with distance <= r)*cellSize^2. The radius that gives a farm its required area is then a
+# lookup instead of the Buffer -> Clip -> Shape_Area -> nudge-the-radius loop, which sometimes ran all weekend.
+#
+# The profiles ignore other farms, so they give the exact answer for farms whose buffers don't overlap anyone
+# else's. Farms that share area still go through the iterative loop, but start from a much better radius.
+#
+# Profiles are stored back to back in one float32 array (CSR style): distances[offsets[i]:offsets[i+1]] are the
+# sorted distances for farm i, out to that farm's search radius limits[i].
+
+import numpy as np
+
+
+class RadialProfiles(object):
+
+    def __init__(self, offsets, distances, limits, cellArea):
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.distances = np.asarray(distances, dtype=np.float32)
+        self.limits = np.asarray(limits, dtype=np.float64)
+        self.cellArea = float(cellArea)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @classmethod
+    def build(cls, mask, grid, x, y, requiredArea, maxRadius, growth=2.0):
+        # mask: 2D array, nonzero where manure can be spread. grid: RasterGrid of the mask
+        # x, y: farm coordinates. requiredArea: area each farm needs (m^2)
+        # maxRadius: the furthest (m) any profile is allowed to reach, e.g. the focal distance
+        # Each farm starts searching at twice the radius it would need if every cell were available, and the
+        # search radius grows by 'growth' until the required area is reached or maxRadius is hit.
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        requiredArea = np.asarray(requiredArea, dtype=np.float64)
+        rows, cols = grid.rowCol(x, y)
+        cellSize = grid.cellSize
+        nFarms = len(x)
+        pieces = list()
+        counts = np.zeros(nFarms, dtype=np.int64)
+        limits = np.zeros(nFarms, dtype=np.float64)
+        for i in range(nFarms):
+            area = requiredArea[i] if requiredArea[i] == requiredArea[i] else 0.
+            searchRadius = min(max(growth*(area/np.pi)**0.5, cellSize), maxRadius)
+            while True:
+                dist = _cellDistances(mask, grid, rows[i], cols[i], x[i], y[i], searchRadius)
+                if len(dist)*grid.cellArea >= area or searchRadius >= maxRadius:
+                    break
+                searchRadius = min(searchRadius*growth, maxRadius)
+            dist.sort()
+            pieces.append(dist.astype(np.float32))
+            counts[i] = len(dist)
+            limits[i] = searchRadius
+        offsets = np.zeros(nFarms+1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        distances = np.concatenate(pieces) if pieces else np.zeros(0, dtype=np.float32)
+        return cls(offsets, distances, limits, grid.cellArea)
+
+    def counts(self):
+        return np.diff(self.offsets)
+
+    def radiusForArea(self, areas):
+        # Smallest radius for each farm whose circle holds at least 'areas' of available cells. NaN where the
+        # area isn't reachable within the farm's search radius
+        areas = np.asarray(areas, dtype=np.float64)
+        nCells = np.maximum(np.ceil(areas/self.cellArea), 1).astype(np.int64)
+        counts = self.counts()
+        reachable = (nCells <= counts) & ~np.isnan(areas)
+        radii = np.full(len(self), np.nan)
+        idx = self.offsets[:-1][reachable] + nCells[reachable] - 1
+        radii[reachable] = self.distances[idx]
+        return radii
+
+    def areaAtRadius(self, radii, farms=None):
+        # Available area inside each radius. NaN where the radius goes past what was stored for that farm.
+        # farms: optional farm indices if radii is only for some of the farms
+        radii = np.asarray(radii, dtype=np.float64)
+        if farms is None:
+            farms = np.arange(len(self))
+        areas = np.full(len(farms), np.nan)
+        for j, i in enumerate(farms):
+            if radii[j] > self.limits[i]:
+                continue
+            segment = self.distances[self.offsets[i]:self.offsets[i+1]]
+            areas[j] = np.searchsorted(segment, radii[j], side='right')*self.cellArea
+        return areas
+
+    def save(self, path):
+        np.savez(path, offsets=self.offsets, distances=self.distances, limits=self.limits,
+                 cellArea=np.array(self.cellArea))
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        return cls(data['offsets'], data['distances'], data['limits'], float(data['cellArea']))
+
+
+def _cellDistances(mask, grid, row, col, x, y, radius):
+    # Distances from (x, y) to the centers of all nonzero mask cells within 'radius'
+    halo = int(np.ceil(radius/grid.cellSize)) + 1
+    row0 = max(row-halo, 0)
+    row1 = min(row+halo+1, grid.nRows)
+    col0 = max(col-halo, 0)
+    col1 = min(col+halo+1, grid.nCols)
+    if row0 >= row1 or col0 >= col1:
+        return np.zeros(0)
+    cellRows, cellCols = np.nonzero(np.asarray(mask[row0:row1, col0:col1]))
+    cx, cy = grid.cellCenters(cellRows+row0, cellCols+col0)
+    dist = np.hypot(cx-x, cy-y)
+    return dist[dist <= radius]
@@ -0,0 +1,166 @@
+# Buffer radius updates for the confined farm convergence loop. The loop used to grow every non-converged buffer by
+# sqrt(f*ADiff + 1), with the damping factor f stepping through 1, 0.75, 0.5 and 0.1 as the global Conv fraction
+# dropped. That converges slowly and oscillates for grouped buffers, because every farm gets the same damping no
+# matter how its own area is responding.
+#
+# RadiusHistory keeps each farm's (radius, clipped area) from earlier iterations and picks one of two strategies:
+#   'damped' - the old schedule, kept so results can be compared
+#   'secant' - a safeguarded secant step on sqrt(clipped area) - sqrt(required area), which is close to linear in
+#              the radius. The step is kept inside the bracket of radii already known to be too small / big enough,
+#              falls back to bisection when the secant leaves the bracket, and falls back to the undamped
+#              sqrt(ADiff + 1) step when there is no usable history yet. A farm's bracket and history only hold while
+#              its group stays the same, so they are reset when the group's required area changes or the bracket
+#              has closed, instead of pinning the farm to an old radius.
+# Both are vectorized over all farms. The history also records the iteration each farm converged on, so the two
+# strategies can be compared with iterationReport().
+
+import numpy as np
+
+# Largest step allowed in one iteration. The loop caps ADiff at 40, so the old schedule never grew a radius by more than sqrt(41)
+maxGrowth = 41**0.5
+
+
+class RadiusHistory(object):
+
+    def __init__(self, threshold, method='secant'):
+        # threshold: ReqAreaThreshold - farms with ADiff above it have not converged
+        if method not in ('secant', 'damped'):
+            raise ValueError("method must be 'secant' or 'damped', not "+str(method))
+        self.threshold = threshold
+        self.method = method
+        self.iteration = 0
+        self.rowOfID = dict()
+        self.prevRadius = np.zeros(0)
+        self.prevResidual = np.zeros(0)
+        self.prevReqArea = np.zeros(0)
+        self.low = np.zeros(0)
+        self.high = np.zeros(0)
+        self.convergedAt = np.zeros(0, dtype=np.int64)
+        self.log = list()
+
+    def _rows(self, ids):
+        # History rows for the farm IDs, adding rows for farms that haven't been seen yet
+        newIDs = [i for i in ids if i not in self.rowOfID]
+        if newIDs:
+            start = len(self.rowOfID)
+            for k, i in enumerate(newIDs):
+                self.rowOfID[i] = start+k
+            nNew = len(newIDs)
+            self.prevRadius = np.concatenate((self.prevRadius, np.full(nNew, np.nan)))
+            self.prevResidual = np.concatenate((self.prevResidual, np.full(nNew, np.nan)))
+            self.prevReqArea = np.concatenate((self.prevReqArea, np.full(nNew, np.nan)))
+            self.low = np.concatenate((self.low, np.zeros(nNew)))
+            self.high = np.concatenate((self.high, np.full(nNew, np.inf)))
+            self.convergedAt = np.concatenate((self.convergedAt, np.zeros(nNew, dtype=np.int64)))
+        return np.array([self.rowOfID[i] for i in ids], dtype=np.int64)
+
+    def update(self, ids, radii, clipArea, reqArea, aDiff, conv):
+        # New radius for every farm. Farms with ADiff <= threshold keep their radius.
+        # ids: farm OBJECTIDs. radii: current RInit. clipArea: clipped area of the farm's group (F_AREA)
+        # reqArea: required area of the farm's group (SUM_Req_Area). aDiff: ADiff as calculated in the loop
+        # conv: fraction of farms not converged, only used by the 'damped' schedule
+        self.iteration += 1
+        rows = self._rows(ids)
+        radii = np.asarray(radii, dtype=np.float64)
+        clipArea = np.asarray(clipArea, dtype=np.float64)
+        reqArea = np.asarray(reqArea, dtype=np.float64)
+        aDiff = np.asarray(aDiff, dtype=np.float64)
+        # NaN ADiff (no clipped area) never counted as not converged in the UpdateCursor version either
+        notConverged = aDiff > self.threshold
+
+        # Keep track of when each farm converged. A farm can lose area to a neighbor and drop out again
+        converged = rows[~notConverged]
+        self.convergedAt[converged[self.convergedAt[converged] == 0]] = self.iteration
+        self.convergedAt[rows[notConverged]] = 0
+
+        # A farm that joined or left a group (its group's required area changed) has a different area curve, so its
+        # bracket and last step say nothing about it anymore
+        prevReqArea = self.prevReqArea[rows]
+        regrouped = ~np.isnan(prevReqArea) & ~np.isclose(prevReqArea, reqArea)
+        self._reset(rows[regrouped])
+        self.prevReqArea[rows] = reqArea
+
+        residual = np.sqrt(np.maximum(clipArea, 0)) - np.sqrt(np.maximum(reqArea, 0))
+        known = ~np.isnan(residual)
+        # Tighten each farm's bracket with this iteration's result
+        tooSmall = known & (residual < 0)
+        bigEnough = known & (residual >= 0)
+        self.low[rows[tooSmall]] = np.maximum(self.low[rows[tooSmall]], radii[tooSmall])
+        self.high[rows[bigEnough]] = np.minimum(self.high[rows[bigEnough]], radii[bigEnough])
+        # A closed bracket (low >= high) would keep bisecting to the same radius forever, e.g. when a neighbor's
+        # buffer changed the clipped area without changing the group. Only this iteration's result is kept
+        closed = self.low[rows] >= self.high[rows]
+        self._reset(rows[closed])
+        self.low[rows[closed & tooSmall]] = radii[closed & tooSmall]
+        self.high[rows[closed & bigEnough]] = radii[closed & bigEnough]
+
+        newRadii = radii.copy()
+        move = notConverged
+        growthStep = ((np.where(move, aDiff, 0)+1)**0.5)*radii
+        if self.method == 'damped':
+            newRadii[move] = ((dampingFactor(conv)*aDiff[move]+1)**0.5)*radii[move]
+        else:
+            r = radii[move]
+            h = residual[move]
+            prevR = self.prevRadius[rows[move]]
+            prevH = self.prevResidual[rows[move]]
+            low = self.low[rows[move]]
+            high = self.high[rows[move]]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                slope = (h - prevH)/(r - prevR)
+                secant = r - h/slope
+            # Only trust the secant if the area is growing with the radius
+            usable = np.isfinite(secant) & (slope > 0)
+            step = np.where(usable, secant, growthStep[move])
+            step = np.minimum(step, r*maxGrowth)
+            inside = (step > low) & (step < high)
+            bisect = np.where(np.isfinite(high), 0.5*(low+high), growthStep[move])
+            newRadii[move] = np.where(inside, step, bisect)
+
+        self.prevRadius[rows[known]] = radii[known]
+        self.prevResidual[rows[known]] = residual[known]
+        nNotConverged = int(notConverged.sum())
+        self.log.append({'iteration': self.iteration, 'notConverged': nNotConverged,
+                         'conv': nNotConverged/float(max(len(radii), 1)),
+                         'meanADiff': float(np.nanmean(aDiff)) if known.any() else float('nan')})
+        return newRadii
+
+    def _reset(self, rows):
+        self.low[rows] = 0
+        self.high[rows] = np.inf
+        self.prevRadius[rows] = np.nan
+        self.prevResidual[rows] = np.nan
+
+    def iterationReport(self):
+        # Summary of how fast farms converged. Farms still not converged are left out of the statistics
+        done = self.convergedAt[self.convergedAt > 0]
+        report = {'method': self.method, 'iterations': self.iteration, 'farms': len(self.convergedAt),
+                  'converged': len(done), 'log': list(self.log)}
+        if len(done):
+            report['meanIterationsToConverge'] = float(done.mean())
+            report['medianIterationsToConverge'] = float(np.median(done))
+            report['maxIterationsToConverge'] = int(done.max())
+            report['convergedByIteration'] = np.bincount(done, minlength=self.iteration+1)[1:].cumsum().tolist()
+        return report
+
+    def printReport(self):
+        report = self.iterationReport()
+        print('Radius update method: '+report['method']+', '+str(report['iterations'])+' iterations, '+
+              str(report['converged'])+' of '+str(report['farms'])+' farms converged')
+        if report['converged']:
+            print('Iterations to converge - mean: '+str(round(report['meanIterationsToConverge'], 2))+
+                  ', median: '+str(report['medianIterationsToConverge'])+', max: '+str(report['maxIterationsToConverge']))
+        for entry in report['log']:
+            print('  iteration '+str(entry['iteration'])+': not converged = '+str(entry['notConverged'])+
+                  ', Conv = '+str(round(entry['conv'], 4))+', mean ADiff = '+str(round(entry['meanADiff'], 4)))
+
+
+def dampingFactor(conv):
+    # The original schedule, including its handling of the boundaries (Conv exactly .1, .05 or .02 gets 0.1)
+    if conv > .1:
+        return 1.0
+    elif conv < .1 and conv > .05:
+        return 0.75
+    elif conv < .05 and conv > .02:
+        return 0.5
+    return 0.1
@@ -0,0 +1,336 @@
+# Lazy raster algebra for chains of Con/IsNull/SetNull/arithmetic like the ag mask in the manure model. With
+# arcpy.sa every step (conNLCD, conNLCD1, RectMinusBasin, conCDL_N...) is a whole 30 m raster of the Great Lakes
+# rectangle written to the scratch workspace, and the rectangle and basin masks each read the inputs again. Here the
+# same expressions only build a graph; evaluate() then runs every output through it one band of rows at a time:
+#   - each input is read once per band (arcpy.RasterToNumPyArray on the band, or a slice of a NumPy array, which
+#     can be a memory-mapped .npy), so memory is bounded by the band size, not the raster size
+#   - steps used by several outputs (conNLCD1, conGolf...) are only worked out once per band, and each step's band
+#     is dropped as soon as the last step using it has read it, so only the arrays still needed are held at a time
+#   - bands are independent, so they are spread over a thread pool. NumPy lets go of the GIL in its array
+#     operations; arcpy reads are done one at a time
+# Nulls follow the Spatial Analyst rules: arithmetic and comparisons are NoData where any input is NoData, Con is
+# NoData where the condition is, IsNull is never NoData. Each node returns (values, valid), with valid None when
+# every cell is valid.
+#
+# Usage is the same as arcpy.sa:
+#   nlcd = RasterAlgebra.Raster(rasterNLCD)
+#   mask = RasterAlgebra.Con((nlcd > 70) & (nlcd < 90), 1, 0)
+#   arrays = RasterAlgebra.evaluate([('mask', mask, np.uint8, 255)], grid)
+
+import os
+import threading
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+
+class Expr(object):
+    # Base of every node in the graph. Operators build new nodes instead of computing anything
+
+    def _evaluate(self, band, memo):
+        raise NotImplementedError
+
+    def children(self):
+        # Nodes this one reads. Inputs have none
+        return []
+
+    def evaluateBand(self, band, memo):
+        # (values, valid) of this node over a band, worked out once per band however many nodes use it. With the
+        # 'uses' counts of evaluate() in memo, the result is dropped from memo when its last user has it
+        key = id(self)
+        if key not in memo:
+            memo[key] = self._evaluate(band, memo)
+        result = memo[key]
+        uses = memo.get('uses')
+        if uses is not None and key in uses:
+            uses[key] -= 1
+            if uses[key] == 0:
+                del memo[key]
+        return result
+
+    def __add__(self, other):
+        return Operation(np.add, self, other)
+
+    def __radd__(self, other):
+        return Operation(np.add, other, self)
+
+    def __sub__(self, other):
+        return Operation(np.subtract, self, other)
+
+    def __rsub__(self, other):
+        return Operation(np.subtract, other, self)
+
+    def __mul__(self, other):
+        return Operation(np.multiply, self, other)
+
+    def __rmul__(self, other):
+        return Operation(np.multiply, other, self)
+
+    def __truediv__(self, other):
+        return Operation(np.true_divide, self, other)
+
+    def __rtruediv__(self, other):
+        return Operation(np.true_divide, other, self)
+
+    # Python 2 uses __div__ for /. Like arcpy.sa, dividing rasters always gives floats
+    __div__ = __truediv__
+    __rdiv__ = __rtruediv__
+
+    def __gt__(self, other):
+        return Operation(np.greater, self, other)
+
+    def __ge__(self, other):
+        return Operation(np.greater_equal, self, other)
+
+    def __lt__(self, other):
+        return Operation(np.less, self, other)
+
+    def __le__(self, other):
+        return Operation(np.less_equal, self, other)
+
+    def __eq__(self, other):
+        return Operation(np.equal, self, other)
+
+    def __ne__(self, other):
+        return Operation(np.not_equal, self, other)
+
+    def __and__(self, other):
+        return Operation(np.logical_and, self, other)
+
+    def __or__(self, other):
+        return Operation(np.logical_or, self, other)
+
+    def __invert__(self):
+        return Operation(np.logical_not, self)
+
+    # __eq__ is overloaded, so nodes are hashed by identity
+    __hash__ = object.__hash__
+
+
+class Constant(Expr):
+
+    def __init__(self, value):
+        self.value = value
+
+    def _evaluate(self, band, memo):
+        return self.value, None
+
+
+class ArrayInput(Expr):
+    # A NumPy array on the evaluation grid, e.g. np.load(path, mmap_mode='r'). noData marks the NoData cells
+
+    def __init__(self, array, noData=None):
+        self.array = array
+        self.noData = noData
+
+    def _evaluate(self, band, memo):
+        row0, row1 = band
+        values = np.asarray(self.array[row0:row1])
+        if self.noData is None:
+            return values, None
+        return values, values != self.noData
+
+
+class RasterInput(Expr):
+    # An arcpy raster (path or Raster object), read one band at a time with RasterToNumPyArray. Cells outside the
+    # raster are NoData
+
+    readLock = threading.Lock()
+
+    def __init__(self, path, noData=None):
+        self.path = path
+        self.noData = noData
+
+    def _evaluate(self, band, memo):
+        import arcpy
+        row0, row1 = band
+        window = memo['grid'].window(row0, row1, 0, memo['grid'].nCols)
+        with self.readLock:
+            if self.noData is None:
+                raster = self.path if isinstance(self.path, arcpy.Raster) else arcpy.Raster(self.path)
+                self.noData = _noDataValue(raster)
+            values = arcpy.RasterToNumPyArray(self.path, window.lowerLeft(), window.nCols, window.nRows, self.noData)
+        return values, values != self.noData
+
+
+class Operation(Expr):
+
+    def __init__(self, function, *operands):
+        self.function = function
+        self.operands = [_node(operand) for operand in operands]
+
+    def children(self):
+        return self.operands
+
+    def _evaluate(self, band, memo):
+        results = [operand.evaluateBand(band, memo) for operand in self.operands]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            values = self.function(*[result[0] for result in results])
+        return values, _allValid([result[1] for result in results])
+
+
+class ConExpr(Expr):
+
+    def __init__(self, condition, trueValue, falseValue):
+        self.condition = _node(condition)
+        self.trueValue = _node(trueValue)
+        self.falseValue = None if falseValue is None else _node(falseValue)
+
+    def children(self):
+        return [self.condition, self.trueValue] + ([] if self.falseValue is None else [self.falseValue])
+
+    def _evaluate(self, band, memo):
+        condition, conditionValid = self.condition.evaluateBand(band, memo)
+        condition = np.asarray(condition, dtype=bool)
+        trueValues, trueValid = self.trueValue.evaluateBand(band, memo)
+        if self.falseValue is None:
+            falseValues, falseValid = 0, False
+        else:
+            falseValues, falseValid = self.falseValue.evaluateBand(band, memo)
+        values = np.where(condition, trueValues, falseValues)
+        if trueValid is None and falseValid is None:
+            valid = None
+        else:
+            valid = np.where(condition, True if trueValid is None else trueValid,
+                             True if falseValid is None else falseValid)
+        return values, _allValid([conditionValid, valid])
+
+
+class IsNullExpr(Expr):
+
+    def __init__(self, operand):
+        self.operand = _node(operand)
+
+    def children(self):
+        return [self.operand]
+
+    def _evaluate(self, band, memo):
+        values, valid = self.operand.evaluateBand(band, memo)
+        if valid is None:
+            return np.zeros(np.shape(values), dtype=np.uint8), None
+        return (~valid).astype(np.uint8), None
+
+
+def Raster(source, noData=None):
+    # Input node: a raster path or arcpy Raster (read with arcpy), or a NumPy array on the evaluation grid
+    if isinstance(source, np.ndarray):
+        return ArrayInput(source, noData)
+    return RasterInput(source, noData)
+
+
+def Con(condition, trueValue, falseValue=None):
+    # Like arcpy.sa.Con. falseValue None gives NoData where the condition is false
+    return ConExpr(condition, trueValue, falseValue)
+
+
+def IsNull(operand):
+    return IsNullExpr(operand)
+
+
+def SetNull(condition, value):
+    # Like arcpy.sa.SetNull: NoData where the condition is true, value elsewhere
+    return ConExpr(Operation(np.logical_not, condition), value, None)
+
+
+def evaluate(outputs, grid, bandRows=512, workers=1, outFolder=None, onBand=None, keep=()):
+    # Works out every output in one pass over the bands of the grid. outputs: list of (name, expr, dtype, noDataValue).
+    # Returns a dict of name -> 2D array with NoData cells set to noDataValue. With outFolder the arrays are
+    # memory-mapped .npy files in it (<name>.npy) instead of being held in memory. onBand(band, memo) is called once
+    # the outputs of a band are done, with the band's evaluated nodes still in memo, so other sums of the same layers
+    # (see MassBalance.py) don't need a pass of their own. With workers > 1 it is called from several threads at once.
+    # Other nodes are dropped from memo once used, so the nodes onBand reads have to be listed in keep
+    results = dict()
+    for name, expr, dtype, noDataValue in outputs:
+        if outFolder is None:
+            results[name] = np.empty(grid.shape, dtype=dtype)
+        else:
+            if not os.path.isdir(outFolder):
+                os.makedirs(outFolder)
+            results[name] = np.lib.format.open_memmap(os.path.join(outFolder, name+'.npy'), 'w+', dtype, grid.shape)
+    bands = [(row0, min(row0+bandRows, grid.nRows)) for row0 in range(0, grid.nRows, bandRows)]
+    roots = [_node(expr) for name, expr, dtype, noDataValue in outputs]
+    uses = _useCounts(roots, keep)
+
+    def runBand(band):
+        memo = {'grid': grid, 'uses': dict(uses)}
+        row0, row1 = band
+        for root, (name, expr, dtype, noDataValue) in zip(roots, outputs):
+            values, valid = root.evaluateBand(band, memo)
+            # Assignment broadcasts constants to the whole band
+            out = results[name][row0:row1]
+            out[...] = values if valid is None else np.where(valid, values, noDataValue)
+        if onBand is not None:
+            onBand(band, memo)
+
+    if workers <= 1:
+        for band in bands:
+            runBand(band)
+    else:
+        pool = ThreadPool(workers)
+        try:
+            pool.map(runBand, bands, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    for array in results.values():
+        if isinstance(array, np.memmap):
+            array.flush()
+    return results
+
+
+def toRaster(array, grid, noDataValue, spatialReference=None, path=None):
+    # arcpy Raster from an evaluated output, saved to path if one is given
+    import arcpy
+    raster = arcpy.NumPyArrayToRaster(array, grid.lowerLeft(), grid.cellSize, grid.cellSize, noDataValue)
+    if path is not None:
+        raster.save(path)
+        if spatialReference is not None:
+            arcpy.DefineProjection_management(path, spatialReference)
+        raster = arcpy.Raster(path)
+    return raster
+
+
+def _useCounts(roots, keep=()):
+    # How many times each node is read in a band: once by every node using it (each node is only worked out once per
+    # band) and once per output it is. Nodes in keep are left out, so they are never dropped
+    uses = dict()
+    seen = set()
+    stack = list(roots)
+    for root in roots:
+        uses[id(root)] = uses.get(id(root), 0) + 1
+    while stack:
+        node = stack.pop()
+        if id(node) in seen:
+            continue
+        seen.add(id(node))
+        for child in node.children():
+            uses[id(child)] = uses.get(id(child), 0) + 1
+            stack.append(child)
+    for node in keep:
+        uses.pop(id(node), None)
+    return uses
+
+
+def _node(value):
+    return value if isinstance(value, Expr) else Constant(value)
+
+
+def _allValid(valids):
+    # Cells valid in every operand. None means all cells are valid
+    valids = [v for v in valids if v is not None]
+    if not valids:
+        return None
+    valid = valids[0]
+    for v in valids[1:]:
+        valid = valid & v
+    return valid
+
+
+def _noDataValue(raster):
+    # NoData value to read a raster with. Rasters without one still need a value for cells outside their extent
+    if raster.noDataValue is not None:
+        return raster.noDataValue
+    pixelType = str(raster.pixelType)
+    if pixelType.startswith('U'):
+        return 2**int(pixelType[1:])-1
+    return -9999
@@ -0,0 +1,72 @@
+# Description of the 30 m snap grid used by the manure model rasters, for going between map coordinates
+# (Albers, meters) and row/column indices of NumPy arrays made with arcpy.RasterToNumPyArray.
+# Row 0 is the top (north) row, the same way RasterToNumPyArray and NumPyArrayToRaster lay out arrays.
+
+import numpy as np
+
+
+class RasterGrid(object):
+
+    def __init__(self, xMin, yMax, cellSize, nRows, nCols):
+        self.xMin = float(xMin)
+        self.yMax = float(yMax)
+        self.cellSize = float(cellSize)
+        self.nRows = int(nRows)
+        self.nCols = int(nCols)
+
+    @classmethod
+    def fromRaster(cls, raster):
+        # Grid of an arcpy Raster object (or path to a raster)
+        import arcpy
+        if not isinstance(raster, arcpy.Raster):
+            raster = arcpy.Raster(raster)
+        extent = raster.extent
+        return cls(extent.XMin, extent.YMax, raster.meanCellWidth, raster.height, raster.width)
+
+    @property
+    def shape(self):
+        return (self.nRows, self.nCols)
+
+    @property
+    def xMax(self):
+        return self.xMin + self.nCols*self.cellSize
+
+    @property
+    def yMin(self):
+        return self.yMax - self.nRows*self.cellSize
+
+    @property
+    def cellArea(self):
+        return self.cellSize*self.cellSize
+
+    def lowerLeft(self):
+        # For arcpy.NumPyArrayToRaster
+        import arcpy
+        return arcpy.Point(self.xMin, self.yMin)
+
+    def rowCol(self, x, y):
+        # Row and column of the cell containing each point. Points outside the grid get indices outside
+        # 0..nRows-1 / 0..nCols-1, check them with inside()
+        rows = np.floor((self.yMax - np.asarray(y, dtype=np.float64))/self.cellSize).astype(np.int64)
+        cols = np.floor((np.asarray(x, dtype=np.float64) - self.xMin)/self.cellSize).astype(np.int64)
+        return rows, cols
+
+    def inside(self, rows, cols):
+        return (rows >= 0) & (rows < self.nRows) & (cols >= 0) & (cols < self.nCols)
+
+    def cellCenters(self, rows, cols):
+        x = self.xMin + (np.asarray(cols) + 0.5)*self.cellSize
+        y = self.yMax - (np.asarray(rows) + 0.5)*self.cellSize
+        return x, y
+
+    def flatIndex(self, rows, cols):
+        return np.asarray(rows, dtype=np.int64)*self.nCols + np.asarray(cols, dtype=np.int64)
+
+    def window(self, row0, row1, col0, col1):
+        # Grid of a sub-window (rows row0:row1, columns col0:col1)
+        return RasterGrid(self.xMin + col0*self.cellSize, self.yMax - row0*self.cellSize, self.cellSize,
+                          row1-row0, col1-col0)
+
+    def sameAs(self, other):
+        return (abs(self.xMin-other.xMin) < 1e-6*self.cellSize and abs(self.yMax-other.yMax) < 1e-6*self.cellSize and
+                self.cellSize == other.cellSize and self.shape == other.shape)
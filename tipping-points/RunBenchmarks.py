@@ -0,0 +1,223 @@
+# Times the hot paths of the manure model on a synthetic landscape (see SyntheticLandscape.py), so speedups and
+# regressions can be measured without the S:\ drive inputs or arcpy. Each step runs the same helper modules the model
+# script does, on the same kind of data:
+#   ag mask           - the Con/IsNull/SetNull graph of the 'ag mask' stage, evaluated band by band and bit-packed
+#   focal area        - FocalSum of the ag mask at the focal distance, stored as uint32 counts
+#   exclusion test    - PlacementZones from the county and focal area rasters, and Req_Area > FocalArea for every bin
+#                       and county at once
+#   placement         - BinPlacement of the confined farms over the placement workers
+#   buffer convergence - radial profiles, then groupCircles / groupAreas / RadiusHistory until Conv <= ConvThreshold
+#   final summation   - pasture rates + unrecovered loads (sparse) + confined manure, evaluated band by band
+#
+#   python RunBenchmarks.py            - the 'small' scale
+#   python RunBenchmarks.py large      - any of the scales below
+#
+# Every step is a RunTrace record (wall, CPU, memory) appended to pathBenchmarks with the scale's settings, and each run
+# is compared with the last earlier run of the same scale, step by step. The Benchmarks folder (scratch landscapes of
+# several GB at the large scale, and the records) is left out of git.
+
+import json
+import os
+import shutil
+import sys
+
+import numpy as np
+
+import BinPlacement
+import BufferGroups
+import CompactRaster
+import FarmPlacement
+import FocalSum
+import PointRaster
+import RadiusUpdate
+import RasterAlgebra
+import SyntheticLandscape
+from PackedMask import PackedMask
+from RadialProfile import RadialProfiles
+from RunTrace import RunTrace
+from SparseRaster import SparseRaster
+
+pathBenchmarks = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Benchmarks')
+benchmarkWorkers = 4 # Raster threads and placement processes
+
+# Landscape settings (see SyntheticLandscape.generate) and model parameters of each scale. focalDist is in cells
+scales = {
+    'small': {'nRows': 1000, 'nCols': 1000, 'nCounties': 12, 'nBins': 6, 'confinedFarms': 300, 'pastureFarms': 600,
+              'cafos': 50, 'focalDist': 50},
+    'medium': {'nRows': 4000, 'nCols': 4000, 'nCounties': 40, 'nBins': 10, 'confinedFarms': 2000, 'pastureFarms': 4000,
+               'cafos': 300, 'focalDist': 200},
+    'large': {'nRows': 12000, 'nCols': 12000, 'nCounties': 120, 'nBins': 15, 'confinedFarms': 8000,
+              'pastureFarms': 16000, 'cafos': 1000, 'focalDist': 667},
+}
+agFraction = 0.45
+pastureFraction = 0.1
+ReqAreaThreshold = .05
+ConvThreshold = .04
+maxIterations = 40
+pastureAssimilation = .0084
+seed = 2017
+
+
+def agMask(land, folder):
+    nlcd = RasterAlgebra.Raster(land.nlcd, 0)
+    cdlN = RasterAlgebra.Raster(land.cdlN, SyntheticLandscape.noDataDemand)
+    cdlP = RasterAlgebra.Raster(land.cdlP, SyntheticLandscape.noDataDemand)
+    conNLCD = RasterAlgebra.Con((nlcd > 70) & (nlcd < 90), 1, 0)
+    conNLCD1 = RasterAlgebra.Con(RasterAlgebra.IsNull(conNLCD), 0, conNLCD)
+    rectMinusBasin = RasterAlgebra.Raster(land.basinRect, 255) - conNLCD1
+    conCDL_N = RasterAlgebra.Con(cdlN == 0, 0, 1)
+    conCDL_P = RasterAlgebra.Con(cdlP == 0, 0, 1)
+    conGolf = RasterAlgebra.Con(RasterAlgebra.IsNull(RasterAlgebra.Raster(land.golf, 255)), 1, 0)
+    basin = ((RasterAlgebra.Con(RasterAlgebra.IsNull(conCDL_N), 0, conCDL_N) +
+              RasterAlgebra.Con(RasterAlgebra.IsNull(conCDL_P), 0, conCDL_P))*conNLCD1*conGolf)
+    masks = RasterAlgebra.evaluate([('AgMaskRect', RasterAlgebra.Con(basin + rectMinusBasin == 0, 0, 1), np.uint8, 255),
+                                    ('AgCellsBasin', RasterAlgebra.SetNull(RasterAlgebra.Con(basin == 0, 0, 1) == 0, 1), np.uint8, 0)],
+                                   land.grid, workers=benchmarkWorkers, outFolder=folder)
+    return CompactRaster.saveMask(os.path.join(folder, 'Ag_Mask_Rect.npy'), RasterAlgebra.Raster(masks['AgMaskRect'], 255), land.grid)
+
+
+def focalArea(land, maskAg, focalDist, folder):
+    counts = CompactRaster.createCounts(os.path.join(folder, 'FocalArea.npy'), land.grid, land.grid.cellArea)
+    FocalSum.focalSumsTiled(maskAg, [focalDist], out=[counts])
+    for row0 in range(0, counts.shape[0], 1024):
+        band = counts[row0:row0+1024]
+        band[band == 0] = CompactRaster.noDataCount
+    counts.flush()
+    del counts
+    return CompactRaster.load(os.path.join(folder, 'FocalArea.npy'))
+
+
+def binTasks(land, table, requiredArea):
+    tasks = list()
+    for binID in range(1, land.nBins+1):
+        rows = table['GMEID'] == binID
+        tasks.append((binID, table['CtyID'][rows], table['Operations'][rows],
+                      None if requiredArea is None else requiredArea[rows]))
+    return tasks
+
+
+def confinedRequiredArea(land):
+    # Req_Area of a farm: its P load at the county's average confined rate (AvgR, capped at the 90th percentile)
+    loads = land.countyLoads
+    avgR = loads['kgP_year']/loads['Man_m2']
+    avgR = np.minimum(avgR, np.nanpercentile(avgR, 90))
+    return land.confined['kgP_farm_y']/avgR[loads.lookup(land.confined['CtyID'])]
+
+
+def exclusionTest(land, focal):
+    zones = FarmPlacement.PlacementZones.fromArrays(
+        np.where((np.asarray(land.nlcd) == 82) | (np.asarray(land.nlcd) == 81), land.counties, 0), land.grid,
+        np.nan_to_num(focal[:, :]))
+    fraction, fullyExcluded = zones.exclusion(land.confined['CtyID'], confinedRequiredArea(land))
+    return zones, int(fullyExcluded.sum())
+
+
+def placement(land, zones, folder):
+    tasks = binTasks(land, land.confined, confinedRequiredArea(land))
+    placed = BinPlacement.placeBins(zones, tasks, seed, 0, benchmarkWorkers, os.path.join(folder, 'Placement'))
+    farms = FarmPlacement.concatenate([placed[binID] for binID, _, _, _ in tasks])
+    rows = np.concatenate([np.flatnonzero(land.confined['GMEID'] == binID) for binID, _, _, _ in tasks])
+    return farms, rows[farms.request]
+
+
+def bufferConvergence(land, maskAg, farms, farmRows, focalDist):
+    # The loop of the 'convergence' stage on the ag mask plus the CAFO cells
+    maskAvailable = PackedMask(np.array(maskAg.bits), land.grid)
+    maskAvailable.setPoints(land.cafoX, land.cafoY)
+    ids = np.arange(1, len(farms)+1)
+    reqArea = np.asarray(confinedRequiredArea(land))[farmRows]
+    profiles = RadialProfiles.build(maskAvailable, land.grid, farms.x, farms.y, reqArea, focalDist*land.grid.cellSize)
+    radii = profiles.radiusForArea(reqArea)
+    radii = np.where(np.isnan(radii), (reqArea/np.pi)**0.5, radii)
+    history = RadiusUpdate.RadiusHistory(ReqAreaThreshold)
+    cache = BufferGroups.GroupAreaCache()
+    conv = 1.
+    iteration = 0
+    while conv > ConvThreshold and iteration < maxIterations:
+        groups = BufferGroups.groupCircles(farms.x, farms.y, radii)
+        dirty = cache.dirtyFarms(ids, groups, radii)
+        if dirty.any():
+            cache.record(*maskAvailable.groupAreas(farms.x[dirty], farms.y[dirty], radii[dirty], groups[dirty]))
+        clipArea = cache.farmAreas()
+        groupReq = np.bincount(groups, weights=reqArea)[groups]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            aDiff = np.clip((groupReq-clipArea)/clipArea, 0, 40)
+        aDiff[reqArea < (land.grid.cellSize/2)**2] = 0
+        iteration += 1
+        conv = float((aDiff > ReqAreaThreshold).sum())/max(len(radii), 1)
+        radii = history.update(ids, radii, clipArea, groupReq, aDiff, conv)
+    return maskAvailable, radii, groups, iteration, conv
+
+
+def finalSummation(land, maskAvailable, farms, farmRows, radii, groups, folder):
+    grid = land.grid
+    # Pasture N and P rates on pasture cells, as the pasture stage saves them
+    pastureN = CompactRaster.saveRates(os.path.join(folder, 'PastureN.npy'),
+                                       RasterAlgebra.Con(RasterAlgebra.Raster(land.nlcd, 0) == 81, 5*pastureAssimilation, 0), grid)
+    pastureP = CompactRaster.saveRates(os.path.join(folder, 'PastureP.npy'),
+                                       RasterAlgebra.Con(RasterAlgebra.Raster(land.nlcd, 0) == 81, pastureAssimilation, 0), grid)
+    # Unrecovered loads on the farm cells, and the confined manure spread evenly over each group's cells
+    loadN = land.confined['kgN_farm_y'][farmRows]
+    loadP = land.confined['kgP_farm_y'][farmRows]
+    unrecovered = PointRaster.accumulate(grid, farms.x, farms.y, [('N', 0.1*loadN), ('P', 0.1*loadP)])
+    cellGroups = maskAvailable.circleCells(farms.x, farms.y, radii, groups)
+    cellsPerGroup = np.maximum(np.bincount(cellGroups.values, minlength=groups.max()+1), 1)
+    manure = dict()
+    for name, loads in (('N', loadN), ('P', loadP)):
+        perCell = 0.9*np.bincount(groups, weights=loads, minlength=groups.max()+1)/cellsPerGroup
+        manure[name] = SparseRaster(grid, cellGroups.cells, perCell[cellGroups.values]).band(0, grid.nRows, np.float32)
+    totals = RasterAlgebra.evaluate([('NManureTotal', pastureN + unrecovered.sparse('N') + RasterAlgebra.Raster(manure['N']), np.float32, -1),
+                                     ('PManureTotal', pastureP + unrecovered.sparse('P') + RasterAlgebra.Raster(manure['P']), np.float32, -1)],
+                                    grid, workers=benchmarkWorkers, outFolder=folder)
+    return dict((name, float(np.asarray(array, dtype=np.float64).sum())) for name, array in totals.items())
+
+
+def compareRuns(path, trace, scale):
+    # Wall time of every step against the last earlier run of the same scale
+    previous = dict()
+    with open(path) as f:
+        for line in f:
+            record = json.loads(line)
+            if record.get('scale') == scale and record['run'] != trace.runID:
+                if previous.get(record['name'], {}).get('run', '') <= record['run']:
+                    previous[record['name']] = record
+    print('%-30s %12s %12s %8s' % ('step', 'wall s', 'before s', 'ratio'))
+    for record in trace.records:
+        before = previous.get(record['name'])
+        if before is None:
+            print('%-30s %12.2f %12s %8s' % (record['name'], record['wall'], '-', '-'))
+        else:
+            print('%-30s %12.2f %12.2f %8.2f' % (record['name'], record['wall'], before['wall'],
+                                                 record['wall']/max(before['wall'], 1e-3)))
+
+
+if __name__ == '__main__':
+    scale = sys.argv[1] if len(sys.argv) > 1 else 'small'
+    settings = dict(scales[scale])
+    focalDist = settings.pop('focalDist')
+    folder = os.path.join(pathBenchmarks, 'Scratch_'+scale)
+    if os.path.isdir(folder):
+        shutil.rmtree(folder)
+    tracePath = os.path.join(pathBenchmarks, 'Benchmarks.jsonl')
+    trace = RunTrace(tracePath, tracePython=True)
+    tags = dict(settings, scale=scale, focalDist=focalDist)
+    with trace.span('landscape', **tags):
+        land = SyntheticLandscape.generate(agFraction=agFraction, pastureFraction=pastureFraction, seed=seed,
+                                           folder=os.path.join(folder, 'Landscape'), **settings)
+    with trace.span('ag mask', **tags) as fields:
+        maskAg = agMask(land, folder)
+        fields['agCells'] = maskAg.count()
+    with trace.span('focal area', **tags):
+        focal = focalArea(land, maskAg, focalDist, folder)
+    with trace.span('exclusion test', **tags) as fields:
+        zones, fields['fullyExcluded'] = exclusionTest(land, focal)
+    with trace.span('placement', **tags) as fields:
+        farms, farmRows = placement(land, zones, folder)
+        fields['farms'] = len(farms)
+    del zones
+    with trace.span('buffer convergence', **tags) as fields:
+        maskAvailable, radii, groups, fields['iterations'], fields['Conv'] = bufferConvergence(land, maskAg, farms, farmRows, focalDist)
+    with trace.span('final summation', **tags) as fields:
+        fields.update(finalSummation(land, maskAvailable, farms, farmRows, radii, groups, folder))
+    trace.printSummary()
+    compareRuns(tracePath, trace, scale)
@@ -0,0 +1,71 @@
+# Monte Carlo ensemble of the random farm placement: runs Animal_Waste_Update2017_JAR.py for ensembleSize placement
+# seeds (see ModelSweep.py, the stages before confined placement are run once) and keeps per-cell mean, variance,
+# standard deviation and exceedance probability layers of the N and P manure totals (see EnsembleStats.py), instead of
+# every realization's rasters.
+#
+#   python RunEnsemble.py
+#
+# Each realization is added to the statistics as soon as it finishes, and its folder is deleted unless
+# keepRealizations is set, so disk use doesn't grow with the ensemble size either.
+
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+import ModelSweep
+from EnsembleStats import CellStats
+from RunManureModel import pathStageCache, scriptPath, stages
+
+pathEnsemble = 'S:\\Users\\roushjac\\Tipping Points\\Manure\\Script\\Python\\Outputs\\Ensemble'
+ensembleSize = 50 # Number of placement seeds
+ensembleFirstSeed = 1 # Seeds ensembleFirstSeed, ensembleFirstSeed+1, ...
+ensembleWorkers = 4 # Realizations run at the same time
+keepRealizations = False
+# Cells above these totals are counted for the exceedance probability layers (same units as NManureTotal/PManureTotal)
+thresholdsN = [.01, .02]
+thresholdsP = [.0025, .005]
+
+layers = [('NManureTotal', thresholdsN), ('PManureTotal', thresholdsP)]
+
+
+def realization(namespace):
+    # Final N and P arrays of a realization, and the grid they are on
+    result = dict((name, os.path.join(namespace['pathRasterScratch'], name+'.npy')) for name, _ in layers)
+    result['Grid'] = namespace['gridNLCD']
+    return result
+
+
+if __name__ == '__main__':
+    stats = dict()
+
+    def addRealization(row):
+        grid = row.pop('Grid', None)
+        if 'Error' in row:
+            return
+        for name, thresholds in layers:
+            if name not in stats:
+                stats[name] = CellStats(os.path.join(pathEnsemble, 'Running', name), grid, thresholds)
+            values = np.load(row[name], mmap_mode='r')
+            stats[name].add(values, -1)
+            # The memory map has to be closed before its folder can be deleted on Windows
+            del values
+        if not keepRealizations:
+            shutil.rmtree(os.path.join(pathEnsemble, row['Scenario']))
+        print(row['Scenario']+' added, '+str(stats[layers[0][0]].realizations)+' realizations so far')
+
+    sweep = ModelSweep.Sweep(scriptPath, pathStageCache, stages, pathEnsemble,
+                             workspaces=['outDir', 'scratchWork'],
+                             folders=['pathRasterScratch', 'pathPlacementScratch', 'pathSparseRasters'],
+                             environment={'workspace': 'outDir', 'scratchWorkspace': 'scratchWork'},
+                             collect=realization, workers=ensembleWorkers)
+    seeds = list(range(ensembleFirstSeed, ensembleFirstSeed+ensembleSize))
+    rows = sweep.run({'paramPlacementSeed': seeds}, addRealization)
+    for name, _ in layers:
+        if name in stats:
+            paths = stats[name].save(os.path.join(pathEnsemble, name))
+            print(name+': '+', '.join(sorted(paths)))
+    table = pd.DataFrame(rows)
+    table = table[[column for column in ['Scenario', 'paramPlacementSeed', 'Minutes', 'Error'] if column in table.columns]]
+    table.to_csv(os.path.join(pathEnsemble, 'Ensemble_Runs.csv'), index=False)
@@ -0,0 +1,51 @@
+# Runs Animal_Waste_Update2017_JAR.py stage by stage with ModelPipeline.py, so a rerun after changing a parameter
+# or after a crash only redoes the stages that are affected, instead of starting over from the ag mask.
+#
+#   python RunManureModel.py                      - run every stage that is out of date
+#   python RunManureModel.py "pasture placement"  - also rerun that stage, and everything after it
+#
+# The stage names match the [stage: ...] tags on the #%% cells of the model script. Stage keys and checkpoints are
+# kept in pathStageCache. Delete that folder to start from scratch.
+
+import os
+import sys
+
+from ModelPipeline import Pipeline, Stage
+
+scriptPath = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Animal_Waste_Update2017_JAR.py')
+pathStageCache = 'S:\\Users\\roushjac\\Tipping Points\\Manure\\Script\\Python\\Outputs\\StageCache'
+
+# params/inputs/outputs/values are names of variables set in the script's setup cell (see ModelPipeline.Stage).
+# Outputs that aren't script variables are dataset names in the output workspace
+stages = [
+    # TableToTable doesn't work with 64 bit background processing, so the input tables are still made in ArcMap
+    Stage('input tables', manual=True),
+    Stage('ag mask',
+          inputs=['rasterNFertilizerDemand', 'rasterPFertilizerDemand', 'rasterNLCD', 'rasterNLCDRect', 'featureGolfCourses'],
+          outputs=['pathAgMaskBits', 'featureTempAllFertilzedCellsRect', 'featureTempAllFertilzedCells']),
+    Stage('focal area',
+          params=['paramFocalDist', 'paramFocalDistSweep', 'cellSize'],
+          outputs=['pathFocalCounts']),
+    Stage('county rates',
+          params=['paramAvgRCapPercentile'],
+          inputs=['featureCounties', 'tableManureArea', 'tableManureTotal'],
+          outputs=['featureTempCountyManureArea', 'featureTempCountyManureClip']),
+    Stage('confined placement',
+          params=['paramPlacementSeed'],
+          inputs=['tableAllCAFOs', 'tableFarmCountsCon', 'featureCounties'],
+          outputs=['featureTempConfinedHerds', 'ConfinedFarmsclean'],
+          values=['pointSourceBinCounties', 'pointSourceBinCountiesFinal']),
+    Stage('pasture placement',
+          params=['paramFocalDistPasture', 'paramFocalDistPastureSweep', 'paramPastureAssimiliation', 'paramPlacementSeed'],
+          inputs=['tableFarmCountsPast', 'featureCounties'],
+          outputs=['featureWasteBuffersClipPast', 'pathAvailableMask', 'pathPastureNRates', 'pathPasturePRates']),
+    Stage('convergence',
+          params=['ReqAreaThreshold', 'ConvThreshold', 'paramRadiusUpdate', 'paramMaxIterations', 'paramFocalDist'],
+          outputs=['featureTempConfinedFarms', 'featureWasteBuffersClip', 'tableGroupedBuffers']),
+    Stage('final rasters',
+          inputs=['tableManureTotal', 'tableFarmCountsPast', 'featureCounties'],
+          outputs=['outCAFOArea', 'NManureTotal', 'PManureTotal']),
+]
+
+if __name__ == '__main__':
+    Pipeline(scriptPath, pathStageCache, stages).run(force=sys.argv[1:])
@@ -0,0 +1,48 @@
+# Runs Animal_Waste_Update2017_JAR.py for every combination of the parameter values in sweepGrid (see ModelSweep.py)
+# and writes the basin N and P manure totals of every scenario to one table.
+#
+#   python RunParameterSweep.py
+#
+# The stages before the first one a swept parameter affects are run once, with the stage cache of RunManureModel.py,
+# so a sweep of the convergence thresholds starts from the placed farms of the last normal run. Each scenario's
+# outputs are kept in its own folder under pathSweep.
+
+import os
+
+import pandas as pd
+
+import ModelSweep
+from RunManureModel import pathStageCache, scriptPath, stages
+
+pathSweep = 'S:\\Users\\roushjac\\Tipping Points\\Manure\\Script\\Python\\Outputs\\ParameterSweep'
+sweepWorkers = 4 # Scenarios run at the same time. Each one also uses the model's own placement and raster workers
+
+# Parameter name -> values to run. Only the stages from the first one with one of these in its params are run for
+# every scenario ('county rates' for paramAvgRCapPercentile, 'pasture placement' for paramPastureAssimiliation,
+# 'convergence' for the thresholds)
+sweepGrid = {
+    'ReqAreaThreshold': [.025, .05, .1],
+    'ConvThreshold': [.02, .04, .08],
+    'paramPastureAssimiliation': [.0084],
+    'paramAvgRCapPercentile': [90],
+}
+
+
+def manureTotals(namespace):
+    # Basin totals of the final N and P rasters, kept as arrays in the scenario's pathRasterScratch
+    return dict((name, ModelSweep.rasterTotal(os.path.join(namespace['pathRasterScratch'], name+'.npy'), -1))
+                for name in ('NManureTotal', 'PManureTotal'))
+
+
+if __name__ == '__main__':
+    sweep = ModelSweep.Sweep(scriptPath, pathStageCache, stages, pathSweep,
+                             workspaces=['outDir', 'scratchWork'],
+                             folders=['pathRasterScratch', 'pathPlacementScratch', 'pathSparseRasters'],
+                             environment={'workspace': 'outDir', 'scratchWorkspace': 'scratchWork'},
+                             collect=manureTotals, workers=sweepWorkers)
+    rows = sweep.run(sweepGrid)
+    table = pd.DataFrame(rows)
+    columns = ['Scenario'] + sorted(sweepGrid) + ['NManureTotal', 'PManureTotal', 'Minutes', 'Error']
+    table = table[[column for column in columns if column in table.columns]]
+    table.to_csv(os.path.join(pathSweep, 'Sweep_Totals.csv'), index=False)
+    print(table)
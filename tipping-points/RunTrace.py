@@ -0,0 +1,185 @@
+# Timing and memory records of model runs, so the slow and memory hungry parts (FocalStatistics, the placement bins,
+# the convergence loop - all of which have run out of memory or frozen before) show up as numbers instead of ad hoc
+# print lines. Every record is one JSON object per line appended to the trace file, with:
+#   run      - ID of the run (start time and process ID), so runs appending to the same file can be told apart
+#   name     - what was timed, e.g. 'stage: focal area', 'placement bin', 'convergence iteration'
+#   started, wall, cpu  - start time (epoch seconds), wall and CPU seconds of this process
+#   rssMB, peakRSSMB    - resident memory of the process at the end, and its peak so far
+#   pyPeakMB            - peak of the Python (and NumPy) allocations while it ran, from tracemalloc
+# and any other fields given (binID, iteration, Conv, meanADiff...).
+#
+#   timer = runTrace.start('focal sums', radii=2)       record = timer.stop()
+#   with runTrace.span('county rates') as fields:       fields['counties'] = 83
+#   @runTrace.timed('load zones')
+#
+# ModelPipeline.py times every stage it runs with the script's runTrace and prints summary() at the end of the run.
+# Memory needs psutil or the resource module (not on Windows), tracemalloc needs Python 3. Without them those fields
+# are None.
+
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+try:
+    import resource
+except ImportError:
+    resource = None
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+def cpuSeconds():
+    # User + system CPU time of this process
+    times = os.times()
+    return times[0] + times[1]
+
+
+def memoryMB():
+    # (current, peak) resident memory of this process in MB. None for what can't be read here
+    current = peak = None
+    if psutil is not None:
+        info = psutil.Process(os.getpid()).memory_info()
+        current = info.rss/2.**20
+        if getattr(info, 'peak_wset', None) is not None:
+            # Windows keeps the peak working set
+            peak = info.peak_wset/2.**20
+    if peak is None and resource is not None:
+        maxRSS = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Bytes on macOS, KB elsewhere
+        peak = maxRSS/2.**20 if sys.platform == 'darwin' else maxRSS/2.**10
+    return current, peak
+
+
+class Timer(object):
+    # One timed piece of a run, from RunTrace.start
+
+    def __init__(self, trace, name, fields):
+        self.trace = trace
+        self.name = name
+        self.fields = fields
+        self.pyPeak = 0
+        self.started = time.time()
+        self.cpuStarted = cpuSeconds()
+
+    def stop(self, **fields):
+        # Records the time and memory since start, with fields added to the ones given there. Returns the record
+        wall = time.time() - self.started
+        cpu = cpuSeconds() - self.cpuStarted
+        pyPeak = self.trace._stopPython(self)
+        self.fields.update(fields)
+        rss, peakRSS = memoryMB()
+        return self.trace.record(self.name, wall, cpu, rssMB=rss, peakRSSMB=peakRSS, pyPeakMB=pyPeak,
+                                 started=self.started, **self.fields)
+
+
+class RunTrace(object):
+
+    def __init__(self, path=None, tracePython=False):
+        # path: JSON-lines file the records are appended to (None keeps them in memory only). tracePython: trace
+        # Python allocations with tracemalloc for pyPeakMB, which slows down pure Python loops somewhat
+        self.path = path
+        self.runID = time.strftime('%Y%m%d-%H%M%S')+'-'+str(os.getpid())
+        self.records = list()
+        self._open = list()
+        self.tracePython = tracePython and tracemalloc is not None
+        if self.tracePython and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if path is not None and os.path.dirname(path) and not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+
+    def start(self, name, **fields):
+        timer = Timer(self, name, fields)
+        if self.tracePython:
+            # The peak is reset for every timer, so the ones it is nested in keep the peak so far first
+            peak = tracemalloc.get_traced_memory()[1]
+            for other in self._open:
+                other.pyPeak = max(other.pyPeak, peak)
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+        self._open.append(timer)
+        return timer
+
+    def _stopPython(self, timer):
+        if timer in self._open:
+            self._open.remove(timer)
+        if not self.tracePython:
+            return None
+        peak = tracemalloc.get_traced_memory()[1]
+        for other in self._open:
+            other.pyPeak = max(other.pyPeak, peak)
+        return max(timer.pyPeak, peak)/2.**20
+
+    @contextmanager
+    def span(self, name, **fields):
+        # Times the with block. Fields set on the yielded dict are recorded too; an exception is recorded as 'error'
+        timer = self.start(name, **fields)
+        try:
+            yield timer.fields
+        except Exception as e:
+            timer.stop(error=repr(e))
+            raise
+        timer.stop()
+
+    def timed(self, name=None):
+        # Decorator timing every call of a function
+        def decorate(function):
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.span(name or function.__name__):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorate
+
+    def record(self, name, wall, cpu=None, **fields):
+        # Adds a record, e.g. one timed in another process (see BinPlacement.py)
+        record = {'run': self.runID, 'name': name, 'wall': round(wall, 3),
+                  'cpu': None if cpu is None else round(cpu, 3)}
+        record.setdefault('started', time.time()-wall)
+        for key, value in fields.items():
+            record[key] = value.item() if hasattr(value, 'item') else value
+        self.records.append(record)
+        if self.path is not None:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(record, sort_keys=True)+'\n')
+        return record
+
+    def summary(self):
+        # Per name, in the order they first finished: count, total and max wall seconds, total CPU seconds and the
+        # highest peak memory numbers
+        rows = list()
+        byName = dict()
+        for record in self.records:
+            if record['name'] not in byName:
+                byName[record['name']] = {'name': record['name'], 'count': 0, 'wall': 0., 'maxWall': 0., 'cpu': 0.,
+                                          'peakRSSMB': None, 'pyPeakMB': None}
+                rows.append(byName[record['name']])
+            row = byName[record['name']]
+            row['count'] += 1
+            row['wall'] += record['wall']
+            row['maxWall'] = max(row['maxWall'], record['wall'])
+            row['cpu'] += record['cpu'] or 0.
+            for key in ('peakRSSMB', 'pyPeakMB'):
+                if record.get(key) is not None:
+                    row[key] = max(row[key], record[key]) if row[key] is not None else record[key]
+        return rows
+
+    def printSummary(self):
+        lines = ['%-40s %6s %12s %12s %12s %12s %12s' % ('name', 'count', 'wall s', 'max wall s', 'cpu s',
+                                                          'peak RSS MB', 'py peak MB')]
+        for row in self.summary():
+            lines.append('%-40s %6d %12.1f %12.1f %12.1f %12s %12s' % (
+                row['name'][:40], row['count'], row['wall'], row['maxWall'], row['cpu'],
+                '-' if row['peakRSSMB'] is None else '%.0f' % row['peakRSSMB'],
+                '-' if row['pyPeakMB'] is None else '%.0f' % row['pyPeakMB']))
+        text = '\n'.join(lines)
+        print(text)
+        return text
@@ -0,0 +1,84 @@
+# Sparse rasters for layers that are almost all zero, like the unrecovered loads of the confined farms: a few
+# thousand loaded cells out of billions at 30 m. Only the loaded cells are kept, as sorted flat cell indices with a
+# value each (COO). Row offsets into them (CSR) are worked out when first needed, so a band of rows can be made
+# dense without searching the whole list.
+#
+# A SparseRaster is a RasterAlgebra expression node, so it can be added straight to dense rasters:
+#   total = RasterAlgebra.Raster(RasterPastureNnoNull) + unrecoveredN
+# and is only made dense one band at a time, when evaluate() reaches it. Cells without a value are 0, never NoData.
+# save() writes a compressed .npz of just the loaded cells.
+
+import numpy as np
+
+import RasterAlgebra
+from RasterGrid import RasterGrid
+
+
+class SparseRaster(RasterAlgebra.Expr):
+
+    def __init__(self, grid, cells, values):
+        # cells: flat cell indices on grid (any order, repeats are summed). values: one value per cell
+        cells = np.asarray(cells, dtype=np.int64)
+        values = np.asarray(values)
+        if len(cells) and (np.diff(cells) <= 0).any():
+            cells, inverse = np.unique(cells, return_inverse=True)
+            values = np.bincount(inverse.ravel(), weights=values, minlength=len(cells)).astype(values.dtype)
+        self.grid = grid
+        self.cells = cells
+        self.values = values
+        self._rowOffsets = None
+
+    @classmethod
+    def fromDense(cls, array, grid):
+        array = np.asarray(array)
+        cells = np.flatnonzero(array)
+        return cls(grid, cells, array.ravel()[cells])
+
+    def __len__(self):
+        return len(self.cells)
+
+    @property
+    def nbytes(self):
+        return self.cells.nbytes + self.values.nbytes
+
+    def rowOffsets(self):
+        # CSR row pointers: the cells of row r are cells[offsets[r]:offsets[r+1]]
+        if self._rowOffsets is None:
+            self._rowOffsets = np.searchsorted(self.cells, np.arange(self.grid.nRows+1, dtype=np.int64)*self.grid.nCols)
+        return self._rowOffsets
+
+    def band(self, row0, row1, dtype=None):
+        # Dense array of rows row0:row1
+        offsets = self.rowOffsets()
+        start, end = offsets[row0], offsets[row1]
+        out = np.zeros((row1-row0, self.grid.nCols), dtype=dtype or self.values.dtype)
+        out.ravel()[self.cells[start:end] - row0*self.grid.nCols] = self.values[start:end]
+        return out
+
+    def dense(self, dtype=None):
+        return self.band(0, self.grid.nRows, dtype)
+
+    def sum(self):
+        return self.values.sum()
+
+    def _evaluate(self, band, memo):
+        if not self.grid.sameAs(memo['grid']):
+            raise ValueError('Sparse raster is on a different grid than the one being evaluated')
+        return self.band(band[0], band[1]), None
+
+    def plus(self, other):
+        # Sparse sum of two sparse rasters on the same grid (the + operator builds a lazy dense expression instead)
+        return SparseRaster(self.grid, np.concatenate((self.cells, other.cells)),
+                            np.concatenate((self.values, other.values)))
+
+    def save(self, path):
+        grid = self.grid
+        indexType = np.uint32 if grid.nRows*grid.nCols < 2**32 else np.int64
+        np.savez_compressed(path, cells=self.cells.astype(indexType), values=self.values,
+                            grid=np.array([grid.xMin, grid.yMax, grid.cellSize, grid.nRows, grid.nCols]))
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        xMin, yMax, cellSize, nRows, nCols = data['grid']
+        return cls(RasterGrid(xMin, yMax, cellSize, int(nRows), int(nCols)), data['cells'], data['values'])
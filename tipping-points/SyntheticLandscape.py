@@ -0,0 +1,195 @@
+# Synthetic inputs for the manure model, so its slow parts can be timed (see RunBenchmarks.py) without the S:\ drive
+# inputs. Everything is made with NumPy on a RasterGrid of any size, with the same codes and NoData conventions as the
+# real inputs:
+#   nlcd        - NLCD classes (uint8): 82 crops, 81 pasture, 41 forest, 21 developed, 11 water. 0 (NoData) outside
+#                 the basin
+#   cdlN, cdlP  - CDL fertilizer demand (float32), 0 on part of the ag cells. noDataDemand outside the basin
+#   golf        - golf course cells (uint8): 1 on golf courses, 255 (NoData) elsewhere, like the rasterized polygons
+#   basinRect   - ag cells of the whole rectangle, inside and outside the basin (uint8): 1 on ag, 255 (NoData)
+#                 elsewhere, like NLCD_GLB_Rec_Alb_ND255_AGMASK
+#   counties    - county IDs (int32): Voronoi cells of random county seats, 0 outside the basin
+#   confined, pasture - farm count tables (AttributeStores keyed by BIN_CTY) with GMEID, CtyID, Operations,
+#                 kgN_farm_y and kgP_farm_y, like Confined_Animals.dbf / Pasture_Animals.dbf
+#   countyLoads - confined county totals (CtyID, kgN_year, kgP_year, Man_m2), like Total_Confined_County_Loads.dbf
+#   cafoX, cafoY - permitted CAFO locations, on ag cells
+# Land cover comes from smooth random fields (noise on a coarse grid, interpolated), so ag and pasture come in patches
+# like in the basin instead of salt and pepper. The same seed gives the same landscape.
+#
+# With a folder the rasters are memory-mapped .npy files in it, made band by band, so landscapes bigger than memory
+# can be made.
+
+import os
+
+import numpy as np
+
+from AttributeStore import AttributeStore
+from RasterGrid import RasterGrid
+
+noDataDemand = -9999.
+
+
+class Landscape(object):
+
+    def __init__(self, grid, nlcd, cdlN, cdlP, golf, basinRect, counties, confined, pasture, countyLoads, cafoX, cafoY):
+        self.grid = grid
+        self.nlcd = nlcd
+        self.cdlN = cdlN
+        self.cdlP = cdlP
+        self.golf = golf
+        self.basinRect = basinRect
+        self.counties = counties
+        self.confined = confined
+        self.pasture = pasture
+        self.countyLoads = countyLoads
+        self.cafoX = cafoX
+        self.cafoY = cafoY
+
+    @property
+    def nBins(self):
+        return int(self.confined['GMEID'].max())
+
+
+def generate(nRows=2000, nCols=2000, cellSize=30., nCounties=20, nBins=10, confinedFarms=2000, pastureFarms=4000,
+             cafos=200, agFraction=0.45, pastureFraction=0.1, patchCells=60, seed=0, folder=None, bandRows=512):
+    # nRows x nCols raster. confinedFarms/pastureFarms: about how many farms the tables ask for in all, cafos: number
+    # of permitted CAFOs. agFraction/pastureFraction: share of the basin's cells in crops/pasture. patchCells: size
+    # of the land cover patches in cells
+    rng = np.random.RandomState(seed)
+    grid = RasterGrid(0., nRows*cellSize, cellSize, nRows, nCols)
+    nlcd = _array(folder, 'nlcd', np.uint8, grid.shape)
+    cdlN = _array(folder, 'cdlN', np.float32, grid.shape)
+    cdlP = _array(folder, 'cdlP', np.float32, grid.shape)
+    golf = _array(folder, 'golf', np.uint8, grid.shape)
+    basinRect = _array(folder, 'basinRect', np.uint8, grid.shape)
+    counties = _array(folder, 'counties', np.int32, grid.shape)
+    # Coarse noise for land cover, demand and golf courses, and county seats inside the basin
+    coarseShape = (nRows//patchCells+2, nCols//patchCells+2)
+    coverNoise = rng.standard_normal(coarseShape)
+    demandNoise = rng.standard_normal(coarseShape)
+    seatRows, seatCols = _basinCells(rng, grid, nCounties)
+    # Land cover thresholds on the smooth field: the top agFraction is crops, the next pastureFraction is pasture
+    sample = _smooth(coverNoise, patchCells, rng.randint(0, nRows, 4096), rng.randint(0, nCols, 4096))
+    cropCut, pastureCut, forestCut, developedCut = np.percentile(
+        sample, [100*(1-agFraction), 100*(1-agFraction-pastureFraction), 25, 8])
+    cols = np.arange(nCols)
+    for row0 in range(0, nRows, bandRows):
+        row1 = min(row0+bandRows, nRows)
+        rows = np.arange(row0, row1)
+        rowGrid, colGrid = np.meshgrid(rows, cols, indexing='ij')
+        inBasin = _inBasin(grid, rowGrid, colGrid)
+        cover = _smooth(coverNoise, patchCells, rowGrid, colGrid)
+        band = np.full(rowGrid.shape, 41, dtype=np.uint8)
+        band[cover < forestCut] = 21
+        band[cover < developedCut] = 11
+        band[cover >= pastureCut] = 81
+        band[cover >= cropCut] = 82
+        band[~inBasin] = 0
+        nlcd[row0:row1] = band
+        # Demand on crop and pasture cells, with some ag cells that take none
+        demand = np.exp(_smooth(demandNoise, patchCells, rowGrid, colGrid))
+        fertilized = ((band == 82) | (band == 81)) & (rng.random_sample(band.shape) > 0.1)
+        cdlN[row0:row1] = np.where(inBasin, np.where(fertilized, 150*demand, 0), noDataDemand)
+        cdlP[row0:row1] = np.where(inBasin, np.where(fertilized, 25*demand, 0), noDataDemand)
+        golf[row0:row1] = np.where(inBasin & (rng.random_sample(band.shape) < 0.002) & (band == 41), 1, 255)
+        basinRect[row0:row1] = np.where(cover >= pastureCut, 1, 255)
+        counties[row0:row1] = np.where(inBasin, _nearest(rowGrid, colGrid, seatRows, seatCols)+1, 0)
+    for array in (nlcd, cdlN, cdlP, golf, basinRect, counties):
+        if isinstance(array, np.memmap):
+            array.flush()
+    # Ag cells per county decide where the farms are, so the tables match the land cover
+    agCells = np.zeros(nCounties+1)
+    pastureCells = np.zeros(nCounties+1)
+    for row0 in range(0, nRows, bandRows):
+        zones = np.asarray(counties[row0:row0+bandRows])
+        cover = np.asarray(nlcd[row0:row0+bandRows])
+        agCells += np.bincount(zones[(cover == 82) | (cover == 81)], minlength=nCounties+1)
+        pastureCells += np.bincount(zones[cover == 81], minlength=nCounties+1)
+    confined = _farmTable(rng, nBins, agCells[1:], confinedFarms, 400.)
+    pasture = _farmTable(rng, nBins, pastureCells[1:], pastureFarms, 15.)
+    # County totals of the confined loads, and manure area as a share of the county's ag cells
+    countyIDs = np.arange(1, nCounties+1, dtype=np.int32)
+    loadN = np.bincount(confined['CtyID'], weights=confined['Operations']*confined['kgN_farm_y'], minlength=nCounties+1)
+    loadP = np.bincount(confined['CtyID'], weights=confined['Operations']*confined['kgP_farm_y'], minlength=nCounties+1)
+    countyLoads = AttributeStore([('CtyID', countyIDs), ('kgN_year', loadN[1:]), ('kgP_year', loadP[1:]),
+                                  ('Man_m2', agCells[1:]*grid.cellArea*rng.uniform(0.05, 0.3, nCounties))], 'CtyID')
+    cafoX, cafoY = _cafoPoints(rng, grid, nlcd, cafos, bandRows)
+    return Landscape(grid, nlcd, cdlN, cdlP, golf, basinRect, counties, confined, pasture, countyLoads, cafoX, cafoY)
+
+
+def _array(folder, name, dtype, shape):
+    if folder is None:
+        return np.zeros(shape, dtype=dtype)
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    return np.lib.format.open_memmap(os.path.join(folder, name+'.npy'), 'w+', dtype, shape)
+
+
+def _smooth(noise, patchCells, rows, cols):
+    # Bilinear interpolation of coarse noise at (rows, cols)
+    r = np.asarray(rows, dtype=np.float64)/patchCells
+    c = np.asarray(cols, dtype=np.float64)/patchCells
+    r0 = r.astype(np.int64)
+    c0 = c.astype(np.int64)
+    dr = r - r0
+    dc = c - c0
+    return ((noise[r0, c0]*(1-dc) + noise[r0, c0+1]*dc)*(1-dr) +
+            (noise[r0+1, c0]*(1-dc) + noise[r0+1, c0+1]*dc)*dr)
+
+
+def _inBasin(grid, rows, cols):
+    # The basin is the ellipse filling most of the rectangle. The corners are the 'rest of the US' part of the
+    # rectangle, where manure can be spread but no farms are placed
+    y = (rows + 0.5)/grid.nRows - 0.5
+    x = (cols + 0.5)/grid.nCols - 0.5
+    return (x/0.48)**2 + (y/0.48)**2 <= 1
+
+
+def _basinCells(rng, grid, n):
+    rows = list()
+    cols = list()
+    while len(rows) < n:
+        r = rng.randint(0, grid.nRows, 4*n)
+        c = rng.randint(0, grid.nCols, 4*n)
+        inside = _inBasin(grid, r, c)
+        rows.extend(r[inside])
+        cols.extend(c[inside])
+    return np.array(rows[:n]), np.array(cols[:n])
+
+
+def _nearest(rows, cols, seatRows, seatCols, maxCells=2**23):
+    # Index of the nearest county seat of each cell, a few rows at a time to bound the distance table
+    out = np.zeros(rows.shape, dtype=np.int32)
+    step = max(1, maxCells//max(1, rows.shape[1]*len(seatRows)))
+    for i in range(0, rows.shape[0], step):
+        d = ((rows[i:i+step, :, None]-seatRows)**2 + (cols[i:i+step, :, None]-seatCols)**2)
+        out[i:i+step] = d.argmin(axis=2)
+    return out
+
+
+def _farmTable(rng, nBins, countyWeights, totalFarms, meanPLoad):
+    # One row per bin and county with farms. Bigger bins (higher GMEID) have fewer, bigger farms
+    nCounties = len(countyWeights)
+    share = countyWeights/max(countyWeights.sum(), 1.)
+    binShare = 1./np.arange(1, nBins+1)
+    binShare /= binShare.sum()
+    binIDs, countyIDs = np.meshgrid(np.arange(1, nBins+1), np.arange(1, nCounties+1), indexing='ij')
+    operations = rng.poisson(totalFarms*binShare[:, None]*share[None, :]).astype(np.float64)
+    keep = operations.ravel() > 0
+    binIDs = binIDs.ravel()[keep]
+    countyIDs = countyIDs.ravel()[keep].astype(np.int32)
+    operations = operations.ravel()[keep]
+    loadP = meanPLoad*binIDs*rng.lognormal(0, 0.3, len(binIDs))
+    return AttributeStore([('BIN_CTY', binIDs*100000+countyIDs), ('GMEID', binIDs), ('CtyID', countyIDs),
+                           ('Operations', operations), ('kgN_farm_y', 5*loadP), ('kgP_farm_y', loadP)], 'BIN_CTY')
+
+
+def _cafoPoints(rng, grid, nlcd, n, bandRows):
+    # Points on random crop cells, at a random spot inside the cell
+    cells = list()
+    for row0 in range(0, grid.nRows, bandRows):
+        crop = np.flatnonzero(np.asarray(nlcd[row0:row0+bandRows]).ravel() == 82)
+        cells.append(crop[rng.random_sample(len(crop)) < 4.*n/max(1, grid.nRows*grid.nCols)] + row0*grid.nCols)
+    cells = np.concatenate(cells)
+    cells = cells[rng.permutation(len(cells))[:n]]
+    x, y = grid.cellCenters(cells // grid.nCols, cells % grid.nCols)
+    return (x + (rng.random_sample(len(x))-0.5)*grid.cellSize, y + (rng.random_sample(len(y))-0.5)*grid.cellSize)
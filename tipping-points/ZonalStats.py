@@ -0,0 +1,170 @@
+# Zonal statistics on the model's 30 m grid without Statistics_analysis, Dissolve or SpatialJoin. The zones (counties
+# by CtyID) are rasterized once onto the snap grid and cached as an int32 .npy file, which is memory-mapped when it is
+# used, so later runs skip PolygonToRaster entirely. The cache is rebuilt when the zone features change (same
+# signature as the stage cache in ModelPipeline.py).
+#
+# stats() then works out COUNT, SUM, MIN, MAX and MEAN of a value raster for every zone in one pass over bands of
+# rows: sums and counts with np.bincount, minimums and maximums by sorting each band's cells by zone and reducing
+# each run of equal zones. Values can be a raster path, an array on the same grid or a RasterAlgebra expression.
+# Zone 0 is "no zone".
+#
+# pointZones() looks up the zone of points (e.g. placed farms) from the cell they fall in, instead of SpatialJoin.
+# Only points in cells next to a different zone can be in another polygon than their cell's, so just those are
+# tested against the polygons of the zones around them.
+
+import json
+import os
+
+import numpy as np
+
+import RasterAlgebra
+from AttributeStore import AttributeStore
+from ModelPipeline import signature
+
+
+class ZoneRaster(object):
+
+    def __init__(self, zones, grid, zoneField='ZONE'):
+        self.zones = zones
+        self.grid = grid
+        self.zoneField = zoneField
+
+    @classmethod
+    def fromFeatures(cls, features, zoneField, grid, cacheFolder, bandRows=1024):
+        # Zone raster of features (polygons) by zoneField, from the cache in cacheFolder if it is up to date
+        cachePath = os.path.join(cacheFolder, zoneField+'.npy')
+        infoPath = os.path.join(cacheFolder, zoneField+'.json')
+        info = {'features': str(features), 'signature': signature(features), 'zoneField': zoneField,
+                'grid': [grid.xMin, grid.yMax, grid.cellSize, grid.nRows, grid.nCols]}
+        if os.path.exists(cachePath) and os.path.exists(infoPath):
+            with open(infoPath) as f:
+                if json.load(f) == info:
+                    return cls(np.load(cachePath, mmap_mode='r'), grid, zoneField)
+        import arcpy
+        if not os.path.isdir(cacheFolder):
+            os.makedirs(cacheFolder)
+        # PolygonToRaster follows the snap raster and extent environment settings, which match grid
+        zoneRaster = 'Zones_'+zoneField
+        arcpy.PolygonToRaster_conversion(features, zoneField, zoneRaster, 'CELL_CENTER', '', grid.cellSize)
+        zones = np.lib.format.open_memmap(cachePath, 'w+', np.int32, grid.shape)
+        for row0 in range(0, grid.nRows, bandRows):
+            row1 = min(row0+bandRows, grid.nRows)
+            band = grid.window(row0, row1, 0, grid.nCols)
+            zones[row0:row1] = arcpy.RasterToNumPyArray(zoneRaster, band.lowerLeft(), band.nCols, band.nRows, 0)
+        zones.flush()
+        del zones
+        arcpy.Delete_management(zoneRaster)
+        with open(infoPath, 'w') as f:
+            json.dump(info, f)
+        return cls(np.load(cachePath, mmap_mode='r'), grid, zoneField)
+
+    @classmethod
+    def fromArray(cls, zones, grid, zoneField='ZONE'):
+        return cls(np.asarray(zones, dtype=np.int32), grid, zoneField)
+
+    def stats(self, values, name='VALUE', noData=None, bandRows=1024):
+        # AttributeStore keyed by the zone field, with COUNT, SUM_<name>, MIN_<name>, MAX_<name> and MEAN_<name> like
+        # Statistics_analysis. NoData and NaN cells are left out. Zones with no valid cells get COUNT 0 and NaN stats
+        if not isinstance(values, RasterAlgebra.Expr):
+            values = RasterAlgebra.Raster(values, noData)
+        size = 1
+        sums = np.zeros(size)
+        counts = np.zeros(size, dtype=np.int64)
+        mins = np.full(size, np.inf)
+        maxs = np.full(size, -np.inf)
+        present = np.zeros(size, dtype=bool)
+        for row0 in range(0, self.grid.nRows, bandRows):
+            row1 = min(row0+bandRows, self.grid.nRows)
+            zones = np.asarray(self.zones[row0:row1]).ravel()
+            bandValues, valid = values.evaluateBand((row0, row1), {'grid': self.grid})
+            # Constants (e.g. Con(mask, 900, 0) over a band with no mask cells) are spread over the band
+            blank = np.zeros((row1-row0, self.grid.nCols))
+            bandValues = (blank + bandValues).ravel()
+            keep = (zones > 0) & ~np.isnan(bandValues)
+            if valid is not None:
+                keep &= ((blank == 0) & valid).ravel()
+            if zones.max() >= size:
+                # Grow the per-zone arrays to the biggest zone ID seen so far
+                grow = int(zones.max())+1-size
+                sums = np.append(sums, np.zeros(grow))
+                counts = np.append(counts, np.zeros(grow, dtype=np.int64))
+                mins = np.append(mins, np.full(grow, np.inf))
+                maxs = np.append(maxs, np.full(grow, -np.inf))
+                present = np.append(present, np.zeros(grow, dtype=bool))
+                size = len(sums)
+            present[np.unique(zones[zones > 0])] = True
+            zones = zones[keep]
+            bandValues = bandValues[keep]
+            if len(zones) == 0:
+                continue
+            sums += np.bincount(zones, weights=bandValues, minlength=size)
+            counts += np.bincount(zones, minlength=size)
+            order = np.argsort(zones, kind='mergesort')
+            zones = zones[order]
+            bandValues = bandValues[order]
+            starts = np.flatnonzero(np.r_[True, zones[1:] != zones[:-1]])
+            runZones = zones[starts]
+            mins[runZones] = np.minimum(mins[runZones], np.minimum.reduceat(bandValues, starts))
+            maxs[runZones] = np.maximum(maxs[runZones], np.maximum.reduceat(bandValues, starts))
+        zoneIDs = np.flatnonzero(present)
+        found = counts[zoneIDs] > 0
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = sums[zoneIDs]/counts[zoneIDs]
+        return AttributeStore([(self.zoneField, zoneIDs.astype(np.int32)), ('COUNT', counts[zoneIDs]),
+                               ('SUM_'+name, sums[zoneIDs]),
+                               ('MIN_'+name, np.where(found, mins[zoneIDs], np.nan)),
+                               ('MAX_'+name, np.where(found, maxs[zoneIDs], np.nan)),
+                               ('MEAN_'+name, np.where(found, means, np.nan))], self.zoneField)
+
+    def pointZones(self, x, y, features=None):
+        # Zone ID of each point, 0 outside the grid or every zone. With features (the polygons the zones were made
+        # from), points in cells on a zone boundary are checked against the polygons. A point that isn't in any of
+        # them (e.g. a farm placed at a random spot in a shoreline cell) keeps the zone of its cell
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        rows, cols = self.grid.rowCol(x, y)
+        inside = self.grid.inside(rows, cols)
+        zones = np.zeros(len(x), dtype=np.int32)
+        zones[inside] = self.zones[rows[inside], cols[inside]]
+        if features is None:
+            return zones
+        neighbors = self._neighborZones(rows, cols, inside)
+        boundary = inside & (neighbors != zones[:, None]).any(axis=1)
+        if boundary.any():
+            zones[boundary] = _polygonZones(features, self.zoneField, x[boundary], y[boundary], neighbors[boundary],
+                                            zones[boundary])
+        return zones
+
+    def _neighborZones(self, rows, cols, inside):
+        # Zones of the 3 x 3 cells around each point (0 off the grid)
+        neighbors = np.zeros((len(rows), 9), dtype=np.int32)
+        k = 0
+        for dr in (-1, 0, 1):
+            for dc in (-1, 0, 1):
+                r = rows + dr
+                c = cols + dc
+                onGrid = inside & self.grid.inside(r, c)
+                neighbors[onGrid, k] = self.zones[r[onGrid], c[onGrid]]
+                k += 1
+        return neighbors
+
+
+def _polygonZones(features, zoneField, x, y, candidates, cellZones):
+    # Zone of each point from a point-in-polygon test against the polygons of its candidate zones. Points in none of
+    # them keep cellZones, the zone of the cell they are in
+    import arcpy
+    spatialReference = arcpy.Describe(features).spatialReference
+    wanted = set(int(zone) for zone in np.unique(candidates) if zone != 0)
+    polygons = dict()
+    with arcpy.da.SearchCursor(features, [zoneField, 'SHAPE@']) as cursor:
+        for zone, shape in cursor:
+            if zone is not None and int(zone) in wanted:
+                polygons.setdefault(int(zone), list()).append(shape)
+    zones = np.array(cellZones, dtype=np.int32)
+    for i in range(len(x)):
+        point = arcpy.PointGeometry(arcpy.Point(float(x[i]), float(y[i])), spatialReference)
+        for zone in np.unique(candidates[i]):
+            if zone != 0 and any(shape.contains(point) for shape in polygons.get(int(zone), ())):
+                zones[i] = zone
+                break
+    return zones